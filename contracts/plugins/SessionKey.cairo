@@ -14,7 +14,7 @@ from starkware.cairo.common.math_cmp import is_le_felt
 from starkware.cairo.common.registers import get_fp_and_pc
 from starkware.cairo.common.alloc import alloc
 from starkware.cairo.common.bool import TRUE, FALSE
-from starkware.cairo.common.math import assert_not_zero, assert_nn
+from starkware.cairo.common.math import assert_not_zero, assert_nn, assert_nn_le, unsigned_div_rem
 from starkware.starknet.common.syscalls import (
     call_contract,
     get_tx_info,
@@ -26,14 +26,16 @@ from contracts.account.IPluginAccount import CallArray
 
 // H('StarkNetDomain(chainId:felt)')
 const STARKNET_DOMAIN_TYPE_HASH = 0x13cda234a04d66db62c06b8e3ad5f91bd0c67286c2c7519a826cf49da6ba478;
-// H('Session(key:felt,expires:felt,root:merkletree)')
-const SESSION_TYPE_HASH = 0x1aa0e1c56b45cf06a54534fa1707c54e520b842feb21d03b7deddb6f1e340c;
+// H('Session(key:felt,expires:felt,root:merkletree,epoch:felt)')
+const SESSION_TYPE_HASH = 0x2fa688a35c92dba531f29f73757285d5dabd7edb99bb2ce7ac2b00a0831a46b;
 // H(Policy(contractAddress:felt,selector:selector))
 const POLICY_TYPE_HASH = 0x2f0026e78543f036f33e26a8f5891b88c58dc1e20cbbfaf0bb53274da6fa568;
+// number of multiproof flags packed in a single felt
+const MULTIPROOF_FLAGS_PER_FELT = 128;
 
 @contract_interface
 namespace IAccount {
-    func isValidSignature(hash: felt, sig_len: felt, sig: felt*) {
+    func isValidSignature(hash: felt, sig_len: felt, sig: felt*) -> (isValid: felt) {
     }
 }
 
@@ -41,10 +43,30 @@ namespace IAccount {
 func session_key_revoked(session_key: felt) {
 }
 
+@event
+func all_sessions_revoked(session_epoch: felt) {
+}
+
 @storage_var
 func SessionKey_revoked_keys(key: felt) -> (res: felt) {
 }
 
+// part of every session hash, bumping it invalidates all the existing sessions
+@storage_var
+func SessionKey_session_epoch() -> (res: felt) {
+}
+
+// when enabled, sessions authorised by the account are recorded so the session token
+// is only verified the first time a session is used
+@storage_var
+func SessionKey_session_cache_enabled() -> (res: felt) {
+}
+
+// keyed by the hash of the session hash and the session token, see assert_session_authorised
+@storage_var
+func SessionKey_approved_sessions(approval: felt) -> (res: felt) {
+}
+
 @view
 func supportsInterface{syscall_ptr: felt*, pedersen_ptr: HashBuiltin*, range_check_ptr}(
     interfaceId: felt
@@ -99,7 +121,7 @@ func validate{
     }
 
     with_attr error_message("SessionKey: invalid proof len") {
-         assert proofs_len = call_array_len * proof_len;
+        check_proofs_len(call_array_len, proof_len, proofs_len);
     }
 
     with_attr error_message("SessionKey: invalid signature length") {
@@ -111,15 +133,18 @@ func validate{
         assert_nn(session_expires - now);
     }
 
+    let (session_epoch) = SessionKey_session_epoch.read();
     let (session_hash) = compute_session_hash(
-        session_key, session_expires, root, tx_info.chain_id, tx_info.account_contract_address
+        session_key,
+        session_expires,
+        root,
+        session_epoch,
+        tx_info.chain_id,
+        tx_info.account_contract_address,
     );    
     with_attr error_message("SessionKey: unauthorised session") {
-        IAccount.isValidSignature(
-            contract_address=tx_info.account_contract_address,
-            hash=session_hash,
-            sig_len=session_token_len,
-            sig=session_token,
+        assert_session_authorised(
+            session_hash, session_token_len, session_token, tx_info.account_contract_address
         );
     }
     // check if the session key is revoked
@@ -136,7 +161,12 @@ func validate{
             signature_s=sig_s,
         );
     }
-    check_policy(call_array_len, call_array, root, proof_len, proofs_len, proofs);
+    // a proof_len of 0 means the proofs are a single multiproof for all the calls
+    if (proof_len == 0) {
+        check_policy_multiproof(call_array_len, call_array, root, proofs_len, proofs);
+    } else {
+        check_policy(call_array_len, call_array, root, proof_len, proofs_len, proofs);
+    }
 
     return ();
 }
@@ -152,10 +182,99 @@ func revokeSessionKey{syscall_ptr: felt*, pedersen_ptr: HashBuiltin*, range_chec
     return ();
 }
 
+@external
+func revokeAllSessions{syscall_ptr: felt*, pedersen_ptr: HashBuiltin*, range_check_ptr}() {
+    assert_only_self();
+
+    let (session_epoch) = SessionKey_session_epoch.read();
+    SessionKey_session_epoch.write(session_epoch + 1);
+    all_sessions_revoked.emit(session_epoch + 1);
+    return ();
+}
+
+@view
+func getSessionEpoch{syscall_ptr: felt*, pedersen_ptr: HashBuiltin*, range_check_ptr}() -> (
+    session_epoch: felt
+) {
+    let (session_epoch) = SessionKey_session_epoch.read();
+    return (session_epoch=session_epoch);
+}
+
+@external
+func setSessionCache{syscall_ptr: felt*, pedersen_ptr: HashBuiltin*, range_check_ptr}(
+    enabled: felt
+) {
+    assert_only_self();
+
+    with_attr error_message("SessionKey: invalid value") {
+        assert enabled * (enabled - 1) = 0;
+    }
+    SessionKey_session_cache_enabled.write(enabled);
+    return ();
+}
+
+@view
+func isSessionCacheEnabled{syscall_ptr: felt*, pedersen_ptr: HashBuiltin*, range_check_ptr}() -> (
+    enabled: felt
+) {
+    let (enabled) = SessionKey_session_cache_enabled.read();
+    return (enabled=enabled);
+}
+
 /////////////////////
 // INTERNAL FUNCTIONS
 /////////////////////
 
+// checks the session token, unless the same session and token were already approved while the cache is enabled.
+// An approval only depends on the session hash, which includes the session epoch, and on the token: rotating the
+// owner key or removing the signer plugin of the token doesn't drop it, revokeAllSessions must be called then
+func assert_session_authorised{syscall_ptr: felt*, pedersen_ptr: HashBuiltin*, range_check_ptr}(
+    session_hash: felt, session_token_len: felt, session_token: felt*, account: felt
+) {
+    alloc_locals;
+    let (cache_enabled) = SessionKey_session_cache_enabled.read();
+    if (cache_enabled == FALSE) {
+        assert_valid_session_token(session_hash, session_token_len, session_token, account);
+        return ();
+    }
+
+    let (local approval) = hash_session_approval(session_hash, session_token_len, session_token);
+    let (is_approved) = SessionKey_approved_sessions.read(approval);
+    if (is_approved == TRUE) {
+        return ();
+    }
+    assert_valid_session_token(session_hash, session_token_len, session_token, account);
+    SessionKey_approved_sessions.write(approval, TRUE);
+    return ();
+}
+
+// the signer plugins may return FALSE instead of reverting on an invalid token
+func assert_valid_session_token{syscall_ptr: felt*, range_check_ptr}(
+    session_hash: felt, session_token_len: felt, session_token: felt*, account: felt
+) {
+    let (is_valid) = IAccount.isValidSignature(
+        contract_address=account, hash=session_hash, sig_len=session_token_len, sig=session_token
+    );
+    assert is_valid = TRUE;
+    return ();
+}
+
+func hash_session_approval{pedersen_ptr: HashBuiltin*}(
+    session_hash: felt, session_token_len: felt, session_token: felt*
+) -> (hash: felt) {
+    let hash_ptr = pedersen_ptr;
+    with hash_ptr {
+        let (hash_state) = hash_init();
+        let (hash_state) = hash_update_single(hash_state_ptr=hash_state, item=session_hash);
+        let (hash_state) = hash_update(
+            hash_state_ptr=hash_state, data_ptr=session_token, data_length=session_token_len
+        );
+        let (hash) = hash_finalize(hash_state_ptr=hash_state);
+        let pedersen_ptr = hash_ptr;
+    }
+    return (hash=hash);
+}
+
 func check_policy{
     syscall_ptr: felt*, pedersen_ptr: HashBuiltin*, ecdsa_ptr: SignatureBuiltin*, range_check_ptr
 }(
@@ -172,18 +291,7 @@ func check_policy{
         return ();
     }
 
-    let hash_ptr = pedersen_ptr;
-    with hash_ptr {
-        let (hash_state) = hash_init();
-        let (hash_state) = hash_update_single(hash_state_ptr=hash_state, item=POLICY_TYPE_HASH);
-        let (hash_state) = hash_update_single(hash_state_ptr=hash_state, item=[call_array].to);
-        let (hash_state) = hash_update_single(
-            hash_state_ptr=hash_state, item=[call_array].selector
-        );
-        let (leaf) = hash_finalize(hash_state_ptr=hash_state);
-        let pedersen_ptr = hash_ptr;
-    }
-
+    let (leaf) = hash_policy(call_array);
     let (proof_valid) = merkle_verify(leaf, root, proof_len, proofs);
     with_attr error_message("SessionKey: not allowed by policy") {
         assert proof_valid = TRUE;
@@ -199,8 +307,211 @@ func check_policy{
     return ();
 }
 
+func check_proofs_len{range_check_ptr}(call_array_len: felt, proof_len: felt, proofs_len: felt) {
+    if (proof_len == 0) {
+        assert_nn(proofs_len);
+        return ();
+    }
+    assert proofs_len = call_array_len * proof_len;
+    return ();
+}
+
+// multiproof layout:
+// leaves_len, leaves, call_leaves (index of the leaf of each call), proof_len, proof, flags_len, flags
+func check_policy_multiproof{
+    syscall_ptr: felt*, pedersen_ptr: HashBuiltin*, ecdsa_ptr: SignatureBuiltin*, range_check_ptr
+}(
+    call_array_len: felt, call_array: CallArray*, root: felt, multiproof_len: felt, multiproof: felt*
+) {
+    alloc_locals;
+
+    if (call_array_len == 0) {
+        return ();
+    }
+
+    with_attr error_message("SessionKey: invalid multiproof") {
+        let leaves_len = multiproof[0];
+        assert_nn(leaves_len);
+        let leaves = multiproof + 1;
+        let call_leaves = leaves + leaves_len;
+        let proof_len = call_leaves[call_array_len];
+        assert_nn(proof_len);
+        let proof = call_leaves + call_array_len + 1;
+        let flags_len = proof[proof_len];
+        assert_nn(flags_len);
+        let flags = proof + proof_len + 1;
+        assert multiproof_len = leaves_len + call_array_len + proof_len + flags_len + 3;
+        // at least one hash is needed to reach the root
+        assert_nn(leaves_len + proof_len - 2);
+    }
+
+    with_attr error_message("SessionKey: not allowed by policy") {
+        check_call_leaves(call_array_len, call_array, leaves_len - 1, leaves, call_leaves);
+        let (hashes) = alloc();
+        let (calc_root) = calc_multiproof_root(
+            hashes_len=leaves_len + proof_len - 1,
+            leaves_len=leaves_len,
+            leaves=leaves,
+            hashes_read=hashes,
+            hashes_write=hashes,
+            proof_len=proof_len,
+            proof=proof,
+            flag_word=0,
+            flag_word_len=0,
+            flags_len=flags_len,
+            flags=flags,
+        );
+        assert calc_root = root;
+    }
+    return ();
+}
+
+// checks that the policy of each call is one of the multiproof leaves
+func check_call_leaves{pedersen_ptr: HashBuiltin*, range_check_ptr}(
+    call_array_len: felt, call_array: CallArray*, max_leaf_index: felt, leaves: felt*, call_leaves: felt*
+) {
+    if (call_array_len == 0) {
+        return ();
+    }
+    let (leaf) = hash_policy(call_array);
+    let leaf_index = [call_leaves];
+    assert_nn_le(leaf_index, max_leaf_index);
+    assert leaves[leaf_index] = leaf;
+    return check_call_leaves(
+        call_array_len - 1, call_array + CallArray.SIZE, max_leaf_index, leaves, call_leaves + 1
+    );
+}
+
+// rebuilds the root from the multiproof leaves, the proof nodes and the flags
+// every hash takes its first node from the queue (leaves then computed hashes) and its second
+// node from the queue if the flag is set, from the proof otherwise
+func calc_multiproof_root{pedersen_ptr: HashBuiltin*, range_check_ptr}(
+    hashes_len: felt,
+    leaves_len: felt,
+    leaves: felt*,
+    hashes_read: felt*,
+    hashes_write: felt*,
+    proof_len: felt,
+    proof: felt*,
+    flag_word: felt,
+    flag_word_len: felt,
+    flags_len: felt,
+    flags: felt*,
+) -> (res: felt) {
+    alloc_locals;
+
+    let (a, leaves_len, leaves, hashes_read) = pop_multiproof_queue(
+        leaves_len, leaves, hashes_read, hashes_write
+    );
+    let (flag, flag_word, flag_word_len, flags_len, flags) = pop_multiproof_flag(
+        flag_word, flag_word_len, flags_len, flags
+    );
+    local b;
+    local leaves_len_after;
+    local leaves_after: felt*;
+    local hashes_read_after: felt*;
+    local proof_len_after;
+    local proof_after: felt*;
+    if (flag == 1) {
+        let (node, next_leaves_len, next_leaves, next_hashes_read) = pop_multiproof_queue(
+            leaves_len, leaves, hashes_read, hashes_write
+        );
+        b = node;
+        leaves_len_after = next_leaves_len;
+        leaves_after = next_leaves;
+        hashes_read_after = next_hashes_read;
+        proof_len_after = proof_len;
+        proof_after = proof;
+        tempvar range_check_ptr = range_check_ptr;
+    } else {
+        assert_not_zero(proof_len);
+        b = [proof];
+        leaves_len_after = leaves_len;
+        leaves_after = leaves;
+        hashes_read_after = hashes_read;
+        proof_len_after = proof_len - 1;
+        proof_after = proof + 1;
+        tempvar range_check_ptr = range_check_ptr;
+    }
+
+    let le = is_le_felt(a, b);
+    local node;
+    if (le == 1) {
+        let (n) = hash2{hash_ptr=pedersen_ptr}(a, b);
+        node = n;
+    } else {
+        let (n) = hash2{hash_ptr=pedersen_ptr}(b, a);
+        node = n;
+    }
+    assert [hashes_write] = node;
+
+    if (hashes_len == 1) {
+        // every leaf and proof node must have been used
+        assert leaves_len_after = 0;
+        assert proof_len_after = 0;
+        return (node,);
+    }
+
+    return calc_multiproof_root(
+        hashes_len - 1,
+        leaves_len_after,
+        leaves_after,
+        hashes_read_after,
+        hashes_write + 1,
+        proof_len_after,
+        proof_after,
+        flag_word,
+        flag_word_len,
+        flags_len,
+        flags,
+    );
+}
+
+// takes the next leaf, or the next computed hash once all the leaves are used
+func pop_multiproof_queue(
+    leaves_len: felt, leaves: felt*, hashes_read: felt*, hashes_write: felt*
+) -> (node: felt, leaves_len: felt, leaves: felt*, hashes_read: felt*) {
+    if (leaves_len != 0) {
+        return ([leaves], leaves_len - 1, leaves + 1, hashes_read);
+    }
+    // a hash can only be used after it has been computed
+    assert_not_zero(hashes_write - hashes_read);
+    return ([hashes_read], 0, leaves, hashes_read + 1);
+}
+
+// takes the next flag, flags are packed from the least significant bit
+func pop_multiproof_flag{range_check_ptr}(
+    flag_word: felt, flag_word_len: felt, flags_len: felt, flags: felt*
+) -> (flag: felt, flag_word: felt, flag_word_len: felt, flags_len: felt, flags: felt*) {
+    if (flag_word_len == 0) {
+        assert_not_zero(flags_len);
+        let (next_word, flag) = unsigned_div_rem([flags], 2);
+        return (flag, next_word, MULTIPROOF_FLAGS_PER_FELT - 1, flags_len - 1, flags + 1);
+    }
+    let (next_word, flag) = unsigned_div_rem(flag_word, 2);
+    return (flag, next_word, flag_word_len - 1, flags_len, flags);
+}
+
+func hash_policy{pedersen_ptr: HashBuiltin*}(policy_call: CallArray*) -> (leaf: felt) {
+    let hash_ptr = pedersen_ptr;
+    with hash_ptr {
+        let (hash_state) = hash_init();
+        let (hash_state) = hash_update_single(hash_state_ptr=hash_state, item=POLICY_TYPE_HASH);
+        let (hash_state) = hash_update_single(hash_state_ptr=hash_state, item=[policy_call].to);
+        let (hash_state) = hash_update_single(hash_state_ptr=hash_state, item=[policy_call].selector);
+        let (leaf) = hash_finalize(hash_state_ptr=hash_state);
+        let pedersen_ptr = hash_ptr;
+    }
+    return (leaf=leaf);
+}
+
 func compute_session_hash{pedersen_ptr: HashBuiltin*}(
-    session_key: felt, session_expires: felt, root: felt, chain_id: felt, account: felt
+    session_key: felt,
+    session_expires: felt,
+    root: felt,
+    session_epoch: felt,
+    chain_id: felt,
+    account: felt,
 ) -> (hash: felt) {
     alloc_locals;
     let hash_ptr = pedersen_ptr;
@@ -210,7 +521,7 @@ func compute_session_hash{pedersen_ptr: HashBuiltin*}(
         let (domain_hash) = hash_domain(chain_id);
         let (hash_state) = hash_update_single(hash_state_ptr=hash_state, item=domain_hash);
         let (hash_state) = hash_update_single(hash_state_ptr=hash_state, item=account);
-        let (message_hash) = hash_message(session_key, session_expires, root);
+        let (message_hash) = hash_message(session_key, session_expires, root, session_epoch);
         let (hash_state) = hash_update_single(hash_state_ptr=hash_state, item=message_hash);
         let (hash) = hash_finalize(hash_state_ptr=hash_state);
         let pedersen_ptr = hash_ptr;
@@ -228,14 +539,15 @@ func hash_domain{hash_ptr: HashBuiltin*}(chain_id: felt) -> (hash: felt) {
     return (hash=hash);
 }
 
-func hash_message{hash_ptr: HashBuiltin*}(session_key: felt, session_expires: felt, root: felt) -> (
-    hash: felt
-) {
+func hash_message{hash_ptr: HashBuiltin*}(
+    session_key: felt, session_expires: felt, root: felt, session_epoch: felt
+) -> (hash: felt) {
     let (hash_state) = hash_init();
     let (hash_state) = hash_update_single(hash_state_ptr=hash_state, item=SESSION_TYPE_HASH);
     let (hash_state) = hash_update_single(hash_state_ptr=hash_state, item=session_key);
     let (hash_state) = hash_update_single(hash_state_ptr=hash_state, item=session_expires);
     let (hash_state) = hash_update_single(hash_state_ptr=hash_state, item=root);
+    let (hash_state) = hash_update_single(hash_state_ptr=hash_state, item=session_epoch);
     let (hash) = hash_finalize(hash_state_ptr=hash_state);
     return (hash=hash);
 }
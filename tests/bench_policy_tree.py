@@ -0,0 +1,80 @@
+# Compares building a session policy tree level by level against rebuilding the tree for every proof.
+# With --streaming, compares the peak memory of an in-memory PolicyTree and a file-backed StreamingPolicyTree.
+# usage: python tests/bench_policy_tree.py [--streaming] [size ...]
+import sys
+import tempfile
+import time
+import tracemalloc
+from utils.merkle_utils import get_leaves, generate_merkle_root, generate_merkle_proof, generate_merkle_tree, get_merkle_proofs, PolicyTree, StreamingPolicyTree
+from utils.session_keys_utils import POLICY_TYPE_HASH
+
+DEFAULT_SIZES = [2, 8, 32, 128, 512]
+STREAMING_SIZES = [1024, 16384, 131072]
+# the per-leaf rebuild is quadratic, skip it for larger policies
+MAX_PER_LEAF_SIZE = 128
+
+
+def per_leaf_tree(leaves):
+    root = generate_merkle_root(list(leaves))
+    proofs = [generate_merkle_proof(list(leaves), index) for index in range(len(leaves))]
+    return root, proofs
+
+
+def level_tree(leaves):
+    levels = generate_merkle_tree(leaves)
+    return levels[-1][0], get_merkle_proofs(levels)
+
+
+def timed(fun, *args):
+    start = time.perf_counter()
+    res = fun(*args)
+    return res, time.perf_counter() - start
+
+
+def main(sizes):
+    print(f"{'leaves':>8} {'per leaf (s)':>14} {'levels (s)':>12} {'speedup':>9}")
+    for size in sizes:
+        merkle_leaves = get_leaves(
+            policy_type_hash=POLICY_TYPE_HASH,
+            contracts=[0x1000 + i for i in range(size)],
+            selectors=[0x2000 + i for i in range(size)],
+        )
+        leaves = [leave[0] for leave in merkle_leaves]
+        new_res, new_time = timed(level_tree, leaves)
+        if size > MAX_PER_LEAF_SIZE:
+            print(f"{size:>8} {'-':>14} {new_time:>12.4f} {'-':>9}")
+            continue
+        old_res, old_time = timed(per_leaf_tree, leaves)
+        assert old_res == new_res, "tree builders disagree"
+        print(f"{size:>8} {old_time:>14.4f} {new_time:>12.4f} {old_time / new_time:>8.1f}x")
+
+
+def traced(fun, *args):
+    tracemalloc.start()
+    res, elapsed = timed(fun, *args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return res, elapsed, peak
+
+
+def streaming_main(sizes):
+    print(f"{'leaves':>8} {'memory (s)':>11} {'memory (MB)':>12} {'stream (s)':>11} {'stream (MB)':>12}")
+    for size in sizes:
+        memory_tree, memory_time, memory_peak = traced(
+            PolicyTree, POLICY_TYPE_HASH, [0x1000 + i for i in range(size)], [0x2000 + i for i in range(size)]
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            streaming_tree, streaming_time, streaming_peak = traced(
+                StreamingPolicyTree, directory, POLICY_TYPE_HASH, ((0x1000 + i, 0x2000 + i) for i in range(size))
+            )
+            assert streaming_tree.root == memory_tree.root, "tree builders disagree"
+            streaming_tree.close()
+        print(f"{size:>8} {memory_time:>11.2f} {memory_peak / 1e6:>12.1f} {streaming_time:>11.2f} {streaming_peak / 1e6:>12.1f}")
+
+
+if __name__ == '__main__':
+    arguments = [argument for argument in sys.argv[1:] if argument != '--streaming']
+    if '--streaming' in sys.argv[1:]:
+        streaming_main([int(arg) for arg in arguments] or STREAMING_SIZES)
+    else:
+        main([int(arg) for arg in arguments] or DEFAULT_SIZES)
@@ -0,0 +1,140 @@
+# Sweeps the SessionKey validation over the policy size and the calls per transaction, against the StarkSigner plugin.
+# Records the Cairo resources, the signature length and the python signing time of each point.
+# usage: python tests/bench_session_key.py [--full] [--baseline path] [--check path]
+#   --full           sweeps every policy size from 2 to 4096 leaves (proof depth 1 to 12) and 1 to 32 calls
+#   --baseline path  writes the resource records of the sweep to path
+#   --check path     fails when a point uses notably more resources than in the baseline at path
+import argparse
+import asyncio
+import sys
+import time
+from starkware.starknet.definitions.general_config import StarknetChainId
+from starkware.starknet.testing.starknet import Starknet
+from utils.merkle_utils import NativeHashBackend, set_hash_backend
+from utils.plugin_signer import StarkPluginSigner
+from utils.resources import ResourceRecorder, compare_resource_records, read_resource_records, write_resource_records
+from utils.session_keys_utils import SessionPluginSigner, build_policy_tree, build_session
+from utils.utils import StarkKeyPair, compile_many
+
+DEFAULT_LEAVES = [2, 64, 4096]
+DEFAULT_CALLS = [1, 8, 32]
+FULL_LEAVES = [2 ** depth for depth in range(1, 13)]
+FULL_CALLS = [1, 2, 4, 8, 16, 32]
+# relative growth of a resource reported as a regression
+TOLERANCE = 0.05
+SESSION_EXPIRATION = 2 ** 40
+
+signer_key = StarkKeyPair(123456789987654321)
+session_key = StarkKeyPair(666666666666666666)
+
+
+async def setup():
+    account_cls, sts_plugin_cls, session_key_cls, dapp_cls = compile_many([
+        'contracts/account/PluginAccount.cairo',
+        'contracts/plugins/signer/StarkSigner.cairo',
+        'contracts/plugins/SessionKey.cairo',
+        'contracts/test/Dapp.cairo',
+    ])
+    starknet = await Starknet.empty()
+    sts_plugin_decl = await starknet.declare(contract_class=sts_plugin_cls)
+    session_key_decl = await starknet.declare(contract_class=session_key_cls)
+    # fixed salts keep the addresses, so the ordering of the hashed pairs, identical between runs
+    account = await starknet.deploy(contract_class=account_cls, constructor_calldata=[], contract_address_salt=1)
+    await account.initialize(sts_plugin_decl.class_hash, [signer_key.public_key]).execute()
+    dapps = [
+        await starknet.deploy(contract_class=dapp_cls, constructor_calldata=[], contract_address_salt=salt)
+        for salt in [2, 3]
+    ]
+    stark_plugin_signer = StarkPluginSigner(signer_key, account, sts_plugin_decl.class_hash)
+    session_plugin_signer = SessionPluginSigner(session_key, account, session_key_decl.class_hash)
+    await stark_plugin_signer.add_plugin(session_key_decl.class_hash)
+    return account, stark_plugin_signer, session_plugin_signer, dapps
+
+
+def build_benchmark_session(stark_plugin_signer, account, allowed_calls, leaves):
+    # the policy is padded with calls to a missing entrypoint of the first dapp
+    padding = [(allowed_calls[0][0], f"padding_{index}") for index in range(leaves - len(allowed_calls))]
+    policy = allowed_calls[:leaves] + padding
+    return build_session(
+        signer=stark_plugin_signer,
+        allowed_calls=policy,
+        session_public_key=session_key.public_key,
+        session_expiration=SESSION_EXPIRATION,
+        chain_id=StarknetChainId.TESTNET.value,
+        account_address=account.contract_address,
+        policy_tree=build_policy_tree(policy),
+    )
+
+
+async def run_point(recorder, label, get_signed_transaction, send_signed_tx):
+    start = time.perf_counter()
+    signed_tx = await get_signed_transaction()
+    signing_time = time.perf_counter() - start
+    with recorder.labelled(label):
+        await send_signed_tx(signed_tx)
+    resource_record = recorder.records[-1]
+    print(
+        f"{label:>44} {resource_record.signature_len:>8} {resource_record.validate.n_steps:>9} "
+        f"{resource_record.validate.pedersen:>9} {resource_record.validate.range_check:>7} {resource_record.validate.ecdsa:>6} "
+        f"{resource_record.n_steps:>9} {signing_time * 1000:>9.1f}"
+    )
+
+
+async def main(leaves_sweep, calls_sweep):
+    account, stark_plugin_signer, session_plugin_signer, dapps = await setup()
+    recorder = ResourceRecorder()
+    stark_plugin_signer.resource_recorder = recorder
+    session_plugin_signer.resource_recorder = recorder
+    allowed_calls = [(dapp.contract_address, selector) for selector in ['set_balance', 'increase_balance'] for dapp in dapps]
+
+    def get_calls(count, leaves):
+        usable_calls = allowed_calls[:leaves]
+        return [(*usable_calls[index % len(usable_calls)], [index]) for index in range(count)]
+
+    print(f"{'point':>44} {'sig len':>8} {'v. steps':>9} {'pedersen':>9} {'range':>7} {'ecdsa':>6} {'steps':>9} {'sign ms':>9}")
+    for calls_count in calls_sweep:
+        calls = get_calls(calls_count, len(allowed_calls))
+        await run_point(
+            recorder, f"stark_signer/calls={calls_count}",
+            lambda: stark_plugin_signer.get_signed_transaction(calls),
+            stark_plugin_signer.send_signed_tx,
+        )
+
+    for leaves in leaves_sweep:
+        session = build_benchmark_session(stark_plugin_signer, account, allowed_calls, leaves)
+        for calls_count in calls_sweep:
+            calls = get_calls(calls_count, leaves)
+            await run_point(
+                recorder, f"session_key/leaves={leaves}/calls={calls_count}",
+                lambda: session_plugin_signer.get_signed_transaction(calls, session),
+                session_plugin_signer.send_signed_tx,
+            )
+            await run_point(
+                recorder, f"session_key_multiproof/leaves={leaves}/calls={calls_count}",
+                lambda: session_plugin_signer.get_signed_transaction_with_multiproof(calls, session),
+                session_plugin_signer.send_signed_tx,
+            )
+    return recorder.records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--full', action='store_true')
+    parser.add_argument('--baseline')
+    parser.add_argument('--check')
+    args = parser.parse_args()
+
+    try:
+        set_hash_backend(NativeHashBackend())
+    except AssertionError:
+        pass
+    records = asyncio.run(main(FULL_LEAVES if args.full else DEFAULT_LEAVES, FULL_CALLS if args.full else DEFAULT_CALLS))
+
+    if args.baseline:
+        write_resource_records(args.baseline, records)
+    if args.check:
+        regressions = compare_resource_records(read_resource_records(args.check), records, TOLERANCE)
+        for regression in regressions:
+            print(f"regression {regression}")
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,73 @@
+# Measures the transactions per second of a ShardedSender spreading the calls over 1, 2, 4 and 8 accounts,
+# on the in-process state or through the local gateway stand-in.
+# usage: python tests/bench_sharded_sender.py [transaction count] [--gateway]
+import asyncio
+import sys
+import time
+from starkware.starknet.testing.starknet import Starknet
+from utils.gateway import GatewaySubmitter, start_gateway
+from utils.pipeline import SubmissionPipeline
+from utils.plugin_signer import StarkPluginSigner
+from utils.sharded_sender import ShardedSender
+from utils.utils import StarkKeyPair, compile_many
+
+DEFAULT_COUNT = 32
+ACCOUNTS = [1, 2, 4, 8]
+MAX_BACKLOG = 4
+
+
+async def send_all(sender, calls_list):
+    async def produce():
+        for calls in calls_list:
+            await sender.send(calls)
+        await sender.close()
+
+    producer = asyncio.ensure_future(produce())
+    completions = [completion async for completion in sender.completions()]
+    await producer
+    return completions
+
+
+async def main(count, gateway):
+    account_cls, sts_plugin_cls, dapp_cls = compile_many([
+        'contracts/account/PluginAccount.cairo',
+        'contracts/plugins/signer/StarkSigner.cairo',
+        'contracts/test/Dapp.cairo',
+    ])
+    starknet = await Starknet.empty()
+    sts_plugin_decl = await starknet.declare(contract_class=sts_plugin_cls)
+    dapp = await starknet.deploy(contract_class=dapp_cls, constructor_calldata=[])
+    signers = []
+    for index in range(max(ACCOUNTS)):
+        key_pair = StarkKeyPair(123456789987654321 + index, accelerated=True)
+        account = await starknet.deploy(contract_class=account_cls, constructor_calldata=[])
+        await account.initialize(sts_plugin_decl.class_hash, [key_pair.public_key]).execute()
+        signers.append(StarkPluginSigner(key_pair, account, sts_plugin_decl.class_hash))
+
+    runner = None
+    if gateway:
+        runner, url = await start_gateway(starknet.state)
+    calls_list = [[(dapp.contract_address, 'increase_balance', [1])] for _ in range(count)]
+
+    print(f"{'accounts':>8} {'time (s)':>10} {'tx/s':>10}")
+    try:
+        for accounts in ACCOUNTS:
+            pipeline = SubmissionPipeline(
+                submit=GatewaySubmitter(url) if gateway else None,
+                max_in_flight=accounts * MAX_BACKLOG
+            )
+            sender = ShardedSender(signers[:accounts], max_backlog=MAX_BACKLOG, pipeline=pipeline)
+            start = time.perf_counter()
+            completions = await send_all(sender, calls_list)
+            elapsed = time.perf_counter() - start
+            assert all(completion.error is None for completion in completions), "rejected transactions"
+            print(f"{accounts:>8} {elapsed:>10.3f} {count / elapsed:>10.1f}")
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+
+if __name__ == '__main__':
+    arguments = [argument for argument in sys.argv[1:] if argument != '--gateway']
+    count = int(arguments[0]) if arguments else DEFAULT_COUNT
+    asyncio.run(main(count, '--gateway' in sys.argv[1:]))
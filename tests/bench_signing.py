@@ -0,0 +1,54 @@
+# Measures StarkKeyPair.sign_many throughput with a process pool of 1, 2, 4 and 8 workers,
+# and compares the accelerated key pairs with the reference signing.
+# usage: python tests/bench_signing.py [signature count]
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from utils.utils import StarkKeyPair
+
+DEFAULT_COUNT = 256
+WORKERS = [1, 2, 4, 8]
+
+
+def compare_accelerated(count):
+    message_hashes = [0x1234 + i for i in range(count)]
+    print(f"{'signer':>12} {'time (s)':>10} {'sig/s':>10}")
+    results = []
+    for name, key_pair in [
+        ('reference', StarkKeyPair(123456789987654321)),
+        ('accelerated', StarkKeyPair(123456789987654321, accelerated=True)),
+    ]:
+        # the accelerated tables are built on the first signature
+        key_pair.sign(1)
+        start = time.perf_counter()
+        results.append(key_pair.sign_many(message_hashes))
+        signing_time = time.perf_counter() - start
+        print(f"{name:>12} {signing_time:>10.3f} {count / signing_time:>10.1f}")
+    assert results[0] == results[1], "accelerated signatures differ from the reference ones"
+
+
+def main(count):
+    key_pair = StarkKeyPair(123456789987654321)
+    message_hashes = [0x1234 + i for i in range(count)]
+
+    start = time.perf_counter()
+    serial_signatures = key_pair.sign_many(message_hashes)
+    serial_time = time.perf_counter() - start
+    print(f"{'workers':>8} {'time (s)':>10} {'sig/s':>10}")
+    print(f"{'serial':>8} {serial_time:>10.3f} {count / serial_time:>10.1f}")
+
+    for workers in WORKERS:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # start the workers before timing
+            list(executor.map(abs, range(workers)))
+            start = time.perf_counter()
+            signatures = key_pair.sign_many(message_hashes, executor, chunksize=max(1, count // (4 * workers)))
+            pool_time = time.perf_counter() - start
+        assert signatures == serial_signatures, "process pool signatures differ from the serial ones"
+        print(f"{workers:>8} {pool_time:>10.3f} {count / pool_time:>10.1f}")
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_COUNT
+    compare_accelerated(count)
+    main(count)
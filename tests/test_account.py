@@ -1,10 +1,14 @@
 import pytest
 import asyncio
 import logging
+from typing import Dict
 from starkware.starknet.testing.starknet import Starknet
-from utils.utils import compile, build_contract, StarkKeyPair, ERC165_INTERFACE_ID, ERC165_ACCOUNT_INTERFACE_ID, assert_event_emitted, assert_revert, str_to_felt
+from utils.utils import compile_many, fork_state, StarkKeyPair, ERC165_INTERFACE_ID, ERC165_ACCOUNT_INTERFACE_ID, assert_event_emitted, assert_revert, str_to_felt
 from utils.plugin_signer import StarkPluginSigner
 from utils.session_keys_utils import SessionPluginSigner
+from utils.state_snapshot import load_state_snapshot, deployed_contract
+from utils.sharded_sender import ShardedSender
+from utils.pipeline import StateSubmitter, SubmissionPipeline
 from starkware.starknet.compiler.compile import get_selector_from_name
 
 
@@ -22,65 +26,69 @@ def event_loop():
 
 
 @pytest.fixture(scope='module')
-async def starknet():
-    return await Starknet.empty()
+def contract_classes():
+    return compile_many([
+        'contracts/account/PluginAccount.cairo',
+        'contracts/plugins/signer/StarkSigner.cairo',
+        'contracts/plugins/SessionKey.cairo',
+        'contracts/test/Dapp.cairo',
+    ])
 
 
-@pytest.fixture(scope='module')
-async def account_setup(starknet: Starknet):
-    account_cls = compile('contracts/account/PluginAccount.cairo')
-    sts_plugin_cls = compile("contracts/plugins/signer/StarkSigner.cairo")
+async def setup_network(starknet: Starknet, contract_classes):
+    account_cls, sts_plugin_cls, session_key_cls, dapp_cls = contract_classes
     sts_plugin_decl = await starknet.declare(contract_class=sts_plugin_cls)
+    session_key_decl = await starknet.declare(contract_class=session_key_cls)
 
     account = await starknet.deploy(contract_class=account_cls, constructor_calldata=[])
     await account.initialize(sts_plugin_decl.class_hash, [signer_key.public_key]).execute()
 
     account2 = await starknet.deploy(contract_class=account_cls, constructor_calldata=[])
     await account2.initialize(sts_plugin_decl.class_hash, [signer_key_2.public_key]).execute()
-    return account, account2, account_cls, sts_plugin_decl
-
 
-@pytest.fixture(scope='module')
-async def session_plugin_setup(starknet: Starknet):
-    session_key_cls = compile('contracts/plugins/SessionKey.cairo')
-    session_key_decl = await starknet.declare(contract_class=session_key_cls)
-    return session_key_decl
+    await starknet.declare(contract_class=dapp_cls)
+    dapp = await starknet.deploy(contract_class=dapp_cls, constructor_calldata=[])
+    return {
+        'account': account.contract_address,
+        'account_2': account2.contract_address,
+        'dapp': dapp.contract_address,
+        'sts_plugin_class_hash': sts_plugin_decl.class_hash,
+        'session_key_class_hash': session_key_decl.class_hash,
+    }
 
 
 @pytest.fixture(scope='module')
-async def dapp_setup(starknet: Starknet):
-    dapp_cls = compile('contracts/test/Dapp.cairo')
-    await starknet.declare(contract_class=dapp_cls)
-    return await starknet.deploy(contract_class=dapp_cls, constructor_calldata=[])
+async def snapshot(contract_classes):
+    return await load_state_snapshot('test_account', contract_classes, setup_network)
 
 
 @pytest.fixture
-async def network(starknet: Starknet, account_setup, session_plugin_setup, dapp_setup):
-    account, account_2, account_cls, sts_plugin_decl = account_setup
-    session_key_decl = session_plugin_setup
+def network(snapshot, contract_classes):
+    starknet, values = snapshot
+    account_cls, _, _, dapp_cls = contract_classes
 
-    clean_state = starknet.state.copy()
-    account = build_contract(account, state=clean_state)
-    account_2 = build_contract(account_2, state=clean_state)
+    clean_state = fork_state(starknet.state)
+    account = deployed_contract(clean_state, account_cls, values['account'])
+    account_2 = deployed_contract(clean_state, account_cls, values['account_2'])
 
     stark_plugin_signer = StarkPluginSigner(
         stark_key=signer_key,
         account=account,
-        plugin_class_hash=sts_plugin_decl.class_hash
+        plugin_class_hash=values['sts_plugin_class_hash']
     )
 
     stark_plugin_signer_2 = StarkPluginSigner(
         stark_key=signer_key_2,
         account=account_2,
-        plugin_class_hash=sts_plugin_decl.class_hash
+        plugin_class_hash=values['sts_plugin_class_hash']
     )
 
     session_plugin_signer = SessionPluginSigner(
         stark_key=session_key,
         account=account,
-        plugin_class_hash=session_key_decl.class_hash
+        plugin_class_hash=values['session_key_class_hash']
     )
-    dapp = build_contract(dapp_setup, state=clean_state)
+    dapp = deployed_contract(clean_state, dapp_cls, values['dapp'])
 
     return account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp
 
@@ -152,3 +160,94 @@ async def test_executeOnPlugin(network):
 
     read_execution_info = await stark_plugin_signer.read_on_plugin("getPublicKey")
     assert read_execution_info.result[0] == [signer_key.public_key]
+
+
+@pytest.mark.asyncio
+async def test_sharded_sender(network):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp = network
+    sender = ShardedSender([stark_plugin_signer, stark_plugin_signer_2], max_backlog=2)
+
+    async def produce():
+        for value in [1, 2, 3, 4]:
+            await sender.send([(dapp.contract_address, 'increase_balance', [value])], key='keyed')
+        for _ in range(4):
+            await sender.send([(dapp.contract_address, 'increase_balance', [10])])
+        await sender.close()
+
+    producer = asyncio.ensure_future(produce())
+    completions = [completion async for completion in sender.completions()]
+    await producer
+
+    assert all(completion.error is None for completion in completions)
+    assert (await dapp.get_balance().call()).result.res == 50
+    # the calls of a key are sent in order by a single account
+    keyed = [completion for completion in completions if completion.submission.calls[0][2] != [10]]
+    assert len({completion.submission.signer for completion in keyed}) == 1
+    assert [completion.signed_tx.nonce for completion in keyed] == sorted(completion.signed_tx.nonce for completion in keyed)
+    assert {completion.submission.signer for completion in completions} == {stark_plugin_signer, stark_plugin_signer_2}
+
+
+# executes like StateSubmitter, the transactions of a held signer wait until it's released
+class HeldSubmitter(StateSubmitter):
+    def __init__(self):
+        super().__init__()
+        self.held: Dict[StarkPluginSigner, asyncio.Event] = {}
+
+    def hold(self, signer: StarkPluginSigner):
+        self.held[signer] = asyncio.Event()
+
+    def release(self, signer: StarkPluginSigner):
+        self.held.pop(signer).set()
+
+    async def __call__(self, signer, signed_tx):
+        released = self.held.get(signer)
+        if released is not None:
+            await released.wait()
+        return await super().__call__(signer, signed_tx)
+
+
+@pytest.mark.asyncio
+async def test_sharded_sender_rebalance(network):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp = network
+    submitter = HeldSubmitter()
+    sender = ShardedSender(
+        [stark_plugin_signer, stark_plugin_signer_2], max_backlog=2, pipeline=SubmissionPipeline(submit=submitter)
+    )
+    completions = sender.completions()
+
+    async def send(value, key=None):
+        return (await sender.send([(dapp.contract_address, 'increase_balance', [value])], key=key)).signer
+
+    async def wait_completions(count):
+        for _ in range(count):
+            completion = await completions.__anext__()
+            assert completion.error is None
+
+    # the first account is backed up once 2 of its transactions are pending
+    submitter.hold(stark_plugin_signer)
+    assert await send(1, key='key') == stark_plugin_signer
+    assert await send(2) == stark_plugin_signer
+
+    # round-robin skips the backed up account
+    for value in [3, 4]:
+        assert await send(value) == stark_plugin_signer_2
+        await wait_completions(1)
+
+    # a key with pending calls stays on its backed up account
+    assert await send(5, key='key') == stark_plugin_signer
+    submitter.release(stark_plugin_signer)
+    await wait_completions(3)
+
+    # it moves to the least loaded account once its calls are completed
+    submitter.hold(stark_plugin_signer)
+    assert await send(6) == stark_plugin_signer
+    assert await send(7) == stark_plugin_signer_2
+    await wait_completions(1)
+    assert await send(8) == stark_plugin_signer
+    assert await send(9, key='key') == stark_plugin_signer_2
+
+    submitter.release(stark_plugin_signer)
+    await sender.close()
+    remaining = [completion async for completion in completions]
+    assert len(remaining) == 3 and all(completion.error is None for completion in remaining)
+    assert (await dapp.get_balance().call()).result.res == sum(range(1, 10))
@@ -0,0 +1,203 @@
+import os
+import pytest
+from utils.merkle_utils import get_leaves, generate_merkle_root, generate_merkle_proof, generate_merkle_tree, get_merkle_proofs, verify_merkle_proof, generate_merkle_multiproof, verify_merkle_multiproof, PolicyTree, StreamingPolicyTree
+from utils.merkle_utils import PythonHashBackend, NativeHashBackend, HashOnElements, get_hash_backend, set_hash_backend, cpp_hash
+from starkware.cairo.common.hash_state import compute_hash_on_elements
+from starkware.crypto.signature.signature import FIELD_PRIME
+from utils.session_keys_utils import POLICY_TYPE_HASH, STARKNET_DOMAIN_TYPE_HASH, SESSION_TYPE_HASH, get_session_hash, get_session_hash_prefix
+from utils.utils import str_to_felt
+
+
+def build_leaves(size):
+    merkle_leaves = get_leaves(
+        policy_type_hash=POLICY_TYPE_HASH,
+        contracts=[0x1000 + i for i in range(size)],
+        selectors=[0x2000 + i for i in range(size)],
+    )
+    return [leave[0] for leave in merkle_leaves]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 4, 5, 7, 8, 9, 16, 17])
+def test_generate_merkle_tree_matches_per_leaf_proofs(size):
+    leaves = build_leaves(size)
+
+    levels = generate_merkle_tree(leaves)
+    proofs = get_merkle_proofs(levels)
+
+    assert levels[-1][0] == generate_merkle_root(list(leaves))
+    assert proofs == [generate_merkle_proof(list(leaves), index) for index in range(len(leaves))]
+    for leaf, proof in zip(leaves, proofs):
+        assert verify_merkle_proof(leaf, proof + [levels[-1][0]])
+
+
+def test_merkle_functions_do_not_mutate_values():
+    values = [1, 2, 3]
+    levels = generate_merkle_tree(values)
+    assert levels[0] == [1, 2, 3, 0]
+    generate_merkle_root(values)
+    generate_merkle_proof(values, 1)
+    assert values == [1, 2, 3]
+
+
+def assert_tree_matches_rebuild(tree, policies):
+    contracts = [policy[0] for policy in policies]
+    selectors = [policy[1] for policy in policies]
+    leaves = [leave[0] for leave in get_leaves(POLICY_TYPE_HASH, contracts, selectors)]
+    levels = generate_merkle_tree(leaves)
+    proofs = get_merkle_proofs(levels)
+
+    assert len(tree) == len(policies)
+    assert tree.root == levels[-1][0]
+    for policy in policies:
+        proof = tree.get_proof(*policy)
+        assert proof == proofs[leaves.index(tree.get_leaf(*policy))]
+        assert verify_merkle_proof(tree.get_leaf(*policy), proof + [tree.root])
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 8, 9])
+def test_policy_tree_matches_rebuild(size):
+    policies = [(0x1000 + i, 0x2000 + i) for i in range(size)]
+    tree = PolicyTree(POLICY_TYPE_HASH, [p[0] for p in policies], [p[1] for p in policies])
+    assert_tree_matches_rebuild(tree, policies)
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 8, 17, 100])
+def test_streaming_policy_tree_matches_policy_tree(tmp_path, size):
+    # out of order, the policies are found through the sorted index
+    policies = [(0x1000 + (i * 7) % size, 0x2000 + (i * 7) % size) for i in range(size)]
+    policy_tree = PolicyTree(POLICY_TYPE_HASH, [policy[0] for policy in policies], [policy[1] for policy in policies])
+    leaves = [leaf[0] for leaf in get_leaves(POLICY_TYPE_HASH, [policy[0] for policy in policies], [policy[1] for policy in policies])]
+
+    # a small chunk size spreads every level over several chunks
+    streaming_tree = StreamingPolicyTree(str(tmp_path), POLICY_TYPE_HASH, iter(policies), chunk_size=3)
+    assert len(streaming_tree) == size
+    assert streaming_tree.root == policy_tree.root == generate_merkle_root(list(leaves))
+    assert [streaming_tree.get_proof(*policy) for policy in policies] == policy_tree.get_proofs()
+    assert [streaming_tree.get_proof_at(index) for index in range(size)] == get_merkle_proofs(generate_merkle_tree(leaves))[:size]
+    assert policies[-1] in streaming_tree
+    assert (0x1000, 0x2001) not in streaming_tree
+    assert (0x1000 + size, 0x2000 + size) not in streaming_tree
+    assert sorted(os.listdir(tmp_path)) == sorted(['index.bin', *(f"level_{depth}.bin" for depth in range(len(streaming_tree.levels)))])
+    streaming_tree.close()
+
+
+def test_policy_tree_add():
+    tree = PolicyTree(POLICY_TYPE_HASH)
+    policies = []
+    for i in range(9):
+        policies.append((0x1000 + i, 0x2000 + i))
+        tree.add(*policies[-1])
+        assert_tree_matches_rebuild(tree, policies)
+
+
+def test_policy_tree_remove():
+    policies = [(0x1000 + i, 0x2000 + i) for i in range(9)]
+    tree = PolicyTree(POLICY_TYPE_HASH, [p[0] for p in policies], [p[1] for p in policies])
+    for index in [0, 7, 3, 3, 0, 2, 1]:
+        removed = policies[index]
+        tree.remove(*removed)
+        # removal moves the last policy into the freed slot
+        last = policies.pop()
+        if last != removed:
+            policies[index] = last
+        assert removed not in tree
+        assert_tree_matches_rebuild(tree, policies)
+    while policies:
+        tree.remove(*policies.pop())
+    assert len(tree) == 0
+
+
+def test_policy_tree_replace():
+    policies = [(0x1000 + i, 0x2000 + i) for i in range(5)]
+    tree = PolicyTree(POLICY_TYPE_HASH, [p[0] for p in policies], [p[1] for p in policies])
+    tree.replace(*policies[2], 0x3000, 0x4000)
+    policies[2] = (0x3000, 0x4000)
+    assert_tree_matches_rebuild(tree, policies)
+
+
+@pytest.mark.parametrize("indexes", [[0], [0, 1], [1, 2], [0, 5, 6], [7, 3, 2, 8], list(range(9))])
+def test_generate_merkle_multiproof(indexes):
+    leaves = build_leaves(9)
+    levels = generate_merkle_tree(leaves)
+    proofs = get_merkle_proofs(levels)
+    root = levels[-1][0]
+
+    ordered_leaves, proof, flags = generate_merkle_multiproof([leaves[i] for i in indexes], [proofs[i] for i in indexes])
+
+    assert sorted(ordered_leaves) == sorted(leaves[i] for i in indexes)
+    assert verify_merkle_multiproof(ordered_leaves, proof, flags, root)
+    # shared siblings are only sent once
+    assert len(proof) <= sum(len(proofs[i]) for i in indexes)
+    assert not verify_merkle_multiproof(ordered_leaves, proof, flags, root + 1)
+    assert not verify_merkle_multiproof(ordered_leaves[:-1] + [leaves[4] + 1], proof, flags, root)
+
+
+def test_merkle_multiproof_of_all_leaves_has_no_proof_nodes():
+    leaves = build_leaves(8)
+    levels = generate_merkle_tree(leaves)
+    proofs = get_merkle_proofs(levels)
+    ordered_leaves, proof, flags = generate_merkle_multiproof(leaves, proofs)
+    assert proof == []
+    assert flags == [1] * 7
+    assert verify_merkle_multiproof(ordered_leaves, proof, flags, levels[-1][0])
+
+
+class CountingHashBackend(PythonHashBackend):
+    def __init__(self):
+        self.batches = 0
+
+    def hash_pairs(self, pairs):
+        self.batches += 1
+        return super().hash_pairs(pairs)
+
+    def hash_arrays(self, arrays):
+        self.batches += 1
+        return super().hash_arrays(arrays)
+
+
+def test_hash_backend_batches_levels():
+    backend = CountingHashBackend()
+    default_backend = get_hash_backend()
+    set_hash_backend(backend)
+    try:
+        leaves = build_leaves(8)
+        levels = generate_merkle_tree(leaves)
+    finally:
+        set_hash_backend(default_backend)
+    # one batch for the leaves and one per level
+    assert backend.batches == 1 + 3
+    assert levels == generate_merkle_tree(build_leaves(8))
+
+
+@pytest.mark.skipif(cpp_hash is None, reason="crypto-cpp-py is not installed")
+def test_native_hash_backend():
+    python_backend = PythonHashBackend()
+    native_backend = NativeHashBackend()
+    pairs = [(0, 0), (1, 2), (FIELD_PRIME - 1, 2**251 + 17), (POLICY_TYPE_HASH, 0x1234)]
+    assert native_backend.hash_pairs(pairs) == python_backend.hash_pairs(pairs)
+    arrays = [[], [1], [POLICY_TYPE_HASH, 0x1000, 0x2000]]
+    assert native_backend.hash_arrays(arrays) == [compute_hash_on_elements(data) for data in arrays]
+
+
+@pytest.mark.parametrize("size", [0, 1, 2, 5])
+def test_hash_on_elements(size):
+    elements = [FIELD_PRIME - 1 - index for index in range(size)]
+    assert HashOnElements(elements).finalize() == compute_hash_on_elements(elements)
+
+    prefix = HashOnElements(elements[:size // 2])
+    assert prefix.copy().update(elements[size // 2:]).finalize() == compute_hash_on_elements(elements)
+    # the copies don't change the prefix
+    assert prefix.finalize() == compute_hash_on_elements(elements[:size // 2])
+
+
+def test_session_hash():
+    for chain_id, account_address in [(1, 2), (1, 3), (1, 2)]:
+        expected_hash = compute_hash_on_elements([
+            str_to_felt('StarkNet Message'),
+            compute_hash_on_elements([STARKNET_DOMAIN_TYPE_HASH, chain_id]),
+            account_address,
+            compute_hash_on_elements([SESSION_TYPE_HASH, 4, 5, 6, 7]),
+        ])
+        assert get_session_hash(4, 5, 6, 7, chain_id, account_address) == expected_hash
+        # updating a prefix doesn't change the cached one
+        get_session_hash_prefix(chain_id, account_address).update([8])
@@ -1,13 +1,25 @@
 import pytest
 import asyncio
+import dataclasses
+from concurrent.futures import ProcessPoolExecutor
 import logging
 from starkware.starknet.testing.starknet import Starknet
 from starkware.starknet.definitions.general_config import StarknetChainId
 from starkware.starknet.business_logic.state.state import BlockInfo
-from utils.utils import assert_revert, compile, cached_contract, assert_event_emitted, StarkKeyPair, build_contract, ERC165_INTERFACE_ID, ERC165_ACCOUNT_INTERFACE_ID
-from utils.plugin_signer import StarkPluginSigner
-from utils.session_keys_utils import build_session, SessionPluginSigner
+from utils.utils import assert_revert, compile, compile_many, fork_state, cached_contract, assert_event_emitted, StarkKeyPair, build_contract, ERC165_INTERFACE_ID, ERC165_ACCOUNT_INTERFACE_ID
+from utils.plugin_signer import StarkPluginSigner, QUERY_VERSION
+from utils.session_keys_utils import build_session, build_policy_tree, build_multiproof, SessionPluginSigner
+from utils.state_snapshot import load_state_snapshot, deployed_contract
+from utils.pipeline import SubmissionPipeline, Submission, StateSubmitter, StaleNonceError
+from utils.gateway import GatewaySubmitter, start_gateway
+from utils.resources import ResourceRecorder, read_resource_records, write_resource_records
+from utils.compact_session import load_session, write_session
+from utils.session_manager import SessionManager
+from utils.preflight import INVALID_CALLDATA, SessionKeyView, get_transaction_hash, verify_session_transaction, verify_session_transactions
+from starkware.starkware_utils.error_handling import StarkException
+from starkware.cairo.lang.cairo_constants import DEFAULT_PRIME
 from starkware.starknet.compiler.compile import get_selector_from_name
+from starkware.starknet.services.utils.sequencer_api_utils import InternalInvokeFunctionForSimulate
 
 
 LOGGER = logging.getLogger(__name__)
@@ -25,11 +37,6 @@ def event_loop():
     return asyncio.new_event_loop()
 
 
-@pytest.fixture(scope='module')
-async def starknet():
-    return await Starknet.empty()
-
-
 def update_starknet_block(starknet, block_number=1, block_timestamp=DEFAULT_TIMESTAMP):
     old_block_info = starknet.state.state.block_info
     starknet.state.state.block_info = BlockInfo(
@@ -46,10 +53,17 @@ def reset_starknet_block(starknet):
 
 
 @pytest.fixture(scope='module')
-async def account_setup(starknet: Starknet):
-    account_cls = compile('contracts/account/PluginAccount.cairo')
-    session_key_cls = compile('contracts/plugins/SessionKey.cairo')
-    sts_plugin_cls = compile("contracts/plugins/signer/StarkSigner.cairo")
+def contract_classes():
+    return compile_many([
+        'contracts/account/PluginAccount.cairo',
+        'contracts/plugins/signer/StarkSigner.cairo',
+        'contracts/plugins/SessionKey.cairo',
+        'contracts/test/Dapp.cairo',
+    ])
+
+
+async def setup_network(starknet: Starknet, contract_classes):
+    account_cls, sts_plugin_cls, session_key_cls, dapp_cls = contract_classes
 
     session_key_class = await starknet.declare(contract_class=session_key_cls)
     sts_plugin_decl = await starknet.declare(contract_class=sts_plugin_cls)
@@ -60,29 +74,44 @@ async def account_setup(starknet: Starknet):
     await account.initialize(sts_plugin_decl.class_hash, [signer_key.public_key]).execute()
     await account_2.initialize(sts_plugin_decl.class_hash, [signer_key_2.public_key]).execute()
 
-    return account, account_2, session_key_class.class_hash, sts_plugin_decl.class_hash
-
-
-@pytest.fixture(scope='module')
-async def dapp_setup(starknet: Starknet):
-    dapp_cls = compile('contracts/test/Dapp.cairo')
     await starknet.declare(contract_class=dapp_cls)
     dapp1 = await starknet.deploy(contract_class=dapp_cls, constructor_calldata=[])
     dapp2 = await starknet.deploy(contract_class=dapp_cls, constructor_calldata=[])
-    return dapp1, dapp2
+
+    return {
+        'account': account.contract_address,
+        'account_2': account_2.contract_address,
+        'dapp1': dapp1.contract_address,
+        'dapp2': dapp2.contract_address,
+        'session_key_class_hash': session_key_class.class_hash,
+        'sts_plugin_class_hash': sts_plugin_decl.class_hash,
+    }
+
+
+@pytest.fixture(scope='module')
+async def snapshot(contract_classes):
+    return await load_state_snapshot('test_session_key', contract_classes, setup_network)
+
+
+@pytest.fixture(scope='module')
+def starknet(snapshot):
+    starknet, _ = snapshot
+    return starknet
 
 
 @pytest.fixture
-def contracts(starknet: Starknet, account_setup, dapp_setup):
-    account, account_2, session_plugin_class_hash, sts_plugin_class_hash = account_setup
-    dapp1, dapp2 = dapp_setup
-    clean_state = starknet.state.copy()
+def contracts(snapshot, contract_classes):
+    starknet, values = snapshot
+    account_cls, _, _, dapp_cls = contract_classes
+    session_plugin_class_hash = values['session_key_class_hash']
+    sts_plugin_class_hash = values['sts_plugin_class_hash']
+    clean_state = fork_state(starknet.state)
 
-    account = build_contract(account, state=clean_state)
-    account_2 = build_contract(account_2, state=clean_state)
+    account = deployed_contract(clean_state, account_cls, values['account'])
+    account_2 = deployed_contract(clean_state, account_cls, values['account_2'])
 
-    dapp1 = build_contract(dapp1, state=clean_state)
-    dapp2 = build_contract(dapp2, state=clean_state)
+    dapp1 = deployed_contract(clean_state, dapp_cls, values['dapp1'])
+    dapp2 = deployed_contract(clean_state, dapp_cls, values['dapp2'])
 
     stark_plugin_signer = StarkPluginSigner(
         stark_key=signer_key,
@@ -177,6 +206,707 @@ async def test_call_dapp_with_session_key(starknet: Starknet, contracts):
     )
 
 
+@pytest.mark.asyncio
+async def test_call_dapp_with_updated_policy_tree(starknet: Starknet, contracts):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+
+    await stark_plugin_signer.add_plugin(session_key_class)
+    update_starknet_block(starknet=starknet, block_timestamp=DEFAULT_TIMESTAMP)
+
+    allowed_calls = [
+        (dapp1.contract_address, 'set_balance'),
+        (dapp2.contract_address, 'set_balance'),
+    ]
+    policy_tree = build_policy_tree(allowed_calls)
+
+    # allow a new call and re-issue the session from the edited tree
+    policy_tree.add(dapp2.contract_address, get_selector_from_name('set_balance_times3'))
+    policy_tree.remove(dapp1.contract_address, get_selector_from_name('set_balance'))
+    allowed_calls = [
+        (dapp2.contract_address, 'set_balance'),
+        (dapp2.contract_address, 'set_balance_times3'),
+    ]
+    session = build_session(
+        signer=stark_plugin_signer,
+        allowed_calls=allowed_calls,
+        session_public_key=session_key.public_key,
+        session_expiration=DEFAULT_TIMESTAMP + 10,
+        chain_id=StarknetChainId.TESTNET.value,
+        account_address=account.contract_address,
+        policy_tree=policy_tree
+    )
+    assert session.root == build_session(
+        signer=stark_plugin_signer,
+        allowed_calls=allowed_calls,
+        session_public_key=session_key.public_key,
+        session_expiration=DEFAULT_TIMESTAMP + 10,
+        chain_id=StarknetChainId.TESTNET.value,
+        account_address=account.contract_address
+    ).root
+
+    await session_plugin_signer.send_transaction(
+        calls=[(dapp2.contract_address, 'set_balance_times3', [20])],
+        session=session
+    )
+    assert (await dapp2.get_balance().call()).result.res == 60
+
+
+@pytest.mark.asyncio
+async def test_call_dapp_with_multiproof(starknet: Starknet, contracts):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+
+    await stark_plugin_signer.add_plugin(session_key_class)
+    update_starknet_block(starknet=starknet, block_timestamp=DEFAULT_TIMESTAMP)
+
+    session = build_session(
+        signer=stark_plugin_signer,
+        allowed_calls=[
+            (dapp1.contract_address, 'set_balance'),
+            (dapp1.contract_address, 'set_balance_double'),
+            (dapp2.contract_address, 'set_balance'),
+            (dapp2.contract_address, 'set_balance_double'),
+            (dapp2.contract_address, 'set_balance_times3'),
+        ],
+        session_public_key=session_key.public_key,
+        session_expiration=DEFAULT_TIMESTAMP + 10,
+        chain_id=StarknetChainId.TESTNET.value,
+        account_address=account.contract_address
+    )
+    calls = [
+        (dapp1.contract_address, 'set_balance', [1]),
+        (dapp1.contract_address, 'set_balance_double', [2]),
+        (dapp2.contract_address, 'set_balance', [3]),
+        (dapp1.contract_address, 'set_balance', [4]),
+        (dapp2.contract_address, 'set_balance_times3', [5]),
+        (dapp1.contract_address, 'set_balance', [6]),
+    ]
+
+    single_proofs_tx = await session_plugin_signer.get_signed_transaction(calls, session)
+    single_proofs_info = await session_plugin_signer.send_signed_tx(single_proofs_tx)
+    multiproof_tx = await session_plugin_signer.get_signed_transaction_with_multiproof(calls, session)
+    multiproof_info = await session_plugin_signer.send_signed_tx(multiproof_tx)
+
+    assert_event_emitted(
+        multiproof_info,
+        from_address=account.contract_address,
+        name='transaction_executed',
+        data=[]
+    )
+    assert (await dapp1.get_balance().call()).result.res == 6
+    assert (await dapp2.get_balance().call()).result.res == 15
+
+    # the multiproof is shorter and hashes less
+    assert len(multiproof_tx.signature) < len(single_proofs_tx.signature)
+    single_proofs_pedersen = single_proofs_info.validate_info.execution_resources.builtin_instance_counter['pedersen_builtin']
+    multiproof_pedersen = multiproof_info.validate_info.execution_resources.builtin_instance_counter['pedersen_builtin']
+    assert multiproof_pedersen < single_proofs_pedersen
+
+    # a multiproof for other calls is rejected
+    await assert_revert(
+        session_plugin_signer.send_signed_tx(
+            await session_plugin_signer.get_signed_session_transaction(
+                calls=[(dapp1.contract_address, 'set_balance_times3', [47])],
+                session=session,
+                single_proof_len=0,
+                proofs=build_multiproof(session, [(dapp1.contract_address, 'set_balance', [47])])
+            )
+        ),
+        reverted_with="SessionKey: not allowed by policy"
+    )
+
+
+@pytest.mark.asyncio
+async def test_session_cache(starknet: Starknet, contracts):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+
+    await stark_plugin_signer.add_plugin(session_key_class)
+    update_starknet_block(starknet=starknet, block_timestamp=DEFAULT_TIMESTAMP)
+    assert (await stark_plugin_signer.read_on_plugin("isSessionCacheEnabled", plugin=session_key_class)).result[0] == [0]
+
+    session = build_session(
+        signer=stark_plugin_signer,
+        allowed_calls=[(dapp1.contract_address, 'set_balance')],
+        session_public_key=session_key.public_key,
+        session_expiration=DEFAULT_TIMESTAMP + 10,
+        chain_id=StarknetChainId.TESTNET.value,
+        account_address=account.contract_address
+    )
+    calls = [(dapp1.contract_address, 'set_balance', [47])]
+
+    # without the cache every transaction verifies the session token
+    uncached_resources = (await session_plugin_signer.send_transaction(calls, session)).validate_info.execution_resources
+    assert (await session_plugin_signer.send_transaction(calls, session)).validate_info.execution_resources == uncached_resources
+
+    # only self can enable the cache
+    await assert_revert(
+        stark_plugin_signer_2.send_transaction(
+            [(account.contract_address, 'executeOnPlugin', [session_key_class, get_selector_from_name("setSessionCache"), 1, 1])]
+        ),
+        reverted_with="SessionKey: only self"
+    )
+    await stark_plugin_signer.execute_on_plugin("setSessionCache", [1], plugin=session_key_class)
+    assert (await stark_plugin_signer.read_on_plugin("isSessionCacheEnabled", plugin=session_key_class)).result[0] == [1]
+
+    first_resources = (await session_plugin_signer.send_transaction(calls, session)).validate_info.execution_resources
+    cached_resources = (await session_plugin_signer.send_transaction(calls, session)).validate_info.execution_resources
+    LOGGER.info(f"uncached session validation: {uncached_resources}")
+    LOGGER.info(f"cached session validation: {cached_resources}")
+    assert cached_resources.n_steps < uncached_resources.n_steps
+    assert cached_resources.builtin_instance_counter['ecdsa_builtin'] < first_resources.builtin_instance_counter['ecdsa_builtin']
+    assert cached_resources.builtin_instance_counter['pedersen_builtin'] < first_resources.builtin_instance_counter['pedersen_builtin']
+
+    # an approved session can still be revoked
+    await stark_plugin_signer.execute_on_plugin("revokeSessionKey", [session_key.public_key], plugin=session_key_class)
+    await assert_revert(
+        session_plugin_signer.send_transaction(calls, session),
+        reverted_with="SessionKey: session key revoked"
+    )
+
+
+@pytest.mark.asyncio
+async def test_session_cache_owner_rotation(starknet: Starknet, contracts):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+
+    await stark_plugin_signer.add_plugin(session_key_class)
+    await stark_plugin_signer.execute_on_plugin("setSessionCache", [1], plugin=session_key_class)
+    update_starknet_block(starknet=starknet, block_timestamp=DEFAULT_TIMESTAMP)
+
+    session = build_session(
+        signer=stark_plugin_signer,
+        allowed_calls=[(dapp1.contract_address, 'set_balance')],
+        session_public_key=session_key.public_key,
+        session_expiration=DEFAULT_TIMESTAMP + 10,
+        chain_id=StarknetChainId.TESTNET.value,
+        account_address=account.contract_address
+    )
+    calls = [(dapp1.contract_address, 'set_balance', [47])]
+    await session_plugin_signer.send_transaction(calls, session)
+    cached_resources = (await session_plugin_signer.send_transaction(calls, session)).validate_info.execution_resources
+
+    # the approvals don't depend on the owner key, they hold after a rotation until all the sessions are revoked
+    await stark_plugin_signer.execute_on_plugin("setPublicKey", [signer_key_2.public_key])
+    await session_plugin_signer.send_transaction(calls, session)
+    rotated_signer = StarkPluginSigner(stark_key=signer_key_2, account=account, plugin_class_hash=stark_plugin_signer.plugin_class_hash)
+    await rotated_signer.execute_on_plugin("revokeAllSessions", plugin=session_key_class)
+    await assert_revert(
+        session_plugin_signer.send_transaction(calls, session),
+        reverted_with="SessionKey: unauthorised session"
+    )
+    view = await SessionKeyView.load(
+        account.state, account.contract_address, [session_key_class, stark_plugin_signer.plugin_class_hash], [stark_plugin_signer.plugin_class_hash], [session]
+    )
+    signed_tx = await session_plugin_signer.get_signed_transaction(calls, session)
+    assert verify_session_transaction(view, signed_tx) == "SessionKey: unauthorised session"
+    session_plugin_signer.nonce_manager.invalidate()
+
+    # a session authorised by the new owner key is approved again
+    rotated_session = build_session(
+        signer=rotated_signer,
+        allowed_calls=[(dapp1.contract_address, 'set_balance')],
+        session_public_key=session_key.public_key,
+        session_expiration=DEFAULT_TIMESTAMP + 10,
+        chain_id=StarknetChainId.TESTNET.value,
+        account_address=account.contract_address,
+        session_epoch=1
+    )
+
+    async def send_ecdsa_count():
+        execution_info = await session_plugin_signer.send_transaction(calls, rotated_session)
+        return execution_info.validate_info.execution_resources.builtin_instance_counter['ecdsa_builtin']
+
+    cached_ecdsa_count = cached_resources.builtin_instance_counter['ecdsa_builtin']
+    assert await send_ecdsa_count() > cached_ecdsa_count
+    assert await send_ecdsa_count() == cached_ecdsa_count
+
+    # approvals aren't read while the cache is disabled
+    await rotated_signer.execute_on_plugin("setSessionCache", [0], plugin=session_key_class)
+    assert await send_ecdsa_count() > cached_ecdsa_count
+
+
+@pytest.mark.asyncio
+async def test_session_cache_rejected_token(starknet: Starknet, contracts):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+
+    rejecting_signer_class = (await Starknet(state=account.state).declare(contract_class=compile('contracts/test/RejectingSigner.cairo'))).class_hash
+    await stark_plugin_signer.add_plugin(session_key_class)
+    await stark_plugin_signer.add_plugin(rejecting_signer_class)
+    update_starknet_block(starknet=starknet, block_timestamp=DEFAULT_TIMESTAMP)
+
+    session = build_session(
+        signer=stark_plugin_signer,
+        allowed_calls=[(dapp1.contract_address, 'set_balance')],
+        session_public_key=session_key.public_key,
+        session_expiration=DEFAULT_TIMESTAMP + 10,
+        chain_id=StarknetChainId.TESTNET.value,
+        account_address=account.contract_address
+    )
+    # the plugin returns FALSE for the token instead of reverting
+    rejected_session = dataclasses.replace(session, session_token=[rejecting_signer_class, 1, 2])
+    calls = [(dapp1.contract_address, 'set_balance', [47])]
+
+    for cache_enabled in [0, 1]:
+        await stark_plugin_signer.execute_on_plugin("setSessionCache", [cache_enabled], plugin=session_key_class)
+        # with the cache, the rejected token isn't approved by the first transaction
+        for _ in range(2):
+            await assert_revert(
+                session_plugin_signer.send_transaction(calls, rejected_session),
+                reverted_with="SessionKey: unauthorised session"
+            )
+    await session_plugin_signer.send_transaction(calls, session)
+
+
+@pytest.mark.asyncio
+async def test_compact_session(contracts, tmp_path):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+
+    await stark_plugin_signer.add_plugin(session_key_class)
+    session = build_session(
+        signer=stark_plugin_signer,
+        allowed_calls=[(dapp1.contract_address, 'set_balance'), (dapp2.contract_address, 'set_balance'), (dapp2.contract_address, 'set_balance_double')],
+        session_public_key=session_key.public_key,
+        session_expiration=DEFAULT_TIMESTAMP + 10,
+        chain_id=StarknetChainId.TESTNET.value,
+        account_address=account.contract_address
+    )
+    write_session(str(tmp_path / 'session.bin'), session)
+    with load_session(str(tmp_path / 'session.bin')) as compact_session:
+        await session_plugin_signer.send_transaction([(dapp2.contract_address, 'set_balance', [47])], compact_session)
+        await session_plugin_signer.send_transaction_with_multiproof(
+            [(dapp1.contract_address, 'set_balance', [48]), (dapp2.contract_address, 'set_balance_double', [49])], compact_session
+        )
+    assert (await dapp1.get_balance().call()).result.res == 48
+    assert (await dapp2.get_balance().call()).result.res == 98
+
+
+@pytest.mark.asyncio
+async def test_session_manager(contracts):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+
+    await stark_plugin_signer.add_plugin(session_key_class)
+    state = account.state.state
+    state.block_info = dataclasses.replace(state.block_info, block_timestamp=DEFAULT_TIMESTAMP)
+    manager = SessionManager(
+        signer=stark_plugin_signer,
+        chain_id=StarknetChainId.TESTNET.value,
+        session_duration=100,
+        renewal_margin=10,
+        max_sessions=2,
+        clock=lambda: state.block_info.block_timestamp,
+    )
+    allowed_calls = [(dapp1.contract_address, 'set_balance'), (dapp2.contract_address, 'set_balance')]
+    policy_tree = build_policy_tree(allowed_calls)
+
+    session = await manager.get_session(session_key.public_key, allowed_calls, policy_tree)
+    assert session.session_expiration == DEFAULT_TIMESTAMP + 100
+    assert await manager.get_session(session_key.public_key, allowed_calls, policy_tree) is session
+    await session_plugin_signer.send_transaction([(dapp1.contract_address, 'set_balance', [47])], session)
+
+    # close to its expiration the session is still returned while its replacement is built
+    state.block_info = dataclasses.replace(state.block_info, block_timestamp=DEFAULT_TIMESTAMP + 95)
+    assert await manager.get_session(session_key.public_key, allowed_calls, policy_tree) is session
+    await manager.join()
+    renewed_session = await manager.get_session(session_key.public_key, allowed_calls, policy_tree)
+    assert renewed_session.session_expiration == DEFAULT_TIMESTAMP + 195
+    await session_plugin_signer.send_transaction([(dapp2.contract_address, 'set_balance', [48])], renewed_session)
+
+    # an edited policy or another session key is another session, the least recently used is evicted
+    policy_tree.add(dapp1.contract_address, get_selector_from_name('set_balance_double'))
+    await manager.get_session(session_key.public_key, allowed_calls + [(dapp1.contract_address, 'set_balance_double')], policy_tree)
+    await manager.get_session(wrong_session_key.public_key, allowed_calls + [(dapp1.contract_address, 'set_balance_double')], policy_tree)
+    assert len(manager) == 2
+    assert renewed_session not in manager.sessions.values()
+
+    # the expired sessions are evicted
+    state.block_info = dataclasses.replace(state.block_info, block_timestamp=DEFAULT_TIMESTAMP + 1000)
+    assert (await manager.get_session(session_key.public_key, allowed_calls, policy_tree)).session_expiration == DEFAULT_TIMESTAMP + 1100
+    assert len(manager) == 1
+
+
+@pytest.mark.asyncio
+async def test_session_manager_renewal(contracts, monkeypatch, caplog):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+
+    manager = SessionManager(signer=stark_plugin_signer, chain_id=StarknetChainId.TESTNET.value, session_duration=2, renewal_margin=1)
+    allowed_calls = [(dapp1.contract_address, 'set_balance'), (dapp2.contract_address, 'set_balance')]
+    policy_tree = build_policy_tree(allowed_calls)
+
+    # sessions over other calls of the same tree are other sessions
+    session = await manager.get_session(session_key.public_key, allowed_calls[:1], policy_tree)
+    all_calls_session = await manager.get_session(session_key.public_key, allowed_calls, policy_tree)
+    assert session.allowed_calls == allowed_calls[:1]
+    assert all_calls_session.allowed_calls == allowed_calls
+    assert len(manager) == 2
+
+    # the sessions used since they were built are renewed by a timer, the others are left to expire
+    assert await manager.get_session(session_key.public_key, allowed_calls[:1], policy_tree) is session
+    await asyncio.sleep(1.5)
+    await manager.join()
+    used_key, unused_key = [(account.contract_address, session_key.public_key, policy_tree.root, frozenset(calls)) for calls in [allowed_calls[:1], allowed_calls]]
+    assert manager.renewal_timers.keys() == {used_key}
+    renewed_session = manager.sessions[used_key]
+    assert renewed_session.session_expiration > session.session_expiration
+    assert manager.sessions[unused_key] is all_calls_session
+    assert await manager.get_session(session_key.public_key, allowed_calls[:1], policy_tree) is renewed_session
+
+    # a failed renewal is logged and dropped, the current session is kept
+    def sign(message_hash):
+        raise ValueError("signer unavailable")
+
+    monkeypatch.setattr(stark_plugin_signer, 'sign', sign)
+    key = next(iter(manager.sessions))
+    with caplog.at_level(logging.WARNING, logger='utils.session_manager'):
+        manager.renew(key, renewed_session.allowed_calls, renewed_session.proofs)
+        await manager.join()
+    assert "signer unavailable" in caplog.text
+    assert manager.renewals == {}
+    assert key in manager.sessions
+
+    manager.clear()
+    assert manager.renewal_timers == {}
+
+
+@pytest.mark.asyncio
+async def test_revoke_all_sessions(starknet: Starknet, contracts):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+
+    await stark_plugin_signer.add_plugin(session_key_class)
+    update_starknet_block(starknet=starknet, block_timestamp=DEFAULT_TIMESTAMP)
+    assert (await stark_plugin_signer.read_on_plugin("getSessionEpoch", plugin=session_key_class)).result[0] == [0]
+
+    sessions = [
+        build_session(
+            signer=stark_plugin_signer,
+            allowed_calls=[(dapp1.contract_address, 'set_balance')],
+            session_public_key=key.public_key,
+            session_expiration=DEFAULT_TIMESTAMP + 10,
+            chain_id=StarknetChainId.TESTNET.value,
+            account_address=account.contract_address
+        )
+        for key in [session_key, wrong_session_key]
+    ]
+    calls = [(dapp1.contract_address, 'set_balance', [47])]
+    await session_plugin_signer.send_transaction(calls, sessions[0])
+
+    tx_exec_info = await stark_plugin_signer.execute_on_plugin("revokeAllSessions", plugin=session_key_class)
+    assert_event_emitted(
+        tx_exec_info,
+        from_address=account.contract_address,
+        name='all_sessions_revoked',
+        data=[1]
+    )
+    assert (await stark_plugin_signer.read_on_plugin("getSessionEpoch", plugin=session_key_class)).result[0] == [1]
+
+    # every session built before the revocation is rejected
+    for session in sessions:
+        signer = SessionPluginSigner(
+            stark_key=session_key if session.session_public_key == session_key.public_key else wrong_session_key,
+            account=account,
+            plugin_class_hash=session_key_class
+        )
+        await assert_revert(
+            signer.send_transaction(calls, session),
+            reverted_with="SessionKey: unauthorised session"
+        )
+
+    # a session issued for the new epoch is accepted
+    session = build_session(
+        signer=stark_plugin_signer,
+        allowed_calls=[(dapp1.contract_address, 'set_balance')],
+        session_public_key=session_key.public_key,
+        session_expiration=DEFAULT_TIMESTAMP + 10,
+        chain_id=StarknetChainId.TESTNET.value,
+        account_address=account.contract_address,
+        session_epoch=1
+    )
+    await session_plugin_signer.send_transaction([(dapp1.contract_address, 'set_balance', [48])], session)
+    assert (await dapp1.get_balance().call()).result.res == 48
+
+    # only self can revoke
+    await assert_revert(
+        stark_plugin_signer_2.send_transaction(
+            [(account.contract_address, 'executeOnPlugin', [session_key_class, get_selector_from_name("revokeAllSessions"), 0])]
+        ),
+        reverted_with="SessionKey: only self"
+    )
+
+
+@pytest.mark.asyncio
+async def test_presigned_session_transactions(starknet: Starknet, contracts):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+
+    await stark_plugin_signer.add_plugin(session_key_class)
+    update_starknet_block(starknet=starknet, block_timestamp=DEFAULT_TIMESTAMP)
+
+    session = build_session(
+        signer=stark_plugin_signer,
+        allowed_calls=[(dapp1.contract_address, 'set_balance'), (dapp2.contract_address, 'set_balance')],
+        session_public_key=session_key.public_key,
+        session_expiration=DEFAULT_TIMESTAMP + 10,
+        chain_id=StarknetChainId.TESTNET.value,
+        account_address=account.contract_address
+    )
+    calls_list = [
+        [(dapp1.contract_address, 'set_balance', [1])],
+        [(dapp2.contract_address, 'set_balance', [2]), (dapp1.contract_address, 'set_balance', [3])],
+    ]
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        signed_txs = await session_plugin_signer.get_signed_transactions(calls_list, session, executor=executor)
+    for calls, signed_tx in zip(calls_list, signed_txs):
+        assert signed_tx == await session_plugin_signer.get_signed_transaction(calls, session, signed_tx.nonce)
+        await session_plugin_signer.send_signed_tx(signed_tx)
+    assert (await dapp1.get_balance().call()).result.res == 3
+    assert (await dapp2.get_balance().call()).result.res == 2
+
+
+@pytest.mark.asyncio
+async def test_submission_pipeline(starknet: Starknet, contracts):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+
+    await stark_plugin_signer.add_plugin(session_key_class)
+    update_starknet_block(starknet=starknet, block_timestamp=DEFAULT_TIMESTAMP)
+
+    session = build_session(
+        signer=stark_plugin_signer,
+        allowed_calls=[(dapp1.contract_address, 'set_balance')],
+        session_public_key=session_key.public_key,
+        session_expiration=DEFAULT_TIMESTAMP + 10,
+        chain_id=StarknetChainId.TESTNET.value,
+        account_address=account.contract_address
+    )
+    submissions = [
+        Submission(stark_plugin_signer, [(dapp1.contract_address, 'set_balance', [1])]),
+        Submission(stark_plugin_signer_2, [(dapp2.contract_address, 'set_balance', [10])]),
+        Submission(session_plugin_signer, [(dapp1.contract_address, 'set_balance', [2])], session),
+        # not allowed by the session, fails before a nonce is reserved
+        Submission(session_plugin_signer, [(dapp2.contract_address, 'set_balance', [3])], session),
+        Submission(stark_plugin_signer_2, [(dapp2.contract_address, 'set_balance', [20])]),
+        Submission(session_plugin_signer, [(dapp1.contract_address, 'set_balance', [4])], session),
+    ]
+
+    completions = await SubmissionPipeline(max_in_flight=2).run(submissions)
+    assert sorted(submissions.index(completion.submission) for completion in completions) == list(range(len(submissions)))
+    assert [completion.submission for completion in completions if completion.error is not None] == [submissions[3]]
+    # the transactions of an account are submitted in order with consecutive nonces
+    nonces = [completion.signed_tx.nonce for completion in completions if completion.submission.signer.account == account and completion.error is None]
+    assert nonces == list(range(nonces[0], nonces[0] + 3))
+    assert (await dapp1.get_balance().call()).result.res == 4
+    assert (await dapp2.get_balance().call()).result.res == 20
+
+    # the signers outside the pipeline continue from the nonces it used
+    await stark_plugin_signer.send_transaction([(dapp1.contract_address, 'set_balance', [5])])
+    assert (await dapp1.get_balance().call()).result.res == 5
+
+    # a submission that can't be queued ends the run instead of blocking it
+    with pytest.raises(AttributeError):
+        await asyncio.wait_for(SubmissionPipeline().run([submissions[0], Submission(None, [])]), timeout=60)
+
+
+@pytest.mark.asyncio
+async def test_submission_pipeline_rejection(contracts):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+    nonce_manager = stark_plugin_signer.nonce_manager
+    nonce = await stark_plugin_signer.get_nonce()
+    generation = nonce_manager.generation
+    submitter = StateSubmitter()
+    all_built = asyncio.Event()
+
+    # the transactions are submitted once the whole lane is built
+    async def submit(signer, signed_tx):
+        await all_built.wait()
+        return await submitter(signer, signed_tx)
+
+    pipeline = SubmissionPipeline(submit=submit)
+    submissions = [
+        Submission(stark_plugin_signer, [(dapp1.contract_address, 'set_balance', [value])])
+        # set_balance(-1) is rejected
+        for value in [1, DEFAULT_PRIME - 1, 3, 4]
+    ]
+    for submission in submissions:
+        await pipeline.put(submission)
+    while nonce_manager.next_nonce != nonce + len(submissions):
+        await asyncio.sleep(0)
+    all_built.set()
+    await pipeline.close()
+    completions = {submissions.index(completion.submission): completion async for completion in pipeline.completions()}
+
+    # the transactions built after the rejected one aren't submitted with their stale nonces
+    assert completions[0].error is None
+    assert isinstance(completions[1].error, StarkException)
+    assert all(isinstance(completions[index].error, StaleNonceError) for index in [2, 3])
+    assert nonce_manager.generation == generation + 1
+    assert await stark_plugin_signer.get_nonce() == nonce + 1
+    assert (await dapp1.get_balance().call()).result.res == 1
+
+    # the next transactions get their nonces from the state
+    completions = await SubmissionPipeline().run([Submission(stark_plugin_signer, [(dapp1.contract_address, 'set_balance', [5])])])
+    assert completions[0].error is None and completions[0].signed_tx.nonce == nonce + 1
+    await stark_plugin_signer.send_transaction([(dapp1.contract_address, 'set_balance', [6])])
+    assert (await dapp1.get_balance().call()).result.res == 6
+
+
+@pytest.mark.asyncio
+async def test_submission_pipeline_gateway(contracts):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+    runner, url = await start_gateway(account.state)
+    try:
+        session = build_session(
+            signer=stark_plugin_signer,
+            allowed_calls=[(dapp1.contract_address, 'set_balance')],
+            session_public_key=session_key.public_key,
+            session_expiration=DEFAULT_TIMESTAMP + 10,
+            chain_id=StarknetChainId.TESTNET.value,
+            account_address=account.contract_address
+        )
+        pipeline = SubmissionPipeline(submit=GatewaySubmitter(url), max_in_flight=2)
+        completions = await pipeline.run([
+            Submission(stark_plugin_signer, [(dapp1.contract_address, 'set_balance', [1])]),
+            Submission(stark_plugin_signer_2, [(dapp2.contract_address, 'set_balance', [2])]),
+            # the session plugin isn't added to the account
+            Submission(session_plugin_signer, [(dapp1.contract_address, 'set_balance', [3])], session),
+        ])
+    finally:
+        await runner.cleanup()
+
+    results = {completion.submission.calls[0][2][0]: completion for completion in completions}
+    assert results[1].result['code'] == 'TRANSACTION_RECEIVED'
+    assert results[2].result['code'] == 'TRANSACTION_RECEIVED'
+    assert isinstance(results[3].error, StarkException)
+    assert (await dapp1.get_balance().call()).result.res == 1
+    assert (await dapp2.get_balance().call()).result.res == 2
+
+
+@pytest.mark.asyncio
+async def test_resource_records(starknet: Starknet, contracts, tmp_path):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+
+    await stark_plugin_signer.add_plugin(session_key_class)
+    update_starknet_block(starknet=starknet, block_timestamp=DEFAULT_TIMESTAMP)
+
+    session = build_session(
+        signer=stark_plugin_signer,
+        allowed_calls=[(dapp1.contract_address, 'set_balance'), (dapp2.contract_address, 'set_balance')],
+        session_public_key=session_key.public_key,
+        session_expiration=DEFAULT_TIMESTAMP + 10,
+        chain_id=StarknetChainId.TESTNET.value,
+        account_address=account.contract_address
+    )
+    recorder = ResourceRecorder()
+    stark_plugin_signer.resource_recorder = recorder
+    session_plugin_signer.resource_recorder = recorder
+    calls = [(dapp1.contract_address, 'set_balance', [1]), (dapp2.contract_address, 'set_balance', [2])]
+    with recorder.labelled('stark_signer'):
+        await stark_plugin_signer.send_transaction(calls)
+    with recorder.labelled('session_key'):
+        await session_plugin_signer.send_transaction(calls, session)
+
+    stark_record, session_record = recorder.records
+    assert [stark_record.label, session_record.label] == ['stark_signer', 'session_key']
+    assert [stark_record.n_calls, session_record.n_calls] == [2, 2]
+    assert stark_record.plugin_class_hash == stark_plugin_signer.plugin_class_hash
+    assert session_record.plugin_class_hash == session_key_class
+    # the session key signature and the session token are both verified
+    assert stark_record.validate.ecdsa == 1
+    assert session_record.validate.ecdsa == 2
+    assert session_record.validate.n_steps > stark_record.validate.n_steps
+    assert session_record.execute == stark_record.execute
+    assert stark_record.l1_gas_usage > 0
+
+    path = tmp_path / 'resources.jsonl'
+    write_resource_records(str(path), recorder.records)
+    assert read_resource_records(str(path)) == recorder.records
+
+
+@pytest.mark.asyncio
+async def test_preflight_matches_contract(contracts):
+    account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
+    sts_plugin_class = stark_plugin_signer.plugin_class_hash
+
+    await stark_plugin_signer.add_plugin(session_key_class)
+    account.state.state.block_info = dataclasses.replace(account.state.state.block_info, block_timestamp=DEFAULT_TIMESTAMP)
+
+    allowed_calls = [(dapp1.contract_address, 'set_balance'), (dapp1.contract_address, 'set_balance_double'), (dapp2.contract_address, 'set_balance')]
+
+    def get_session(signer=stark_plugin_signer, session_expiration=DEFAULT_TIMESTAMP + 10):
+        return build_session(
+            signer=signer,
+            allowed_calls=allowed_calls,
+            session_public_key=session_key.public_key,
+            session_expiration=session_expiration,
+            chain_id=StarknetChainId.TESTNET.value,
+            account_address=account.contract_address
+        )
+
+    def replace_signature(signed_tx, index, value):
+        signature = list(signed_tx.signature)
+        signature[index] = value
+        return dataclasses.replace(signed_tx, signature=signature)
+
+    session = get_session()
+    wrong_key_signer = SessionPluginSigner(stark_key=wrong_session_key, account=account, plugin_class_hash=session_key_class)
+    calls = [(dapp1.contract_address, 'set_balance', [47])]
+    multiproof_calls = [(dapp1.contract_address, 'set_balance', [48]), (dapp2.contract_address, 'set_balance', [49])]
+
+    async def check(signed_tx, expected_error):
+        view = await SessionKeyView.load(account.state, account.contract_address, [session_key_class, sts_plugin_class], [sts_plugin_class], [session])
+        assert verify_session_transaction(view, signed_tx) == expected_error
+        if expected_error is None:
+            await session_plugin_signer.send_signed_tx(signed_tx)
+        else:
+            # the malformed calldata fails without an error message
+            await assert_revert(session_plugin_signer.send_signed_tx(signed_tx), reverted_with=None if expected_error == INVALID_CALLDATA else expected_error)
+
+    await check(await session_plugin_signer.get_signed_transaction(calls, session), None)
+    await check(await session_plugin_signer.get_signed_transaction_with_multiproof(multiproof_calls, session), None)
+    await check(await session_plugin_signer.get_signed_transaction(calls, get_session(session_expiration=DEFAULT_TIMESTAMP - 1)), "SessionKey: session expired")
+    await check(await session_plugin_signer.get_signed_transaction(calls, get_session(signer=stark_plugin_signer_2)), "SessionKey: unauthorised session")
+    await check(await wrong_key_signer.get_signed_transaction(calls, session), "SessionKey: invalid signature")
+    await check(
+        await session_plugin_signer.get_signed_transaction_with_proofs([(dapp2.contract_address, 'set_balance', [1])], session, [session.proofs[0]]),
+        "SessionKey: not allowed by policy"
+    )
+
+    signed_tx = await session_plugin_signer.get_signed_transaction(calls, session)
+    await check(replace_signature(signed_tx, 6, signed_tx.signature[6] + 1), "SessionKey: invalid proof len")
+    await check(dataclasses.replace(signed_tx, signature=[*signed_tx.signature, 1]), "SessionKey: invalid signature length")
+    await check(replace_signature(signed_tx, 0, stark_plugin_signer_2.plugin_class_hash + 1), "PluginAccount: unregistered plugin")
+    await check(dataclasses.replace(signed_tx, calldata=signed_tx.calldata[:-1]), INVALID_CALLDATA)
+
+    # the query version is accepted, the session key signs the hash of the transaction with its version
+    query_tx = dataclasses.replace(signed_tx, version=QUERY_VERSION)
+    view = await SessionKeyView.load(account.state, account.contract_address, [session_key_class, sts_plugin_class], [sts_plugin_class], [session])
+    query_tx = replace_signature(query_tx, slice(1, 3), session_key.sign(get_transaction_hash(view, query_tx)))
+    assert verify_session_transaction(view, query_tx) is None
+    # the testing state only runs the query transactions through the simulate API
+    await fork_state(account.state).execute_tx(
+        InternalInvokeFunctionForSimulate.from_external(external_tx=query_tx, general_config=account.state.general_config)
+    )
+    assert verify_session_transaction(view, signed_tx) is None
+    await assert_revert(
+        fork_state(account.state).execute_tx(
+            InternalInvokeFunctionForSimulate.from_external(external_tx=dataclasses.replace(signed_tx, version=QUERY_VERSION), general_config=account.state.general_config)
+        ),
+        reverted_with="SessionKey: invalid signature"
+    )
+    assert verify_session_transaction(view, dataclasses.replace(signed_tx, version=QUERY_VERSION)) == "SessionKey: invalid signature"
+
+    signed_tx = await session_plugin_signer.get_signed_transaction_with_multiproof(multiproof_calls, session)
+    # the first call points to the leaf of the second call
+    first_call_leaf = 8 + 1 + signed_tx.signature[8]
+    await check(replace_signature(signed_tx, first_call_leaf, 1 - signed_tx.signature[first_call_leaf]), "SessionKey: not allowed by policy")
+    await check(replace_signature(signed_tx, 8, signed_tx.signature[8] + 1), "SessionKey: invalid multiproof")
+
+    # a batch checks the session token once, the revocation is only seen by a view loaded after it
+    signed_txs = await session_plugin_signer.get_signed_transactions([calls] * 3, session)
+    view = await SessionKeyView.load(account.state, account.contract_address, [session_key_class, sts_plugin_class], [sts_plugin_class], [session])
+    signed_txs[1] = replace_signature(signed_txs[1], 1, signed_txs[1].signature[1] + 1)
+    assert verify_session_transactions(view, signed_txs) == [None, "SessionKey: invalid signature", None]
+    # the batch is only verified, its nonces are released
+    session_plugin_signer.nonce_manager.invalidate()
+
+    await stark_plugin_signer.execute_on_plugin("revokeSessionKey", [session_key.public_key], plugin=session_key_class)
+    await check(await session_plugin_signer.get_signed_transaction(calls, session), "SessionKey: session key revoked")
+
+
 @pytest.mark.asyncio
 async def test_supportsInterface(contracts):
     account, stark_plugin_signer, stark_plugin_signer_2, session_plugin_signer, dapp1, dapp2, session_key_class = contracts
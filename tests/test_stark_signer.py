@@ -1,9 +1,18 @@
 import pytest
 import asyncio
+import dataclasses
+import json
+from concurrent.futures import ProcessPoolExecutor
 from starkware.starknet.testing.starknet import Starknet
-from utils.utils import str_to_felt, build_contract, compile
+from starkware.starkware_utils.error_handling import StarkException
+from starkware.starknet.definitions.general_config import StarknetChainId
+from starkware.starknet.core.os.transaction_hash.transaction_hash import calculate_transaction_hash_common, TransactionHashPrefix
+from utils.utils import str_to_felt, build_contract, compile_many, copy_contract_state, fork_state, from_call_to_call_array, get_execute_calldata
 from utils.utils import StarkKeyPair, ERC165_INTERFACE_ID, ERC165_ACCOUNT_INTERFACE_ID, assert_event_emitted, assert_revert
 from utils.plugin_signer import StarkPluginSigner
+from utils.state_snapshot import load_state_snapshot, deployed_contract
+from utils.timing import HistogramCollector
+from utils.fast_signature import verify_fast
 
 key_pair = StarkKeyPair(1234)
 new_key_pair = StarkKeyPair(5678)
@@ -15,14 +24,16 @@ def event_loop():
 
 
 @pytest.fixture(scope='module')
-async def starknet():
-    return await Starknet.empty()
+def contract_classes():
+    return compile_many([
+        'contracts/account/PluginAccount.cairo',
+        'contracts/plugins/signer/StarkSigner.cairo',
+        'contracts/test/Dapp.cairo',
+    ])
 
 
-@pytest.fixture(scope='module')
-async def account_setup(starknet: Starknet):
-    account_cls = compile('contracts/account/PluginAccount.cairo')
-    sts_plugin_cls = compile("contracts/plugins/signer/StarkSigner.cairo")
+async def setup_network(starknet: Starknet, contract_classes):
+    account_cls, sts_plugin_cls, dapp_cls = contract_classes
 
     sts_plugin_decl = await starknet.declare(contract_class=sts_plugin_cls)
 
@@ -33,22 +44,29 @@ async def account_setup(starknet: Starknet):
 
     await account.initialize(sts_plugin_decl.class_hash, [key_pair.public_key]).execute()
 
-    return account, sts_plugin_decl.class_hash
+    await starknet.declare(contract_class=dapp_cls)
+    dapp = await starknet.deploy(contract_class=dapp_cls, constructor_calldata=[])
+
+    return {
+        'account': account.contract_address,
+        'dapp': dapp.contract_address,
+        'sts_plugin_class_hash': sts_plugin_decl.class_hash,
+    }
 
 
 @pytest.fixture(scope='module')
-async def dapp(starknet: Starknet):
-    dapp_cls = compile('contracts/test/Dapp.cairo')
-    await starknet.declare(contract_class=dapp_cls)
-    return await starknet.deploy(contract_class=dapp_cls, constructor_calldata=[])
+async def snapshot(contract_classes):
+    return await load_state_snapshot('test_stark_signer', contract_classes, setup_network)
 
 
 @pytest.fixture
-def contracts(starknet: Starknet, account_setup, dapp):
-    account, sts_plugin_class_hash = account_setup
-    clean_state = starknet.state.copy()
+def contracts(snapshot, contract_classes):
+    starknet, values = snapshot
+    account_cls, _, dapp_cls = contract_classes
+    sts_plugin_class_hash = values['sts_plugin_class_hash']
+    clean_state = fork_state(starknet.state)
 
-    account = build_contract(account, state=clean_state)
+    account = deployed_contract(clean_state, account_cls, values['account'])
 
     stark_plugin_signer = StarkPluginSigner(
         stark_key=key_pair,
@@ -56,7 +74,7 @@ def contracts(starknet: Starknet, account_setup, dapp):
         plugin_class_hash=sts_plugin_class_hash
     )
 
-    dapp = build_contract(dapp, state=clean_state)
+    dapp = deployed_contract(clean_state, dapp_cls, values['dapp'])
 
     return account, stark_plugin_signer, sts_plugin_class_hash, dapp
 
@@ -141,3 +159,161 @@ async def test_dapp_long_signature(contracts):
         stark_plugin_signer.send_signed_tx(signed_tx)
     )
     assert (await dapp.get_balance().call()).result.res == 0
+
+
+@pytest.mark.asyncio
+async def test_execute_calldata(contracts):
+    account, stark_plugin_signer, sts_plugin_hash, dapp = contracts
+    calls = [
+        (dapp.contract_address, 'set_balance', [47]),
+        (dapp.contract_address, 'set_balance_double', []),
+        (account.contract_address, 'getVersion', [1, 2, 3]),
+    ]
+
+    # the calldata is encoded like the __execute__ invocation built on a fork of the state
+    raw_invocation = copy_contract_state(account, fork=True).__execute__(*from_call_to_call_array(calls))
+    assert get_execute_calldata(calls) == raw_invocation.calldata
+
+    signed_tx = await stark_plugin_signer.get_signed_transaction(calls)
+    assert signed_tx.calldata == raw_invocation.calldata
+    assert signed_tx.nonce == await account.state.state.get_nonce_at(contract_address=account.contract_address)
+
+
+@pytest.mark.asyncio
+async def test_presigned_transactions(contracts):
+    account, stark_plugin_signer, sts_plugin_hash, dapp = contracts
+    nonce = await stark_plugin_signer.get_nonce()
+
+    signed_txs = await stark_plugin_signer.get_signed_transactions([
+        [(dapp.contract_address, 'set_balance', [value])] for value in [1, 2, 3]
+    ])
+    assert [signed_tx.nonce for signed_tx in signed_txs] == [nonce, nonce + 1, nonce + 2]
+    assert await stark_plugin_signer.nonce_manager.next() == nonce + 3
+
+    for signed_tx in signed_txs:
+        await stark_plugin_signer.send_signed_tx(signed_tx)
+    assert (await dapp.get_balance().call()).result.res == 3
+
+    # nonce + 3 was handed out but never used, the rejected transaction resyncs the manager
+    signed_tx = (await stark_plugin_signer.get_signed_transactions([[(dapp.contract_address, 'set_balance', [4])]]))[0]
+    assert signed_tx.nonce == nonce + 4
+    with pytest.raises(StarkException):
+        await stark_plugin_signer.send_signed_tx(signed_tx)
+    assert await stark_plugin_signer.nonce_manager.next() == nonce + 3
+
+
+@pytest.mark.asyncio
+async def test_presigned_transactions_mixed_with_send_transaction(contracts):
+    account, stark_plugin_signer, sts_plugin_hash, dapp = contracts
+    other_signer = StarkPluginSigner(stark_key=key_pair, account=account, plugin_class_hash=sts_plugin_hash)
+    # the signers of an account share its nonces
+    assert other_signer.nonce_manager is stark_plugin_signer.nonce_manager
+    nonce = await stark_plugin_signer.get_nonce()
+
+    signed_txs = await stark_plugin_signer.get_signed_transactions([
+        [(dapp.contract_address, 'set_balance', [value])] for value in [1, 2]
+    ])
+    # signed after the burst, without reading the state
+    signed_tx = await other_signer.get_signed_transaction([(dapp.contract_address, 'set_balance', [3])])
+    assert [tx.nonce for tx in [*signed_txs, signed_tx]] == [nonce, nonce + 1, nonce + 2]
+
+    for tx in [*signed_txs, signed_tx]:
+        await stark_plugin_signer.send_signed_tx(tx)
+    await other_signer.send_transaction([(dapp.contract_address, 'set_balance', [4])])
+    await stark_plugin_signer.send_transaction([(dapp.contract_address, 'set_balance', [5])])
+    assert (await dapp.get_balance().call()).result.res == 5
+    assert await stark_plugin_signer.get_nonce() == nonce + 5
+
+
+@pytest.mark.asyncio
+async def test_send_signed_txs(contracts):
+    account, stark_plugin_signer, sts_plugin_hash, dapp = contracts
+    nonce = await stark_plugin_signer.get_nonce()
+    signed_txs = await stark_plugin_signer.get_signed_transactions([
+        [(dapp.contract_address, 'set_balance', [value])] for value in [1, 2, 3, 4]
+    ])
+    signed_txs[2] = dataclasses.replace(signed_txs[2], signature=[sts_plugin_hash, 1, 2])
+
+    results = await stark_plugin_signer.send_signed_txs(signed_txs)
+    assert [isinstance(result, StarkException) for result in results] == [False, False, True, True]
+    assert_event_emitted(results[1], from_address=account.contract_address, name='transaction_executed', data=[])
+    assert (await dapp.get_balance().call()).result.res == 2
+    # the rejected transactions resync the nonce manager
+    assert await stark_plugin_signer.nonce_manager.next() == nonce + 2
+
+
+@pytest.mark.asyncio
+async def test_transaction_hash(contracts):
+    account, stark_plugin_signer, _, dapp = contracts
+    for calldata, nonce, max_fee in [([], 0, 0), ([1, 2, 3], 1, 10**15), (get_execute_calldata([(dapp.contract_address, 'set_balance', [47])]), 2**64, 1)]:
+        assert stark_plugin_signer.get_transaction_hash(calldata, nonce, max_fee) == calculate_transaction_hash_common(
+            tx_hash_prefix=TransactionHashPrefix.INVOKE,
+            version=1,
+            contract_address=account.contract_address,
+            entry_point_selector=0,
+            calldata=calldata,
+            max_fee=max_fee,
+            chain_id=StarknetChainId.TESTNET.value,
+            additional_data=[nonce],
+        )
+    signed_tx = await stark_plugin_signer.get_signed_transaction([(dapp.contract_address, 'set_balance', [47])])
+    transaction_hash = signed_tx.calculate_hash(account.state.general_config)
+    assert stark_plugin_signer.get_transaction_hash(signed_tx.calldata, signed_tx.nonce, signed_tx.max_fee) == transaction_hash
+
+
+@pytest.mark.asyncio
+async def test_timing_hooks(contracts, tmp_path):
+    _, stark_plugin_signer, _, dapp = contracts
+    collector = HistogramCollector()
+    stark_plugin_signer.timing_hooks = collector
+
+    for value in range(3):
+        signed_tx = await stark_plugin_signer.get_signed_transaction([(dapp.contract_address, 'set_balance', [value])])
+        await stark_plugin_signer.send_signed_tx(signed_tx)
+
+    summary = collector.summary()
+    assert {name: stage_summary['count'] for name, stage_summary in summary.items()} == {
+        'calldata': 3, 'nonce': 3, 'hash': 3, 'sign': 3, 'execute': 3
+    }
+    assert all(0 <= stage_summary['p50'] <= stage_summary['p99'] <= stage_summary['max'] for stage_summary in summary.values())
+
+    collector.dump(tmp_path / 'timing.json')
+    assert json.loads((tmp_path / 'timing.json').read_text()) == summary
+
+
+def test_accelerated_sign():
+    accelerated_key_pair = StarkKeyPair(key_pair.private_key, accelerated=True)
+    assert accelerated_key_pair.public_key == key_pair.public_key
+    for message_hash in [1, 0x1234, 2**250 + 0x5678, 2**251 - 1]:
+        assert accelerated_key_pair.sign(message_hash) == key_pair.sign(message_hash)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert accelerated_key_pair.sign_many([1, 2, 3], executor) == key_pair.sign_many([1, 2, 3])
+
+
+def test_verify_fast():
+    r, s = key_pair.sign(0x1234)
+    assert verify_fast(0x1234, r, s, key_pair.public_key)
+    assert not verify_fast(0x1235, r, s, key_pair.public_key)
+    assert not verify_fast(0x1234, r, s, new_key_pair.public_key)
+    assert not verify_fast(0x1234, 0, s, key_pair.public_key)
+
+
+def test_sign_many():
+    message_hashes = [0x1234 + i for i in range(10)]
+    serial_signatures = key_pair.sign_many(message_hashes)
+    assert serial_signatures == [key_pair.sign(message_hash) for message_hash in message_hashes]
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert key_pair.sign_many(message_hashes, executor, chunksize=3) == serial_signatures
+
+
+@pytest.mark.asyncio
+async def test_presigned_transactions_in_process_pool(contracts):
+    account, stark_plugin_signer, sts_plugin_hash, dapp = contracts
+    calls_list = [[(dapp.contract_address, 'set_balance', [value])] for value in [1, 2, 3]]
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        signed_txs = await stark_plugin_signer.get_signed_transactions(calls_list, executor=executor)
+    for calls, signed_tx in zip(calls_list, signed_txs):
+        assert signed_tx == await stark_plugin_signer.get_signed_transaction(calls, signed_tx.nonce)
+        await stark_plugin_signer.send_signed_tx(signed_tx)
+    assert (await dapp.get_balance().call()).result.res == 3
@@ -0,0 +1,225 @@
+import gc
+import os
+import sys
+import weakref
+import shutil
+import importlib.util
+import pytest
+import utils.utils
+import utils.state_snapshot
+from starkware.starknet.testing.starknet import Starknet
+from starkware.starknet.compiler.compile import get_selector_from_name
+from utils.utils import compile, compile_many, get_cairo_dependencies, build_contract, fork_state
+from utils.nonce_manager import get_nonce_manager, nonce_managers
+from utils.state_snapshot import load_state_snapshot, deployed_contract, get_state_snapshot_path, store_state_snapshot
+from utils.resources import PhaseResources, ResourceRecord, compare_resource_records
+from utils.timing import get_percentile
+from utils.session_keys_utils import Session, generate_policy_tree
+from utils.compact_session import CompactSession, dump_session, load_session, write_session
+
+
+@pytest.fixture
+def compile_cache(tmp_path, monkeypatch):
+    cache_dir = tmp_path / 'cache'
+    monkeypatch.setattr(utils.utils, 'COMPILE_CACHE_DIR', str(cache_dir))
+    return cache_dir
+
+
+def test_get_cairo_dependencies():
+    assert get_cairo_dependencies('contracts/plugins/SessionKey.cairo') == [
+        'contracts/account/IPluginAccount.cairo',
+        'contracts/plugins/SessionKey.cairo',
+    ]
+
+
+def test_compile_cache(tmp_path, compile_cache, monkeypatch):
+    source = tmp_path / 'Dapp.cairo'
+    shutil.copy('contracts/test/Dapp.cairo', source)
+
+    contract_cls = compile(str(source))
+    assert len(os.listdir(compile_cache)) == 1
+
+    # warm runs don't compile
+    def fail_compile(*args, **kwargs):
+        assert False, "compiled a cached contract"
+    monkeypatch.setattr(utils.utils, 'compile_starknet_files', fail_compile)
+    assert compile(str(source)) == contract_cls
+
+    # a changed source is compiled again and replaces the stale entry
+    monkeypatch.undo()
+    monkeypatch.setattr(utils.utils, 'COMPILE_CACHE_DIR', str(compile_cache))
+    with open(source, 'a') as cairo_file:
+        cairo_file.write('\n// changed\n')
+    stale_entries = os.listdir(compile_cache)
+    assert compile(str(source)) == contract_cls
+    entries = os.listdir(compile_cache)
+    assert len(entries) == 1 and entries != stale_entries
+
+
+def test_compile_many(tmp_path, compile_cache):
+    paths = []
+    for name in ['Dapp', 'FakeAccount']:
+        source = tmp_path / f'{name}.cairo'
+        shutil.copy(f'contracts/test/{name}.cairo', source)
+        paths.append(str(source))
+
+    contract_classes = compile_many([paths[1], paths[0], paths[1]], max_workers=2)
+    assert len(os.listdir(compile_cache)) == 2
+    assert contract_classes == [compile(paths[1]), compile(paths[0]), compile(paths[1])]
+
+
+@pytest.mark.asyncio
+async def test_state_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.state_snapshot, 'STATE_SNAPSHOT_DIR', str(tmp_path))
+    dapp_cls = compile('contracts/test/Dapp.cairo')
+    setups = []
+
+    async def setup(starknet, contract_classes):
+        setups.append(starknet)
+        await starknet.declare(contract_class=contract_classes[0])
+        dapp = await starknet.deploy(contract_class=contract_classes[0], constructor_calldata=[])
+        await dapp.set_balance(47).execute()
+        return {'dapp': dapp.contract_address}
+
+    _, values = await load_state_snapshot('dapp', [dapp_cls], setup)
+    assert len(os.listdir(tmp_path)) == 1
+
+    # warm runs load the state without running the setup
+    starknet, loaded_values = await load_state_snapshot('dapp', [dapp_cls], setup)
+    assert len(setups) == 1
+    assert loaded_values == values
+    dapp = deployed_contract(starknet.state, dapp_cls, values['dapp'])
+    assert (await dapp.get_balance().call()).result.res == 47
+
+
+def test_state_snapshot_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.state_snapshot, 'LOCAL_SOURCE_DIR', str(tmp_path))
+    monkeypatch.setattr(utils.state_snapshot, 'STATE_SNAPSHOT_DIR', str(tmp_path / 'snapshots'))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    dapp_cls = compile('contracts/test/Dapp.cairo')
+    setup_module = tmp_path / 'setup_module.py'
+    helpers_module = tmp_path / 'setup_helpers.py'
+
+    def load_setup(balance, helper_balance=1):
+        helpers_module.write_text(f"helper_balance = {helper_balance}\n")
+        setup_module.write_text(
+            "from setup_helpers import helper_balance\n\n"
+            f"balance = {balance}\n\n"
+            "async def setup(starknet, contract_classes):\n"
+            "    return {'balance': balance + helper_balance}\n"
+        )
+        spec = importlib.util.spec_from_file_location('setup_module', setup_module)
+        module = importlib.util.module_from_spec(spec)
+        monkeypatch.setitem(sys.modules, 'setup_module', module)
+        spec.loader.exec_module(module)
+        return module.setup
+
+    # the constants read by setup and the local modules it imports are part of the key, not only its code
+    snapshot_path = get_state_snapshot_path('dapp', [dapp_cls], load_setup(47))
+    assert get_state_snapshot_path('dapp', [dapp_cls], load_setup(47)) == snapshot_path
+    assert get_state_snapshot_path('dapp', [dapp_cls], load_setup(4747)) != snapshot_path
+    assert get_state_snapshot_path('dapp', [dapp_cls], load_setup(47, helper_balance=1111)) != snapshot_path
+
+    # a new snapshot only evicts the older ones of the same name
+    other_path = get_state_snapshot_path('dapp-other', [dapp_cls], load_setup(47))
+    store_state_snapshot('dapp-other', other_path, None, {})
+    store_state_snapshot('dapp', snapshot_path, None, {})
+    store_state_snapshot('dapp', get_state_snapshot_path('dapp', [dapp_cls], load_setup(4747)), None, {})
+    assert sorted(os.listdir(tmp_path / 'snapshots')) == sorted([
+        os.path.basename(other_path), os.path.basename(get_state_snapshot_path('dapp', [dapp_cls], load_setup(4747)))
+    ])
+
+
+@pytest.mark.asyncio
+async def test_fork_state():
+    dapp_cls = compile('contracts/test/Dapp.cairo')
+    starknet = await Starknet.empty()
+    dapp = await starknet.deploy(contract_class=dapp_cls, constructor_calldata=[])
+    await dapp.set_balance(47).execute()
+
+    fork = fork_state(starknet.state)
+    forked_dapp = build_contract(dapp, state=fork)
+    assert (await forked_dapp.get_balance().call()).result.res == 47
+
+    # the writes and declares on the fork don't reach the parent or the other forks
+    await forked_dapp.set_balance(48).execute()
+    declared_class = await Starknet(state=fork).declare(contract_class=compile('contracts/test/FakeAccount.cairo'))
+    assert (await forked_dapp.get_balance().call()).result.res == 48
+    assert (await dapp.get_balance().call()).result.res == 47
+    assert (await build_contract(dapp, state=fork_state(starknet.state)).get_balance().call()).result.res == 47
+    assert declared_class.class_hash.to_bytes(32, 'big') not in starknet.state.state.contract_classes
+
+
+@pytest.mark.asyncio
+async def test_nonce_manager_fork_collected():
+    dapp_cls = compile('contracts/test/Dapp.cairo')
+    starknet = await Starknet.empty()
+    dapp = await starknet.deploy(contract_class=dapp_cls, constructor_calldata=[])
+
+    gc.collect()
+    managed_states = len(nonce_managers)
+    fork = fork_state(starknet.state)
+    nonce_manager = get_nonce_manager(build_contract(dapp, state=fork))
+    assert get_nonce_manager(build_contract(dapp, state=fork)) is nonce_manager
+    assert await nonce_manager.next() == 0
+
+    # the manager of a fork doesn't keep it alive
+    fork_ref = weakref.ref(fork)
+    del fork, nonce_manager
+    gc.collect()
+    assert fork_ref() is None
+    assert len(nonce_managers) == managed_states
+
+
+def test_compare_resource_records():
+    def resource_record(label, validate_steps, signature_len=3):
+        return ResourceRecord(
+            label=label, plugin_class_hash=1, n_calls=1, signature_len=signature_len,
+            validate=PhaseResources(n_steps=validate_steps, pedersen=1), execute=PhaseResources(n_steps=100),
+            n_steps=1000, l1_gas_usage=10, actual_fee=0
+        )
+
+    baseline = [resource_record('a', 100), resource_record('b', 100)]
+    assert compare_resource_records(baseline, [resource_record('a', 105), resource_record('c', 500)]) == []
+    assert compare_resource_records(baseline, [resource_record('a', 90, signature_len=4), resource_record('b', 110)]) == [
+        'a: signature_len 3 -> 4',
+        'b: validate.n_steps 100 -> 110',
+    ]
+
+
+def test_get_percentile():
+    samples = [float(value) for value in range(1, 101)]
+    assert [get_percentile(samples, percentile) for percentile in [50, 95, 99, 100]] == [50, 95, 99, 100]
+    assert get_percentile([3.0], 99) == 3.0
+
+
+def test_compact_session(tmp_path):
+    allowed_calls = [(contract, selector) for contract in [3, 1, 2] for selector in ['set_balance', 'get_balance', 'transfer']]
+    root, proofs = generate_policy_tree(allowed_calls)
+    session = Session(
+        session_public_key=11, session_expiration=12, root=root, allowed_calls=allowed_calls, proofs=proofs,
+        session_hash=13, account_address=14, session_token=[15, 16, 2**251 + 17], session_epoch=18
+    )
+
+    path = str(tmp_path / 'session.bin')
+    write_session(path, session)
+    for compact_session in [CompactSession(dump_session(session)), load_session(path)]:
+        with compact_session:
+            assert len(compact_session) == len(allowed_calls)
+            assert compact_session.single_proof_len() == session.single_proof_len()
+            assert [compact_session.session_public_key, compact_session.session_expiration, compact_session.root] == [11, 12, root]
+            assert [compact_session.session_hash, compact_session.account_address, compact_session.session_epoch] == [13, 14, 18]
+            assert compact_session.session_token == session.session_token
+            for contract, selector in allowed_calls:
+                assert compact_session.get_proof(contract, selector) == session.get_proof(contract, selector)
+            for contract, selector in [(4, 'set_balance'), (1, 'missing')]:
+                with pytest.raises(ValueError):
+                    compact_session.get_proof(contract, selector)
+            # the allowed calls hold the selectors, sorted like the call table
+            assert compact_session.allowed_calls == sorted((contract, get_selector_from_name(selector)) for contract, selector in allowed_calls)
+            for contract, selector in allowed_calls:
+                assert compact_session.get_proof(contract, get_selector_from_name(selector)) == session.get_proof(contract, selector)
+            assert dump_session(compact_session) == dump_session(session)
+        with pytest.raises(ValueError):
+            compact_session.read_felts(0, 1)
+    assert os.path.getsize(path) == 16 + 32 * (6 + 3) + len(allowed_calls) * 32 * (2 + session.single_proof_len())
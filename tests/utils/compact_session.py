@@ -0,0 +1,126 @@
+import mmap
+import struct
+from functools import cached_property, lru_cache
+from typing import List, Optional, Tuple, Union
+from starkware.starknet.compiler.compile import get_selector_from_name
+from utils.session_keys_utils import Session
+
+# Binary session layout, every felt is 32 bytes big-endian:
+#   header      magic, calls count, proof length and session token length
+#   fields      session_public_key, session_expiration, root, session_hash, account_address, session_epoch
+#   token       session token
+#   call table  (contract, selector) of each allowed call, sorted so a call is found by binary search
+#   proof table one row of proof length felts per call, in the order of the call table
+# The rows have a fixed width, the offset of a proof is computed from the index of its call
+MAGIC = b'SKS1'
+HEADER = struct.Struct('>4sIII')
+FELT_SIZE = 32
+CALL_SIZE = 2 * FELT_SIZE
+FIELDS = ['session_public_key', 'session_expiration', 'root', 'session_hash', 'account_address', 'session_epoch']
+
+get_selector_from_name_cached = lru_cache(maxsize=None)(get_selector_from_name)
+
+
+# the allowed calls of a CompactSession hold the selectors, not their names
+def get_selector(selector: Union[str, int]) -> int:
+    return selector if isinstance(selector, int) else get_selector_from_name_cached(selector)
+
+
+def dump_session(session: Session) -> bytes:
+    proof_len = session.single_proof_len()
+    calls = {}
+    for contract, selector in session.allowed_calls:
+        calls.setdefault((contract, get_selector(selector)), session.get_proof(contract, selector))
+    ordered_calls = sorted(calls)
+
+    data = bytearray(HEADER.pack(MAGIC, len(ordered_calls), proof_len, len(session.session_token)))
+    for value in [*[getattr(session, name) for name in FIELDS], *session.session_token]:
+        data += value.to_bytes(FELT_SIZE, 'big')
+    for contract, selector in ordered_calls:
+        data += contract.to_bytes(FELT_SIZE, 'big') + selector.to_bytes(FELT_SIZE, 'big')
+    for call in ordered_calls:
+        proof = calls[call]
+        assert len(proof) == proof_len, "All the proofs of a session must have the same length"
+        for value in proof:
+            data += value.to_bytes(FELT_SIZE, 'big')
+    return bytes(data)
+
+
+def write_session(path: str, session: Session):
+    with open(path, 'wb') as session_file:
+        session_file.write(dump_session(session))
+
+
+# maps the file, only the pages of the proofs looked up are read. The session must be closed to unmap it
+def load_session(path: str) -> 'CompactSession':
+    with open(path, 'rb') as session_file:
+        return CompactSession(mmap.mmap(session_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+# Session read from the binary layout without copying it, can be used wherever a Session is.
+# The header is decoded when created, a proof only when it's looked up
+class CompactSession:
+    def __init__(self, buffer: Union[bytes, bytearray, mmap.mmap]):
+        self.data = buffer
+        self.buffer = memoryview(buffer)
+        magic, self.calls_len, self.proof_len, token_len = HEADER.unpack_from(self.buffer)
+        assert magic == MAGIC, "Invalid session data"
+        fields = self.read_felts(HEADER.size, len(FIELDS) + token_len)
+        for name, value in zip(FIELDS, fields):
+            setattr(self, name, value)
+        self.session_token = fields[len(FIELDS):]
+        self.calls_offset = HEADER.size + len(fields) * FELT_SIZE
+        self.proofs_offset = self.calls_offset + self.calls_len * CALL_SIZE
+        assert len(self.buffer) == self.proofs_offset + self.calls_len * self.proof_len * FELT_SIZE, "Invalid session data"
+
+    def __len__(self) -> int:
+        return self.calls_len
+
+    def __enter__(self) -> 'CompactSession':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # releases the buffer, unmapping the file of a loaded session
+    def close(self):
+        self.buffer.release()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    # (contract, selector) of each allowed call in the order of the call table, decoded on first use
+    @cached_property
+    def allowed_calls(self) -> List[Tuple[int, int]]:
+        calls = self.read_felts(self.calls_offset, 2 * self.calls_len)
+        return list(zip(calls[0::2], calls[1::2]))
+
+    def single_proof_len(self) -> int:
+        return self.proof_len
+
+    def get_proof(self, contract: int, selector: Union[str, int]) -> List[int]:
+        index = self.get_call_index(contract, get_selector(selector))
+        if index is None:
+            raise ValueError(f"{(contract, selector)} is not an allowed call")
+        return self.read_felts(self.proofs_offset + index * self.proof_len * FELT_SIZE, self.proof_len)
+
+    # binary search of the call table, big-endian felts sort like the integers they encode
+    def get_call_index(self, contract: int, selector: int) -> Optional[int]:
+        key = contract.to_bytes(FELT_SIZE, 'big') + selector.to_bytes(FELT_SIZE, 'big')
+        low, high = 0, self.calls_len
+        while low < high:
+            middle = (low + high) // 2
+            offset = self.calls_offset + middle * CALL_SIZE
+            entry = self.buffer[offset:offset + CALL_SIZE].tobytes()
+            if entry == key:
+                return middle
+            if entry < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def read_felts(self, offset: int, count: int) -> List[int]:
+        return [
+            int.from_bytes(self.buffer[position:position + FELT_SIZE], 'big')
+            for position in range(offset, offset + count * FELT_SIZE, FELT_SIZE)
+        ]
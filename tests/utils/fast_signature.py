@@ -0,0 +1,152 @@
+from typing import List, Optional, Tuple
+from starkware.crypto.signature.signature import (
+    ALPHA,
+    EC_GEN,
+    EC_ORDER,
+    FIELD_PRIME,
+    N_ELEMENT_BITS_ECDSA,
+    generate_k_rfc6979,
+    verify,
+)
+
+try:
+    from crypto_cpp_py.cpp_bindings import cpp_verify
+except ImportError:
+    cpp_verify = None
+
+# bits of the scalar handled by each table lookup
+WINDOW_BITS = 4
+SCALAR_BITS = EC_ORDER.bit_length()
+
+# Jacobian point (X, Y, Z) for the affine point (X / Z^2, Y / Z^3), Z == 0 is the point at infinity
+JacobianPoint = Tuple[int, int, int]
+INFINITY: JacobianPoint = (1, 1, 0)
+
+
+def to_affine(point: JacobianPoint) -> Tuple[int, int]:
+    x, y, z = point
+    z_inv = pow(z, -1, FIELD_PRIME)
+    z_inv_2 = z_inv * z_inv % FIELD_PRIME
+    return x * z_inv_2 % FIELD_PRIME, y * z_inv_2 * z_inv % FIELD_PRIME
+
+
+def jacobian_double(point: JacobianPoint) -> JacobianPoint:
+    x, y, z = point
+    if z == 0 or y == 0:
+        return INFINITY
+    y_2 = y * y % FIELD_PRIME
+    s = 4 * x * y_2 % FIELD_PRIME
+    z_2 = z * z % FIELD_PRIME
+    m = (3 * x * x + ALPHA * z_2 * z_2) % FIELD_PRIME
+    x_3 = (m * m - 2 * s) % FIELD_PRIME
+    y_3 = (m * (s - x_3) - 8 * y_2 * y_2) % FIELD_PRIME
+    z_3 = 2 * y * z % FIELD_PRIME
+    return x_3, y_3, z_3
+
+
+# adds an affine point to a Jacobian point
+def jacobian_add_affine(point: JacobianPoint, affine: Tuple[int, int]) -> JacobianPoint:
+    x_1, y_1, z_1 = point
+    x_2, y_2 = affine
+    if z_1 == 0:
+        return x_2, y_2, 1
+    z_1_2 = z_1 * z_1 % FIELD_PRIME
+    u_2 = x_2 * z_1_2 % FIELD_PRIME
+    s_2 = y_2 * z_1_2 * z_1 % FIELD_PRIME
+    h = (u_2 - x_1) % FIELD_PRIME
+    r = (s_2 - y_1) % FIELD_PRIME
+    if h == 0:
+        if r == 0:
+            return jacobian_double(point)
+        return INFINITY
+    h_2 = h * h % FIELD_PRIME
+    h_3 = h_2 * h % FIELD_PRIME
+    v = x_1 * h_2 % FIELD_PRIME
+    x_3 = (r * r - h_3 - 2 * v) % FIELD_PRIME
+    y_3 = (r * (v - x_3) - y_1 * h_3) % FIELD_PRIME
+    z_3 = z_1 * h % FIELD_PRIME
+    return x_3, y_3, z_3
+
+
+# Precomputed multiples of a fixed point: table[i][d] = d * 2^(WINDOW_BITS * i) * point.
+# A scalar multiplication is then one addition per window and no doubling.
+class FixedBaseTable:
+    def __init__(self, point: Tuple[int, int], window_bits: int = WINDOW_BITS, scalar_bits: int = SCALAR_BITS):
+        self.window_bits = window_bits
+        self.windows = -(-scalar_bits // window_bits)
+        self.table: List[List[Optional[Tuple[int, int]]]] = []
+        base: JacobianPoint = (point[0], point[1], 1)
+        for _ in range(self.windows):
+            base_affine = to_affine(base)
+            multiples = [None, base_affine]
+            current = (base_affine[0], base_affine[1], 1)
+            for _ in range(2, 1 << window_bits):
+                current = jacobian_add_affine(current, base_affine)
+                multiples.append(to_affine(current))
+            self.table.append(multiples)
+            for _ in range(window_bits):
+                base = jacobian_double(base)
+
+    def mult(self, scalar: int) -> Tuple[int, int]:
+        assert 0 < scalar < EC_ORDER, "Invalid scalar"
+        mask = (1 << self.window_bits) - 1
+        result = INFINITY
+        for multiples in self.table:
+            digit = scalar & mask
+            if digit:
+                result = jacobian_add_affine(result, multiples[digit])
+            scalar >>= self.window_bits
+        return to_affine(result)
+
+
+generator_table: Optional[FixedBaseTable] = None
+
+
+# the table of the generator is built once per process
+def get_generator_table() -> FixedBaseTable:
+    global generator_table
+    if generator_table is None:
+        generator_table = FixedBaseTable(EC_GEN)
+    return generator_table
+
+
+# same algorithm and output as starkware.crypto.signature.signature.sign, using the generator table
+# for the nonce point and native modular inverses
+def sign_fast(msg_hash: int, priv_key: int, seed: Optional[int] = None) -> Tuple[int, int]:
+    assert 0 <= msg_hash < 2**N_ELEMENT_BITS_ECDSA, "Message not signable."
+    table = get_generator_table()
+
+    while True:
+        k = generate_k_rfc6979(msg_hash, priv_key, seed)
+        seed = 1 if seed is None else seed + 1
+
+        r = table.mult(k)[0]
+        if not (1 <= r < 2**N_ELEMENT_BITS_ECDSA):
+            continue
+
+        if (msg_hash + r * priv_key) % EC_ORDER == 0:
+            continue
+
+        w = k * pow(msg_hash + r * priv_key, -1, EC_ORDER) % EC_ORDER
+        if not (1 <= w < 2**N_ELEMENT_BITS_ECDSA):
+            continue
+
+        s = pow(w, -1, EC_ORDER)
+        return r, s
+
+
+# same result as starkware.crypto.signature.signature.verify, an invalid signature returns False instead of raising.
+# Uses the native starkware crypto library when crypto-cpp-py is installed
+def verify_fast(msg_hash: int, r: int, s: int, public_key: int) -> bool:
+    if not (0 <= msg_hash < 2**N_ELEMENT_BITS_ECDSA and 1 <= r < 2**N_ELEMENT_BITS_ECDSA and 1 <= s < EC_ORDER and 1 <= public_key < FIELD_PRIME):
+        return False
+    w = pow(s, -1, EC_ORDER)
+    if not 1 <= w < 2**N_ELEMENT_BITS_ECDSA:
+        return False
+    try:
+        if cpp_verify is None:
+            return verify(msg_hash, r, s, public_key)
+        return cpp_verify(msg_hash, r, w, public_key)
+    except (AssertionError, ValueError):
+        # the public key is not the x coordinate of a curve point
+        return False
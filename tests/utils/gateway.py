@@ -0,0 +1,55 @@
+import asyncio
+import json
+from aiohttp import web
+from typing import Dict, Tuple
+from services.external_api.client import BadRequest, RetryConfig
+from starkware.starknet.business_logic.transaction.objects import InternalTransaction
+from starkware.starknet.services.api.gateway.gateway_client import GatewayClient
+from starkware.starknet.services.api.gateway.transaction import InvokeFunction, Transaction
+from starkware.starknet.testing.state import StarknetState
+from starkware.starkware_utils.error_handling import StarkException
+from utils.plugin_signer import PluginSigner
+
+
+# Submits the transactions to a gateway over HTTP, the rejected transactions raise a StarkException like on a local state
+class GatewaySubmitter:
+    def __init__(self, url: str, n_retries: int = 3):
+        # only the unavailable gateway responses are retried, a rejection is final
+        self.client = GatewayClient(url=url, retry_config=RetryConfig(n_retries=n_retries))
+
+    async def __call__(self, signer: PluginSigner, signed_tx: InvokeFunction) -> Dict[str, str]:
+        try:
+            return await self.client.add_transaction(tx=signed_tx)
+        except BadRequest as error:
+            response = json.loads(error.text)
+            raise StarkException(code=response['code'], message=response.get('message'))
+
+
+# Local stand-in for the add_transaction endpoint of the gateway, the transactions are executed on state when received.
+# Must be created in the event loop serving it
+def create_gateway_app(state: StarknetState) -> web.Application:
+    # the requests are handled concurrently, the transactions are executed one at a time
+    lock = asyncio.Lock()
+
+    async def add_transaction(request: web.Request) -> web.Response:
+        tx = Transaction.loads(await request.text())
+        try:
+            internal_tx = InternalTransaction.from_external(external_tx=tx, general_config=state.general_config)
+            async with lock:
+                await state.execute_tx(tx=internal_tx)
+        except StarkException as error:
+            return web.json_response({'code': str(error.code), 'message': error.message}, status=500)
+        return web.json_response({'code': 'TRANSACTION_RECEIVED', 'transaction_hash': hex(internal_tx.hash_value)})
+
+    app = web.Application()
+    app.router.add_post('/gateway/add_transaction', add_transaction)
+    return app
+
+
+# serves the stand-in on a free port, returns the runner to clean up and the url of the gateway
+async def start_gateway(state: StarknetState, host: str = '127.0.0.1', port: int = 0) -> Tuple[web.AppRunner, str]:
+    runner = web.AppRunner(create_gateway_app(state))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    _, bound_port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{bound_port}"
@@ -1,6 +1,96 @@
+import heapq
+import mmap
+import os
+from abc import abstractmethod
+from itertools import islice
+from typing import Iterable, Iterator, Optional
 from starkware.crypto.signature.fast_pedersen_hash import pedersen_hash
 from starkware.cairo.common.hash_state import compute_hash_on_elements
 
+try:
+    from crypto_cpp_py.cpp_bindings import cpp_hash
+except ImportError:
+    cpp_hash = None
+
+
+# computes the pedersen hashes of the merkle trees and sessions
+# the batch methods let a backend hash a whole level in one call
+class HashBackend:
+    @abstractmethod
+    def hash(self, a: int, b: int) -> int:
+        ...
+
+    def hash_pairs(self, pairs: 'list[tuple[int, int]]') -> 'list[int]':
+        return [self.hash(a, b) for a, b in pairs]
+
+    # same as compute_hash_on_elements
+    def hash_array(self, data: 'list[int]') -> int:
+        return compute_hash_on_elements(data, hash_func=self.hash)
+
+    def hash_arrays(self, arrays: 'list[list[int]]') -> 'list[int]':
+        return [self.hash_array(data) for data in arrays]
+
+
+class PythonHashBackend(HashBackend):
+    def hash(self, a: int, b: int) -> int:
+        return pedersen_hash(a, b)
+
+
+# uses the native starkware crypto library, requires crypto-cpp-py
+class NativeHashBackend(HashBackend):
+    def __init__(self):
+        assert cpp_hash is not None, "crypto-cpp-py is not installed"
+
+    def hash(self, a: int, b: int) -> int:
+        return cpp_hash(a, b)
+
+
+hash_backend: HashBackend = PythonHashBackend() if cpp_hash is None else NativeHashBackend()
+
+
+def get_hash_backend() -> HashBackend:
+    return hash_backend
+
+
+def set_hash_backend(backend: HashBackend):
+    global hash_backend
+    hash_backend = backend
+
+
+# running compute_hash_on_elements: the hash of a prefix is kept and extended by update,
+# a copy of a precomputed prefix only hashes the remaining elements
+class HashOnElements:
+    def __init__(self, elements: 'list[int]' = ()):
+        self.value = 0
+        self.length = 0
+        self.update(elements)
+
+    def update(self, elements: 'list[int]') -> 'HashOnElements':
+        value = self.value
+        for element in elements:
+            value = hash_backend.hash(value, element)
+        self.value = value
+        self.length += len(elements)
+        return self
+
+    def copy(self) -> 'HashOnElements':
+        return HashOnElements.from_state(self.state)
+
+    # (value, length), immutable so it can be cached and shared
+    @property
+    def state(self) -> 'tuple[int, int]':
+        return self.value, self.length
+
+    @staticmethod
+    def from_state(state: 'tuple[int, int]') -> 'HashOnElements':
+        hash_state = HashOnElements()
+        hash_state.value, hash_state.length = state
+        return hash_state
+
+    def finalize(self) -> int:
+        return hash_backend.hash(self.value, self.length)
+
+
 # generates merkle root from values list
 # each pair of values must be in sorted order
 def generate_merkle_root(values: 'list[int]') -> int:
@@ -8,7 +98,7 @@ def generate_merkle_root(values: 'list[int]') -> int:
         return values[0]
 
     if len(values) % 2 != 0:
-        values.append(0)
+        values = values + [0]
 
     next_level = get_next_level(values)
     return generate_merkle_root(next_level)
@@ -18,6 +108,30 @@ def generate_merkle_root(values: 'list[int]') -> int:
 def generate_merkle_proof(values: 'list[int]', index: int) -> 'list[int]':
     return generate_proof_helper(values, index, [])
 
+# generates every level of the merkle tree, from the leaves up to the root
+# each level is hashed once, odd levels are padded with 0 like generate_merkle_root
+def generate_merkle_tree(values: 'list[int]') -> 'list[list[int]]':
+    level = list(values)
+    levels = [level]
+    while len(level) > 1:
+        if len(level) % 2 != 0:
+            level.append(0)
+        level = get_next_level(level)
+        levels.append(level)
+    return levels
+
+# extracts the merkle proof of every value from the levels of a tree
+# the proofs are identical to calling generate_merkle_proof for each index
+def get_merkle_proofs(levels: 'list[list[int]]') -> 'list[list[int]]':
+    proofs = [[] for _ in range(len(levels[0]))]
+    for index in range(len(proofs)):
+        proof = proofs[index]
+        node_index = index
+        for level in levels[:-1]:
+            proof.append(level[node_index ^ 1])
+            node_index //= 2
+    return proofs
+
 # checks the validity of a merkle proof
 # the last element of the proof should be the root
 def verify_merkle_proof(leaf: int, proof: 'list[int]') -> bool:
@@ -26,19 +140,65 @@ def verify_merkle_proof(leaf: int, proof: 'list[int]') -> bool:
     curr = leaf
 
     for proof_elem in proof:
-        if curr < proof_elem:
-            curr = pedersen_hash(curr, proof_elem)
-        else:
-            curr = pedersen_hash(proof_elem, curr)
+        curr = hash_pair(curr, proof_elem)
 
     return curr == root
 
+# generates a single multiproof for several leaves from their individual proofs
+# returns the leaves in the order the verifier consumes them, the proof nodes and one flag per hash:
+# a flag is 1 when the second node of the hash is the next node of the queue, 0 when it is the next proof node
+def generate_merkle_multiproof(leaves: 'list[int]', proofs: 'list[list[int]]') -> 'tuple[list[int], list[int], list[int]]':
+    paths = []
+    for leaf, proof in zip(leaves, proofs):
+        path = [leaf]
+        for proof_elem in proof:
+            path.append(hash_pair(path[-1], proof_elem))
+        paths.append(path)
+
+    # ordering the leaves from the root down keeps every subtree contiguous in the queue
+    order = sorted(range(len(leaves)), key=lambda i: paths[i][::-1])
+    queue = [i for i in order]
+    multiproof = []
+    flags = []
+    for depth in range(len(proofs[0])):
+        next_queue = []
+        i = 0
+        while i < len(queue):
+            sibling = proofs[queue[i]][depth]
+            if i + 1 < len(queue) and paths[queue[i + 1]][depth] == sibling:
+                flags.append(1)
+                i += 2
+            else:
+                flags.append(0)
+                multiproof.append(sibling)
+                i += 1
+            next_queue.append(queue[i - 1])
+        queue = next_queue
+
+    return [leaves[i] for i in order], multiproof, flags
+
+# checks the validity of a multiproof generated by generate_merkle_multiproof
+def verify_merkle_multiproof(leaves: 'list[int]', proof: 'list[int]', flags: 'list[int]', root: int) -> bool:
+    if len(leaves) + len(proof) - 1 != len(flags):
+        return False
+
+    queue = list(leaves)
+    proof = list(proof)
+    for flag in flags:
+        if len(queue) < 1 + flag or (not flag and len(proof) == 0):
+            return False
+        a = queue.pop(0)
+        b = queue.pop(0) if flag else proof.pop(0)
+        queue.append(hash_pair(a, b))
+
+    return len(queue) == 1 and len(proof) == 0 and queue[0] == root
+
 # creates the inital merkle leaf values to use
 def get_leaves(policy_type_hash: 'int', contracts: 'list[int]', selectors: 'list[int]') -> 'list[tuple[int, int, int]]':
     values = []
+    leaves = hash_backend.hash_arrays([[policy_type_hash, contracts[i], selectors[i]] for i in range(0, len(contracts))])
     for i in range(0, len(contracts)):
-        leaf = compute_hash_on_elements([policy_type_hash, contracts[i], selectors[i]])
-        value = (leaf, contracts[i], selectors[i])
+        value = (leaves[i], contracts[i], selectors[i])
         values.append(value)
 
     if len(values) % 2 != 0:
@@ -47,25 +207,26 @@ def get_leaves(policy_type_hash: 'int', contracts: 'list[int]', selectors: 'list
 
     return values
 
+# hashes a pair of nodes in sorted order
+def hash_pair(a: int, b: int) -> int:
+    if a < b:
+        return hash_backend.hash(a, b)
+    return hash_backend.hash(b, a)
+
+# hashes a level of (padded) nodes in sorted order
 def get_next_level(level: 'list[int]') -> 'list[int]':
-    next_level = []
+    pairs = []
 
     for i in range(0, len(level), 2):
-        node = 0
-        if level[i] < level[i+1]:
-            node = pedersen_hash(level[i], level[i+1])
-        else:
-            node = pedersen_hash(level[i+1], level[i])
+        pairs.append((level[i], level[i+1]) if level[i] < level[i+1] else (level[i+1], level[i]))
 
-        next_level.append(node)
-
-    return next_level
+    return hash_backend.hash_pairs(pairs)
 
 def generate_proof_helper(level: 'list[int]', index: int, proof: 'list[int]') -> 'list[int]':
     if len(level) == 1:
         return proof
     if len(level) % 2 != 0:
-        level.append(0)
+        level = level + [0]
 
     next_level = get_next_level(level)
     index_parent = 0
@@ -78,4 +239,262 @@ def generate_proof_helper(level: 'list[int]', index: int, proof: 'list[int]') ->
             else:
                 proof.append(level[index-1])
 
-    return generate_proof_helper(next_level, index_parent, proof)
\ No newline at end of file
+    return generate_proof_helper(next_level, index_parent, proof)
+
+# merkle tree of (contract, selector) policies that can be edited in place
+# odd levels are padded with a virtual 0 so the root matches generate_merkle_root(get_leaves(...))
+# every edit only re-hashes the path from the edited leaves to the root
+class PolicyTree:
+    def __init__(self, policy_type_hash: int, contracts: 'list[int]' = None, selectors: 'list[int]' = None):
+        self.policy_type_hash = policy_type_hash
+        self.policies: 'list[tuple[int, int]]' = []
+        self.indexes: 'dict[tuple[int, int], int]' = {}
+        self.levels: 'list[list[int]]' = [[]]
+        contracts = contracts or []
+        selectors = selectors or []
+        leaves = hash_backend.hash_arrays([[policy_type_hash, contract, selector] for contract, selector in zip(contracts, selectors)])
+        for contract, selector, leaf in zip(contracts, selectors, leaves):
+            self._insert(contract, selector, leaf)
+        self._build()
+
+    def __len__(self) -> int:
+        return len(self.policies)
+
+    def __contains__(self, policy: 'tuple[int, int]') -> bool:
+        return policy in self.indexes
+
+    @property
+    def root(self) -> int:
+        assert len(self.policies) > 0, "PolicyTree: empty tree"
+        return self.levels[-1][0]
+
+    def get_leaf(self, contract: int, selector: int) -> int:
+        return hash_backend.hash_array([self.policy_type_hash, contract, selector])
+
+    def get_proof(self, contract: int, selector: int) -> 'list[int]':
+        index = self._index(contract, selector)
+        proof = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            proof.append(level[sibling] if sibling < len(level) else 0)
+            index //= 2
+        return proof
+
+    def get_proofs(self) -> 'list[list[int]]':
+        return [self.get_proof(contract, selector) for contract, selector in self.policies]
+
+    def add(self, contract: int, selector: int):
+        index = self._insert(contract, selector, self.get_leaf(contract, selector))
+        self._update_path(index)
+
+    def remove(self, contract: int, selector: int):
+        index = self._index(contract, selector)
+        last_index = len(self.policies) - 1
+        # move the last policy into the freed slot so only two paths change
+        last_policy = self.policies.pop()
+        del self.indexes[(contract, selector)]
+        last_leaf = self.levels[0].pop()
+        if index != last_index:
+            self.policies[index] = last_policy
+            self.indexes[last_policy] = index
+            self.levels[0][index] = last_leaf
+            self._update_path(index)
+        self._update_path(len(self.policies) - 1)
+
+    def replace(self, contract: int, selector: int, new_contract: int, new_selector: int):
+        index = self._index(contract, selector)
+        assert (new_contract, new_selector) not in self.indexes, "PolicyTree: duplicate policy"
+        del self.indexes[(contract, selector)]
+        self.policies[index] = (new_contract, new_selector)
+        self.indexes[(new_contract, new_selector)] = index
+        self.levels[0][index] = self.get_leaf(new_contract, new_selector)
+        self._update_path(index)
+
+    def _index(self, contract: int, selector: int) -> int:
+        index = self.indexes.get((contract, selector))
+        assert index is not None, "PolicyTree: unknown policy"
+        return index
+
+    def _insert(self, contract: int, selector: int, leaf: int) -> int:
+        assert (contract, selector) not in self.indexes, "PolicyTree: duplicate policy"
+        index = len(self.policies)
+        self.policies.append((contract, selector))
+        self.indexes[(contract, selector)] = index
+        self.levels[0].append(leaf)
+        return index
+
+    def _has_parent(self, depth: int) -> bool:
+        # the leaf level is always paired, even when it holds a single leaf
+        size = len(self.levels[depth])
+        return size > 1 or (depth == 0 and size == 1)
+
+    def _build(self):
+        depth = 0
+        del self.levels[1:]
+        while self._has_parent(depth):
+            level = self.levels[depth]
+            self.levels.append(get_next_level(level if len(level) % 2 == 0 else level + [0]))
+            depth += 1
+
+    def _update_path(self, index: int):
+        depth = 0
+        while self._has_parent(depth):
+            level = self.levels[depth]
+            if depth + 1 == len(self.levels):
+                self.levels.append([])
+            parent_level = self.levels[depth + 1]
+            del parent_level[(len(level) + 1) // 2:]
+            parent = index // 2
+            left = level[2 * parent]
+            right = level[2 * parent + 1] if 2 * parent + 1 < len(level) else 0
+            node = hash_pair(left, right)
+            if parent < len(parent_level):
+                parent_level[parent] = node
+            else:
+                parent_level.append(node)
+            index = parent
+            depth += 1
+        del self.levels[depth + 1:]
+
+# size of a node in the files of a StreamingPolicyTree, big-endian
+NODE_SIZE = 32
+# size of an entry of the policy index of a StreamingPolicyTree: contract, selector and leaf index
+INDEX_ENTRY_SIZE = 3 * NODE_SIZE
+# number of policies, or pairs of nodes, hashed at once by a StreamingPolicyTree
+STREAMING_CHUNK_SIZE = 4096
+
+# merkle tree of (contract, selector) policies built from an iterator, for policies too large to keep in memory
+# the policies and every level are written to files in directory and memory-mapped, the proofs are read from the files
+# the policies are indexed by a file sorted by (contract, selector), merged from the sorted chunks and binary-searched
+# only a chunk of nodes is held in memory at a time, the root and proofs are the same as PolicyTree's
+class StreamingPolicyTree:
+    def __init__(self, directory: str, policy_type_hash: int, policies: 'Iterable[tuple[int, int]]', chunk_size: int = STREAMING_CHUNK_SIZE):
+        self.directory = directory
+        self.policy_type_hash = policy_type_hash
+        self.chunk_size = chunk_size
+        os.makedirs(directory, exist_ok=True)
+        self.size = self._write_leaves(iter(policies))
+        self.index = self._map('index.bin')
+        self.levels: 'list[mmap.mmap]' = [self._map('level_0.bin')]
+        while len(self.levels[-1]) > NODE_SIZE:
+            self.levels.append(self._write_next_level(len(self.levels) - 1))
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __contains__(self, policy: 'tuple[int, int]') -> bool:
+        return self._find(*policy) is not None
+
+    @property
+    def root(self) -> int:
+        return read_nodes(self.levels[-1], 0, 1)[0]
+
+    def get_leaf(self, contract: int, selector: int) -> int:
+        return hash_backend.hash_array([self.policy_type_hash, contract, selector])
+
+    def get_proof(self, contract: int, selector: int) -> 'list[int]':
+        index = self._find(contract, selector)
+        assert index is not None, "StreamingPolicyTree: unknown policy"
+        return self.get_proof_at(index)
+
+    # proof of the policy at index in the order of the iterator
+    def get_proof_at(self, index: int) -> 'list[int]':
+        proof = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            proof.append(read_nodes(level, sibling, 1)[0] if sibling < len(level) // NODE_SIZE else 0)
+            index //= 2
+        return proof
+
+    def close(self):
+        self.index.close()
+        for level in self.levels:
+            level.close()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _map(self, name: str) -> mmap.mmap:
+        with open(self._path(name), 'rb') as level_file:
+            return mmap.mmap(level_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _write_leaves(self, policies: 'Iterator[tuple[int, int]]') -> int:
+        size = 0
+        runs = []
+        with open(self._path('level_0.bin'), 'wb') as level_file:
+            while True:
+                chunk = list(islice(policies, self.chunk_size))
+                if not chunk:
+                    break
+                leaves = hash_backend.hash_arrays([[self.policy_type_hash, contract, selector] for contract, selector in chunk])
+                level_file.write(b''.join(leaf.to_bytes(NODE_SIZE, 'big') for leaf in leaves))
+                runs.append(self._write_index_run(len(runs), chunk, size))
+                size += len(chunk)
+            assert size > 0, "StreamingPolicyTree: empty tree"
+            # the leaf level is padded like get_leaves, even when it holds a single leaf
+            if size % 2 != 0:
+                level_file.write(bytes(NODE_SIZE))
+        self._merge_index_runs(runs)
+        return size
+
+    # writes the entries of a chunk of policies sorted, big-endian entries sort like the (contract, selector, index) they encode
+    def _write_index_run(self, run: int, chunk: 'list[tuple[int, int]]', start: int) -> str:
+        path = self._path(f"index_{run}.bin")
+        entries = sorted(
+            contract.to_bytes(NODE_SIZE, 'big') + selector.to_bytes(NODE_SIZE, 'big') + (start + offset).to_bytes(NODE_SIZE, 'big')
+            for offset, (contract, selector) in enumerate(chunk)
+        )
+        with open(path, 'wb') as run_file:
+            run_file.write(b''.join(entries))
+        return path
+
+    def _merge_index_runs(self, runs: 'list[str]'):
+        run_files = [open(run, 'rb') for run in runs]
+        try:
+            with open(self._path('index.bin'), 'wb') as index_file:
+                merged = heapq.merge(*(iter(lambda run_file=run_file: run_file.read(INDEX_ENTRY_SIZE), b'') for run_file in run_files))
+                while True:
+                    entries = list(islice(merged, self.chunk_size))
+                    if not entries:
+                        break
+                    index_file.write(b''.join(entries))
+        finally:
+            for run_file in run_files:
+                run_file.close()
+        for run in runs:
+            os.remove(run)
+
+    def _write_next_level(self, depth: int) -> mmap.mmap:
+        level = self.levels[depth]
+        level_size = len(level) // NODE_SIZE
+        name = f"level_{depth + 1}.bin"
+        with open(self._path(name), 'wb') as level_file:
+            for start in range(0, level_size, 2 * self.chunk_size):
+                nodes = read_nodes(level, start, min(2 * self.chunk_size, level_size - start))
+                if len(nodes) % 2 != 0:
+                    nodes.append(0)
+                level_file.write(b''.join(node.to_bytes(NODE_SIZE, 'big') for node in get_next_level(nodes)))
+        return self._map(name)
+
+    # binary search of the index for the first entry of the policy, the index of its leaf when the policy is repeated
+    def _find(self, contract: int, selector: int) -> Optional[int]:
+        key = contract.to_bytes(NODE_SIZE, 'big') + selector.to_bytes(NODE_SIZE, 'big')
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle * INDEX_ENTRY_SIZE
+            if self.index[offset:offset + len(key)] < key:
+                low = middle + 1
+            else:
+                high = middle
+        offset = low * INDEX_ENTRY_SIZE
+        if low == self.size or self.index[offset:offset + len(key)] != key:
+            return None
+        return int.from_bytes(self.index[offset + len(key):offset + INDEX_ENTRY_SIZE], 'big')
+
+
+def read_nodes(buffer: mmap.mmap, start: int, count: int) -> 'list[int]':
+    return [
+        int.from_bytes(buffer[offset:offset + NODE_SIZE], 'big')
+        for offset in range(start * NODE_SIZE, (start + count) * NODE_SIZE, NODE_SIZE)
+    ]
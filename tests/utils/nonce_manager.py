@@ -0,0 +1,55 @@
+import asyncio
+import weakref
+from typing import Awaitable, Callable, Dict, Optional
+from weakref import WeakKeyDictionary
+from starkware.starknet.testing.contract import StarknetContract
+
+
+# Hands out the nonces of a single account locally so transactions can be signed before the previous ones are executed.
+# The manager must be the only source of nonces for the account, it resyncs from the state when invalidated.
+class NonceManager:
+    def __init__(self, fetch_nonce: Callable[[], Awaitable[int]]):
+        self.fetch_nonce = fetch_nonce
+        self.next_nonce: Optional[int] = None
+        # incremented by invalidate, the nonces reserved in an older generation may be stale
+        self.generation = 0
+        self.lock: Optional[asyncio.Lock] = None
+
+    async def reserve(self, count: int = 1) -> range:
+        assert count > 0, "Invalid nonce count"
+        # created lazily to bind to the running event loop
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.next_nonce is None:
+                self.next_nonce = await self.fetch_nonce()
+            nonces = range(self.next_nonce, self.next_nonce + count)
+            self.next_nonce += count
+            return nonces
+
+    async def next(self) -> int:
+        return (await self.reserve(1))[0]
+
+    # the next reservation reads the nonce from the state again
+    def invalidate(self):
+        self.next_nonce = None
+        self.generation += 1
+
+
+# the managers of the accounts of each state, the forks of a state have their own
+nonce_managers: 'WeakKeyDictionary[object, Dict[int, NonceManager]]' = WeakKeyDictionary()
+
+
+# Returns the manager of the account, shared by all the signers of the account so their nonces don't collide
+def get_nonce_manager(account: StarknetContract) -> NonceManager:
+    state = account.state
+    account_address = account.contract_address
+    managers = nonce_managers.setdefault(state, {})
+    if account_address not in managers:
+        # a strong reference from the manager would keep its own key, and so every fork, alive
+        state_ref = weakref.ref(state)
+
+        async def fetch_nonce() -> int:
+            return await state_ref().state.get_nonce_at(contract_address=account_address)
+        managers[account_address] = NonceManager(fetch_nonce)
+    return managers[account_address]
@@ -0,0 +1,200 @@
+import asyncio
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+from starkware.starknet.business_logic.transaction.objects import TransactionExecutionInfo
+from starkware.starknet.services.api.gateway.transaction import InvokeFunction
+from utils.plugin_signer import PluginSigner
+from utils.session_keys_utils import Session, get_call_proofs
+from utils.utils import get_execute_calldata
+
+# submits a transaction signed for the account of the signer, returns the execution info or the gateway response
+Submitter = Callable[[PluginSigner, InvokeFunction], Awaitable[Any]]
+
+
+# Executes on the in-process state of the account, one transaction at a time like a sequencer:
+# the executions interleaved on a StarknetState would overwrite each other's writes
+class StateSubmitter:
+    def __init__(self):
+        # created lazily to bind to the running event loop
+        self.lock: Optional[asyncio.Lock] = None
+
+    async def __call__(self, signer: PluginSigner, signed_tx: InvokeFunction) -> TransactionExecutionInfo:
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            # the pipeline resyncs the nonces of the rejected transactions
+            return await signer.execute_signed_tx(signed_tx)
+
+
+# The nonce of the transaction was reserved before a rejection resynced the nonces of its account, it's not submitted
+class StaleNonceError(Exception):
+    pass
+
+
+@dataclass
+class Submission:
+    signer: PluginSigner
+    calls: list
+    # the transaction is signed with the session key of a SessionPluginSigner
+    session: Optional[Session] = None
+    max_fee: int = 0
+
+
+@dataclass
+class Completion:
+    submission: Submission
+    signed_tx: Optional[InvokeFunction]
+    result: Any
+    error: Optional[Exception]
+
+
+@dataclass
+class PendingTransaction:
+    submission: Submission
+    calldata: Optional[List[int]] = None
+    proofs: Optional[List[int]] = None
+    nonce: Optional[int] = None
+    # generation of the nonce manager when the nonce was reserved
+    nonce_generation: Optional[int] = None
+    transaction_hash: Optional[int] = None
+    signed_tx: Optional[InvokeFunction] = None
+    result: Any = None
+    error: Optional[Exception] = None
+
+
+# Builds the calldata, signs and submits transactions in three pipelined stages.
+# Each account has its own lane: its transactions get consecutive nonces and are submitted in order,
+# the lanes of different accounts run concurrently. put() waits while max_in_flight transactions are not completed.
+# A rejected transaction resyncs the nonces of its account, the transactions of the lane built before the resync
+# complete with a StaleNonceError without being submitted, the next ones get nonces from the state.
+class SubmissionPipeline:
+    def __init__(self, submit: Optional[Submitter] = None, max_in_flight: int = 16, executor: Optional[Executor] = None):
+        self.submit = StateSubmitter() if submit is None else submit
+        self.max_in_flight = max_in_flight
+        # the signatures are computed in the executor when one is given
+        self.executor = executor
+        self.lanes: Dict[int, asyncio.Queue] = {}
+        self.tasks: List[asyncio.Future] = []
+        # called with each completion as soon as it happens, before it's streamed
+        self.listeners: List[Callable[[Completion], None]] = []
+        self.closed = False
+        # created lazily to bind to the running event loop
+        self.in_flight: Optional[asyncio.Semaphore] = None
+        self.completed: Optional[asyncio.Queue] = None
+
+    def start(self):
+        if self.in_flight is None:
+            self.in_flight = asyncio.Semaphore(self.max_in_flight)
+            self.completed = asyncio.Queue()
+
+    async def put(self, submission: Submission):
+        assert not self.closed, "The pipeline is closed"
+        self.start()
+        await self.in_flight.acquire()
+        account_address = submission.signer.account.contract_address
+        if account_address not in self.lanes:
+            self.lanes[account_address] = self.start_lane(submission.signer)
+        await self.lanes[account_address].put(PendingTransaction(submission))
+
+    # waits for the submitted transactions to complete, then ends the completion stream
+    async def close(self):
+        self.closed = True
+        self.start()
+        for lane in self.lanes.values():
+            await lane.put(None)
+        await asyncio.gather(*self.tasks)
+        await self.completed.put(None)
+
+    # the completions in the order they happen, the stream ends when the pipeline is closed
+    async def completions(self) -> AsyncIterator[Completion]:
+        self.start()
+        while True:
+            completion = await self.completed.get()
+            if completion is None:
+                return
+            yield completion
+
+    async def run(self, submissions: List[Submission]) -> List[Completion]:
+        async def produce():
+            try:
+                for submission in submissions:
+                    await self.put(submission)
+            finally:
+                # the lanes and the completion stream always end, even when put raises
+                await self.close()
+
+        producer = asyncio.ensure_future(produce())
+        completions = [completion async for completion in self.completions()]
+        await producer
+        return completions
+
+    def start_lane(self, signer: PluginSigner) -> asyncio.Queue:
+        to_build, to_sign, to_submit = asyncio.Queue(), asyncio.Queue(), asyncio.Queue()
+        self.tasks += [
+            asyncio.ensure_future(self.run_stage(to_build, self.build_transaction, to_sign.put)),
+            asyncio.ensure_future(self.run_stage(to_sign, self.sign_transaction, to_submit.put)),
+            asyncio.ensure_future(self.run_stage(to_submit, self.submit_transaction, self.complete)),
+        ]
+        return to_build
+
+    # a failed transaction skips the next stages, None closes the lane
+    async def run_stage(self, inbox: asyncio.Queue, process: Callable[[PendingTransaction], Awaitable[None]], forward: Callable[[Optional[PendingTransaction]], Awaitable[None]]):
+        while True:
+            pending = await inbox.get()
+            if pending is None:
+                await forward(None)
+                return
+            if pending.error is None:
+                try:
+                    await process(pending)
+                except Exception as error:
+                    pending.error = error
+            await forward(pending)
+
+    async def build_transaction(self, pending: PendingTransaction):
+        submission = pending.submission
+        pending.calldata = get_execute_calldata(submission.calls)
+        if submission.session is not None:
+            pending.proofs = [item for proof in get_call_proofs(submission.session, submission.calls) for item in proof]
+        # reserved once nothing else in the stage can fail
+        # the manager of the account is shared with the signers used outside the pipeline
+        pending.nonce = await submission.signer.nonce_manager.next()
+        pending.nonce_generation = submission.signer.nonce_manager.generation
+        pending.transaction_hash = submission.signer.get_transaction_hash(pending.calldata, pending.nonce, submission.max_fee)
+
+    async def sign_transaction(self, pending: PendingTransaction):
+        submission = pending.submission
+        stark_key = submission.signer.stark_key
+        if self.executor is None:
+            stark_signature = stark_key.sign(pending.transaction_hash)
+        else:
+            stark_signature = await asyncio.get_running_loop().run_in_executor(
+                self.executor, stark_key.sign_function, pending.transaction_hash, stark_key.private_key
+            )
+
+        if submission.session is None:
+            signature = submission.signer.get_plugin_signature(stark_signature)
+        else:
+            session = submission.session
+            signature = submission.signer.get_session_signature(stark_signature, session, session.single_proof_len(), pending.proofs)
+        pending.signed_tx = submission.signer.build_transaction(pending.calldata, signature, pending.nonce, submission.max_fee)
+
+    async def submit_transaction(self, pending: PendingTransaction):
+        if pending.nonce_generation != pending.submission.signer.nonce_manager.generation:
+            raise StaleNonceError(f"Nonce {pending.nonce} was reserved before the nonces of the account were resynced")
+        pending.result = await self.submit(pending.submission.signer, pending.signed_tx)
+
+    async def complete(self, pending: Optional[PendingTransaction]):
+        if pending is None:
+            return
+        nonce_manager = pending.submission.signer.nonce_manager if pending.nonce is not None else None
+        if pending.error is not None and nonce_manager is not None and pending.nonce_generation == nonce_manager.generation:
+            # the only place the pipeline resyncs the nonces, once per rejection: the next transactions
+            # of the lane built with the same generation are stale
+            nonce_manager.invalidate()
+        self.in_flight.release()
+        completion = Completion(pending.submission, pending.signed_tx, pending.result, pending.error)
+        for listener in self.listeners:
+            listener(completion)
+        await self.completed.put(completion)
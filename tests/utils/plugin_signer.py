@@ -1,20 +1,35 @@
 from abc import abstractmethod
-from typing import Optional, List, Tuple
+from concurrent.futures import Executor
+from typing import ContextManager, Optional, List, Tuple, Union
 from starkware.crypto.signature.signature import sign
 from starkware.starknet.testing.contract import StarknetContract
 from starkware.starknet.definitions.general_config import StarknetChainId
-from starkware.starknet.core.os.transaction_hash.transaction_hash import calculate_transaction_hash_common, TransactionHashPrefix
+from starkware.starknet.core.os.transaction_hash.transaction_hash import TransactionHashPrefix
 from starkware.starknet.services.api.gateway.transaction import InvokeFunction, Declare
 from starkware.starknet.business_logic.transaction.objects import InternalTransaction, TransactionExecutionInfo
 from starkware.starknet.compiler.compile import get_selector_from_name
-from utils.utils import from_call_to_call_array, StarkKeyPair, cached_contract, copy_contract_state
+from starkware.starkware_utils.error_handling import StarkException
+from utils.utils import get_execute_calldata, StarkKeyPair
+from utils.nonce_manager import get_nonce_manager
+from utils.merkle_utils import HashOnElements
+from utils.resources import ResourceRecorder
+from utils.timing import NO_TIMING, TimingHooks
 TRANSACTION_VERSION = 1
+# version of the transactions only used to estimate the fees, accepted by PluginAccount like TRANSACTION_VERSION
+QUERY_VERSION = 2 ** 128 + TRANSACTION_VERSION
 
 
 class PluginSigner:
     def __init__(self, account: StarknetContract, plugin_class_hash):
         self.account = account
         self.plugin_class_hash = plugin_class_hash
+        # shared with the other signers of the account
+        self.nonce_manager = get_nonce_manager(account)
+        self.transaction_hash_prefix = HashOnElements([TransactionHashPrefix.INVOKE.value, TRANSACTION_VERSION, account.contract_address, 0])
+        # records the resources of the executed transactions when set
+        self.resource_recorder: Optional[ResourceRecorder] = None
+        # times the stages of the transactions when set
+        self.timing_hooks: Optional[TimingHooks] = None
 
     @abstractmethod
     def sign(self, message_hash: int) -> List[int]:
@@ -24,45 +39,109 @@ class PluginSigner:
         return await self.send_signed_tx(await self.get_signed_transaction(calls, nonce, max_fee))
 
     async def send_signed_tx(self, signed_tx: InvokeFunction) -> TransactionExecutionInfo :
-        return await self.account.state.execute_tx(
-            tx=InternalTransaction.from_external(
-                external_tx=signed_tx,
-                general_config=self.account.state.general_config
+        try:
+            return await self.execute_signed_tx(signed_tx)
+        except StarkException:
+            # the local nonces can't be trusted once a transaction is rejected
+            self.nonce_manager.invalidate()
+            raise
+
+    # same as send_signed_tx, leaving the nonce manager to the caller
+    async def execute_signed_tx(self, signed_tx: InvokeFunction) -> TransactionExecutionInfo:
+        with self.timed('execute'):
+            execution_info = await self.account.state.execute_tx(
+                tx=InternalTransaction.from_external(
+                    external_tx=signed_tx,
+                    general_config=self.account.state.general_config
+                )
             )
-        )
+        if self.resource_recorder is not None:
+            self.resource_recorder.record(signed_tx, execution_info)
+        return execution_info
+
+    # executes the transactions in order on the account's state, like a sequencer block
+    # a rejected transaction doesn't stop the batch, its StarkException is returned in place of its execution info
+    async def send_signed_txs(self, signed_txs: List[InvokeFunction]) -> List[Union[TransactionExecutionInfo, StarkException]]:
+        state = self.account.state
+        general_config = state.general_config
+        internal_txs = []
+        for signed_tx in signed_txs:
+            try:
+                internal_txs.append(InternalTransaction.from_external(external_tx=signed_tx, general_config=general_config))
+            except StarkException as error:
+                internal_txs.append(error)
+
+        results = []
+        for signed_tx, internal_tx in zip(signed_txs, internal_txs):
+            if isinstance(internal_tx, StarkException):
+                results.append(internal_tx)
+                continue
+            try:
+                with self.timed('execute'):
+                    execution_info = await state.execute_tx(tx=internal_tx)
+            except StarkException as error:
+                results.append(error)
+                continue
+            if self.resource_recorder is not None:
+                self.resource_recorder.record(signed_tx, execution_info)
+            results.append(execution_info)
+
+        if any(isinstance(result, StarkException) for result in results):
+            # the local nonces can't be trusted once a transaction is rejected
+            self.nonce_manager.invalidate()
+        return results
+
+    # signs a burst of transactions with consecutive nonces reserved from the nonce manager
+    # they must be sent in order, a rejected transaction also invalidates the ones signed after it
+    # the signatures are computed in the executor when one is given
+    async def get_signed_transactions(self, calls_list, max_fee: Optional[int] = 0, executor: Optional[Executor] = None) -> List[InvokeFunction]:
+        nonces = await self.nonce_manager.reserve(len(calls_list))
+        calldatas = [get_execute_calldata(calls) for calls in calls_list]
+        transaction_hashes = [self.get_transaction_hash(calldata, nonce, max_fee) for calldata, nonce in zip(calldatas, nonces)]
+        signatures = self.sign_many(transaction_hashes, executor)
+        return [
+            self.build_transaction(calldata, signature, nonce, max_fee)
+            for calldata, signature, nonce in zip(calldatas, signatures, nonces)
+        ]
 
-    async def get_signed_transaction(self, calls, nonce: Optional[int] = None, max_fee: Optional[int] = 0) -> InvokeFunction:
-        call_array, calldata = from_call_to_call_array(calls)
+    def sign_many(self, message_hashes: List[int], executor: Optional[Executor] = None) -> List[List[int]]:
+        return [self.sign(message_hash) for message_hash in message_hashes]
 
-        account_copy = copy_contract_state(self.account)
-        raw_invocation = account_copy.__execute__(call_array, calldata)
+    async def get_nonce(self) -> int:
+        return await self.account.state.state.get_nonce_at(contract_address=self.account.contract_address)
+
+    async def get_signed_transaction(self, calls, nonce: Optional[int] = None, max_fee: Optional[int] = 0) -> InvokeFunction:
+        with self.timed('calldata'):
+            calldata = get_execute_calldata(calls)
 
         if nonce is None:
-            nonce = await raw_invocation.state.state.get_nonce_at(contract_address=account_copy.contract_address)
+            with self.timed('nonce'):
+                nonce = await self.nonce_manager.next()
 
-        transaction_hash = calculate_transaction_hash_common(
-            tx_hash_prefix=TransactionHashPrefix.INVOKE,
-            version=TRANSACTION_VERSION,
-            contract_address=self.account.contract_address,
-            entry_point_selector=0,
-            calldata=raw_invocation.calldata,
-            max_fee=max_fee,
-            chain_id=StarknetChainId.TESTNET.value,
-            additional_data=[nonce],
-        )
+        with self.timed('hash'):
+            transaction_hash = self.get_transaction_hash(calldata, nonce, max_fee)
+        with self.timed('sign'):
+            signature = self.sign(transaction_hash)
+        return self.build_transaction(calldata, signature, nonce, max_fee)
 
-        signature = self.sign(transaction_hash)
+    def timed(self, stage: str) -> ContextManager:
+        return NO_TIMING if self.timing_hooks is None else self.timing_hooks.stage(stage)
 
-        external_tx = InvokeFunction(
+    # same as calculate_transaction_hash_common, the fields before the calldata are only hashed once per signer
+    def get_transaction_hash(self, calldata: List[int], nonce: int, max_fee: int) -> int:
+        calldata_hash = HashOnElements(calldata).finalize()
+        return self.transaction_hash_prefix.copy().update([calldata_hash, max_fee, StarknetChainId.TESTNET.value, nonce]).finalize()
+
+    def build_transaction(self, calldata: List[int], signature: List[int], nonce: int, max_fee: int) -> InvokeFunction:
+        return InvokeFunction(
             contract_address=self.account.contract_address,
-            calldata=raw_invocation.calldata,
+            calldata=calldata,
             entry_point_selector=None,
             signature=signature,
             max_fee=max_fee,
             version=TRANSACTION_VERSION,
             nonce=nonce,
         )
-        return external_tx
 
     async def execute_on_plugin(self, selector_name, arguments=None, plugin=None):
         if arguments is None:
@@ -108,4 +187,10 @@ class StarkPluginSigner(PluginSigner):
         self.public_key = stark_key.public_key
 
     def sign(self, message_hash: int) -> List[int]:
-        return [self.plugin_class_hash] + list(self.stark_key.sign(message_hash))
\ No newline at end of file
+        return self.get_plugin_signature(self.stark_key.sign(message_hash))
+
+    def sign_many(self, message_hashes: List[int], executor: Optional[Executor] = None) -> List[List[int]]:
+        return [self.get_plugin_signature(signature) for signature in self.stark_key.sign_many(message_hashes, executor)]
+
+    def get_plugin_signature(self, stark_signature: Tuple[int, int]) -> List[int]:
+        return [self.plugin_class_hash, *stark_signature]
\ No newline at end of file
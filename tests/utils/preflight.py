@@ -0,0 +1,257 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from starkware.cairo.lang.cairo_constants import DEFAULT_PRIME
+from starkware.starknet.core.os.transaction_hash.transaction_hash import calculate_transaction_hash_common, TransactionHashPrefix
+from starkware.starknet.public.abi import get_storage_var_address
+from starkware.starknet.services.api.gateway.transaction import InvokeFunction
+from starkware.starknet.testing.state import StarknetState
+from utils.fast_signature import verify_fast
+from utils.merkle_utils import HashOnElements, get_hash_backend
+from utils.plugin_signer import QUERY_VERSION, TRANSACTION_VERSION
+from utils.session_keys_utils import POLICY_TYPE_HASH, MULTIPROOF_FLAGS_PER_FELT, Session, get_session_hash
+
+# bound of the Cairo range checks, assert_nn(x) requires 0 <= x < RANGE_CHECK_BOUND
+RANGE_CHECK_BOUND = 2 ** 128
+# offset of the proofs in the signature of a session transaction
+PROOFS_OFFSET = 8
+# Only returned by the preflight checks: the calldata of __validate__ is rejected while its arguments are decoded,
+# before the account code runs, and the transaction fails without an error message
+INVALID_CALLDATA = "Preflight: malformed calldata"
+
+
+# The account and SessionKey storage the checks depend on, read once and shared by every transaction checked
+@dataclass
+class SessionKeyView:
+    account_address: int
+    chain_id: int
+    block_timestamp: int
+    session_epoch: int
+    # plugins registered on the account
+    plugins: Set[int]
+    # public key of each registered StarkSigner plugin, used to check the session tokens
+    stark_signer_keys: Dict[int, int] = field(default_factory=dict)
+    revoked_keys: Set[int] = field(default_factory=set)
+    session_cache_enabled: bool = False
+    approved_sessions: Set[int] = field(default_factory=set)
+
+    # reads the values for the given sessions and StarkSigner plugins from the state of the account
+    @classmethod
+    async def load(cls, state: StarknetState, account_address: int, plugins: Iterable[int], stark_signer_plugins: Iterable[int], sessions: Iterable[Session]) -> 'SessionKeyView':
+        async def read(var_name: str, *args) -> int:
+            return await state.state.get_storage_at(account_address, get_storage_var_address(var_name, *args))
+
+        chain_id = state.general_config.chain_id.value
+        session_epoch = await read('SessionKey_session_epoch')
+        registered_plugins = {plugin for plugin in plugins if await read('PluginAccount_plugins', plugin)}
+        view = cls(
+            account_address=account_address,
+            chain_id=chain_id,
+            block_timestamp=state.state.block_info.block_timestamp,
+            session_epoch=session_epoch,
+            plugins=registered_plugins,
+            session_cache_enabled=await read('SessionKey_session_cache_enabled') == 1,
+        )
+        for plugin in stark_signer_plugins:
+            if plugin in registered_plugins:
+                # the StarkSigner storage is in the account, like the storage of every plugin
+                view.stark_signer_keys[plugin] = await read('StarkSigner_public_key')
+        for session in sessions:
+            if await read('SessionKey_revoked_keys', session.session_public_key):
+                view.revoked_keys.add(session.session_public_key)
+            session_hash = get_session_hash(
+                session.session_public_key, session.session_expiration, session.root, session_epoch, chain_id, account_address
+            )
+            approval = hash_session_approval(session_hash, session.session_token)
+            if view.session_cache_enabled and await read('SessionKey_approved_sessions', approval):
+                view.approved_sessions.add(approval)
+        return view
+
+
+# Repeats the checks of PluginAccount.__validate__ and SessionKey.validate on a transaction signed by a SessionPluginSigner,
+# without a state or a Cairo run. Returns the error message the contract would revert with, INVALID_CALLDATA when it fails
+# without one, None when the transaction is valid.
+# session_tokens caches the session tokens already checked, it can be shared by the transactions of a batch
+def verify_session_transaction(view: SessionKeyView, signed_tx: InvokeFunction, session_tokens: Optional[Dict[Tuple[int, ...], bool]] = None) -> Optional[str]:
+    signature = signed_tx.signature
+    call_array = get_call_array(signed_tx.calldata)
+    if call_array is None:
+        return INVALID_CALLDATA
+    # same as PluginAccount.assert_correct_tx_version
+    if signed_tx.version not in (TRANSACTION_VERSION, QUERY_VERSION):
+        return "PluginAccount: invalid tx version"
+    if len(signature) == 0:
+        return "PluginAccount: invalid signature"
+    if signature[0] not in view.plugins:
+        return "PluginAccount: unregistered plugin"
+
+    if len(signature) < PROOFS_OFFSET:
+        return "SessionKey: invalid plugin data"
+    sig_r, sig_s, session_key, session_expires, root, proof_len, proofs_len = signature[1:PROOFS_OFFSET]
+    session_token_offset = PROOFS_OFFSET + proofs_len
+    if session_token_offset >= len(signature):
+        return "SessionKey: invalid plugin data"
+    session_token_len = signature[session_token_offset]
+    session_token = signature[session_token_offset + 1:]
+
+    if proof_len == 0:
+        if not is_nn(proofs_len):
+            return "SessionKey: invalid proof len"
+    elif proofs_len != len(call_array) * proof_len % DEFAULT_PRIME:
+        return "SessionKey: invalid proof len"
+
+    if len(signature) != session_token_offset + 1 + session_token_len:
+        return "SessionKey: invalid signature length"
+
+    if not is_nn(session_expires - view.block_timestamp):
+        return "SessionKey: session expired"
+
+    session_hash = get_session_hash(session_key, session_expires, root, view.session_epoch, view.chain_id, view.account_address)
+    if not view.session_cache_enabled or hash_session_approval(session_hash, session_token) not in view.approved_sessions:
+        token_key = (session_hash, *session_token)
+        if session_tokens is None or token_key not in session_tokens:
+            is_authorised = verify_session_token(view, session_hash, session_token)
+            if session_tokens is not None:
+                session_tokens[token_key] = is_authorised
+        else:
+            is_authorised = session_tokens[token_key]
+        if not is_authorised:
+            return "SessionKey: unauthorised session"
+
+    if session_key in view.revoked_keys:
+        return "SessionKey: session key revoked"
+
+    transaction_hash = get_transaction_hash(view, signed_tx)
+    if not verify_fast(transaction_hash, sig_r, sig_s, session_key):
+        return "SessionKey: invalid signature"
+
+    proofs = signature[PROOFS_OFFSET:]
+    if proof_len == 0:
+        return check_policy_multiproof(call_array, root, proofs_len, proofs)
+    return check_policy(call_array, root, proof_len, proofs)
+
+
+# checks the transactions of a batch, the session tokens are only verified once per session
+def verify_session_transactions(view: SessionKeyView, signed_txs: List[InvokeFunction]) -> List[Optional[str]]:
+    session_tokens = {}
+    return [verify_session_transaction(view, signed_tx, session_tokens) for signed_tx in signed_txs]
+
+
+# same as the isValidSignature call of SessionKey.assert_valid_session_token.
+# Only the StarkSigner tokens are checked, the other plugins are assumed to accept the token
+def verify_session_token(view: SessionKeyView, session_hash: int, session_token: List[int]) -> bool:
+    if len(session_token) == 0 or session_token[0] not in view.plugins:
+        return False
+    public_key = view.stark_signer_keys.get(session_token[0])
+    if public_key is None:
+        return True
+    return len(session_token) == 3 and verify_fast(session_hash, session_token[1], session_token[2], public_key)
+
+
+# same as SessionKey.hash_session_approval
+def hash_session_approval(session_hash: int, session_token: List[int]) -> int:
+    return HashOnElements([session_hash, *session_token]).finalize()
+
+
+def get_transaction_hash(view: SessionKeyView, signed_tx: InvokeFunction) -> int:
+    return calculate_transaction_hash_common(
+        tx_hash_prefix=TransactionHashPrefix.INVOKE,
+        version=signed_tx.version,
+        contract_address=signed_tx.contract_address,
+        entry_point_selector=0,
+        calldata=signed_tx.calldata,
+        max_fee=signed_tx.max_fee,
+        chain_id=view.chain_id,
+        additional_data=[signed_tx.nonce],
+        hash_function=get_hash_backend().hash,
+    )
+
+
+# returns the (to, selector) of each call of the __execute__ calldata, None when the calldata is malformed
+def get_call_array(calldata: List[int]) -> Optional[List[Tuple[int, int]]]:
+    if len(calldata) == 0:
+        return None
+    call_array_len = calldata[0]
+    if len(calldata) < 2 + 4 * call_array_len or len(calldata) != 2 + 4 * call_array_len + calldata[1 + 4 * call_array_len]:
+        return None
+    return [(calldata[1 + 4 * index], calldata[2 + 4 * index]) for index in range(call_array_len)]
+
+
+# same as SessionKey.check_policy
+def check_policy(call_array: List[Tuple[int, int]], root: int, proof_len: int, proofs: List[int]) -> Optional[str]:
+    for index, (to, selector) in enumerate(call_array):
+        node = get_hash_backend().hash_array([POLICY_TYPE_HASH, to, selector])
+        for proof_elem in proofs[index * proof_len:(index + 1) * proof_len]:
+            node = hash_sorted(node, proof_elem)
+        if node != root:
+            return "SessionKey: not allowed by policy"
+    return None
+
+
+# same as SessionKey.check_policy_multiproof, the multiproof may extend into the session token like in the Cairo memory
+def check_policy_multiproof(call_array: List[Tuple[int, int]], root: int, multiproof_len: int, multiproof: List[int]) -> Optional[str]:
+    if len(call_array) == 0:
+        return None
+
+    call_leaves_offset = 1 + (multiproof[0] if multiproof else 0)
+    proof_len_offset = call_leaves_offset + len(call_array)
+    if proof_len_offset >= len(multiproof) or not is_nn(multiproof[0]):
+        return "SessionKey: invalid multiproof"
+    leaves_len = multiproof[0]
+    proof_len = multiproof[proof_len_offset]
+    flags_len_offset = proof_len_offset + 1 + proof_len
+    if not is_nn(proof_len) or flags_len_offset >= len(multiproof) or not is_nn(multiproof[flags_len_offset]):
+        return "SessionKey: invalid multiproof"
+    flags_len = multiproof[flags_len_offset]
+    if multiproof_len != leaves_len + len(call_array) + proof_len + flags_len + 3 or not is_nn(leaves_len + proof_len - 2):
+        return "SessionKey: invalid multiproof"
+
+    leaves = multiproof[1:call_leaves_offset]
+    call_leaves = multiproof[call_leaves_offset:proof_len_offset]
+    proof = multiproof[proof_len_offset + 1:flags_len_offset]
+    flags = multiproof[flags_len_offset + 1:flags_len_offset + 1 + flags_len]
+
+    for (to, selector), leaf_index in zip(call_array, call_leaves):
+        if leaf_index >= leaves_len or leaves[leaf_index] != get_hash_backend().hash_array([POLICY_TYPE_HASH, to, selector]):
+            return "SessionKey: not allowed by policy"
+    if calc_multiproof_root(leaves, proof, flags) != root:
+        return "SessionKey: not allowed by policy"
+    return None
+
+
+# same as SessionKey.calc_multiproof_root, returns None where the contract reverts
+def calc_multiproof_root(leaves: List[int], proof: List[int], flags: List[int]) -> Optional[int]:
+    hashes_len = len(leaves) + len(proof) - 1
+    # flags are packed from the least significant bit, the Cairo code takes MULTIPROOF_FLAGS_PER_FELT flags per felt
+    flag_bits = [(word >> bit) & 1 for word in flags for bit in range(MULTIPROOF_FLAGS_PER_FELT)]
+    if len(flag_bits) < hashes_len:
+        return None
+
+    # the leaves then the computed hashes
+    queue = list(leaves)
+    queue_read = 0
+    proof_read = 0
+    for flag in flag_bits[:hashes_len]:
+        if queue_read + 1 + flag > len(queue) or (not flag and proof_read == len(proof)):
+            return None
+        a = queue[queue_read]
+        if flag:
+            b = queue[queue_read + 1]
+        else:
+            b = proof[proof_read]
+            proof_read += 1
+        queue_read += 1 + flag
+        queue.append(hash_sorted(a, b))
+
+    # every leaf and proof node must have been used
+    if queue_read < len(leaves) or proof_read != len(proof):
+        return None
+    return queue[-1]
+
+
+# hashes a pair in the order of is_le_felt
+def hash_sorted(a: int, b: int) -> int:
+    return get_hash_backend().hash(a, b) if a <= b else get_hash_backend().hash(b, a)
+
+
+def is_nn(value: int) -> bool:
+    return value % DEFAULT_PRIME < RANGE_CHECK_BOUND
@@ -0,0 +1,129 @@
+import contextlib
+import dataclasses
+import json
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional
+from starkware.starknet.business_logic.execution.objects import CallInfo, TransactionExecutionInfo
+from starkware.starknet.services.api.gateway.transaction import InvokeFunction
+
+
+# Cairo resources used by a phase of a transaction, including the calls it makes
+@dataclass
+class PhaseResources:
+    n_steps: int = 0
+    n_memory_holes: int = 0
+    pedersen: int = 0
+    range_check: int = 0
+    ecdsa: int = 0
+    bitwise: int = 0
+
+    @classmethod
+    def from_call_info(cls, call_info: Optional[CallInfo]) -> 'PhaseResources':
+        if call_info is None:
+            return cls()
+        resources = call_info.execution_resources
+        builtins = resources.builtin_instance_counter
+        return cls(
+            n_steps=resources.n_steps,
+            n_memory_holes=resources.n_memory_holes,
+            pedersen=builtins.get('pedersen_builtin', 0),
+            range_check=builtins.get('range_check_builtin', 0),
+            ecdsa=builtins.get('ecdsa_builtin', 0),
+            bitwise=builtins.get('bitwise_builtin', 0),
+        )
+
+
+@dataclass
+class ResourceRecord:
+    label: Optional[str]
+    plugin_class_hash: int
+    n_calls: int
+    signature_len: int
+    validate: PhaseResources
+    execute: PhaseResources
+    # the l1 gas and the total steps, including the OS overhead, are only known for the whole transaction
+    n_steps: int
+    l1_gas_usage: int
+    actual_fee: int
+
+    def to_json(self) -> str:
+        return json.dumps(dataclasses.asdict(self), sort_keys=True)
+
+    @classmethod
+    def from_json(cls, text: str) -> 'ResourceRecord':
+        values = json.loads(text)
+        values['validate'] = PhaseResources(**values['validate'])
+        values['execute'] = PhaseResources(**values['execute'])
+        return cls(**values)
+
+
+# Records the resources of the transactions executed by the PluginSigners it's attached to,
+# the records are labelled with the scenario that sent them
+class ResourceRecorder:
+    def __init__(self):
+        self.records: List[ResourceRecord] = []
+        self.label: Optional[str] = None
+
+    @contextlib.contextmanager
+    def labelled(self, label: str) -> Iterator['ResourceRecorder']:
+        previous_label = self.label
+        self.label = label
+        try:
+            yield self
+        finally:
+            self.label = previous_label
+
+    def record(self, signed_tx: InvokeFunction, execution_info: TransactionExecutionInfo) -> ResourceRecord:
+        resource_record = ResourceRecord(
+            label=self.label,
+            plugin_class_hash=signed_tx.signature[0],
+            n_calls=signed_tx.calldata[0],
+            signature_len=len(signed_tx.signature),
+            validate=PhaseResources.from_call_info(execution_info.validate_info),
+            execute=PhaseResources.from_call_info(execution_info.call_info),
+            n_steps=execution_info.actual_resources.get('n_steps', 0),
+            l1_gas_usage=execution_info.actual_resources.get('l1_gas_usage', 0),
+            actual_fee=execution_info.actual_fee,
+        )
+        self.records.append(resource_record)
+        return resource_record
+
+
+# one JSON record per line with sorted keys, the files can be diffed between commits
+def write_resource_records(path: str, records: List[ResourceRecord]):
+    with open(path, 'w') as records_file:
+        for resource_record in records:
+            records_file.write(resource_record.to_json() + '\n')
+
+
+def read_resource_records(path: str) -> List[ResourceRecord]:
+    with open(path) as records_file:
+        return [ResourceRecord.from_json(line) for line in records_file if line.strip()]
+
+
+# Returns a description of each value of records that grew by more than tolerance from the baseline record with the same label,
+# the labels missing from either side are not compared
+def compare_resource_records(baseline: List[ResourceRecord], records: List[ResourceRecord], tolerance: float = 0.05) -> List[str]:
+    baseline_by_label = {resource_record.label: resource_record for resource_record in baseline}
+    regressions = []
+    for resource_record in records:
+        baseline_record = baseline_by_label.get(resource_record.label)
+        if baseline_record is None:
+            continue
+        values = flatten_resource_record(resource_record)
+        for name, baseline_value in flatten_resource_record(baseline_record).items():
+            if values[name] > baseline_value * (1 + tolerance):
+                regressions.append(f"{resource_record.label}: {name} {baseline_value} -> {values[name]}")
+    return regressions
+
+
+def flatten_resource_record(resource_record: ResourceRecord) -> Dict[str, int]:
+    values = {
+        'signature_len': resource_record.signature_len,
+        'n_steps': resource_record.n_steps,
+        'l1_gas_usage': resource_record.l1_gas_usage,
+    }
+    for phase in ['validate', 'execute']:
+        for name, value in dataclasses.asdict(getattr(resource_record, phase)).items():
+            values[f"{phase}.{name}"] = value
+    return values
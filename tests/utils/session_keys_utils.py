@@ -1,11 +1,13 @@
 from starkware.cairo.common.hash_state import compute_hash_on_elements
-from typing import Optional, List, Tuple
-from utils.merkle_utils import get_leaves, generate_merkle_root, generate_merkle_proof
+from typing import Dict, Optional, List, Tuple
+from utils.merkle_utils import get_leaves, generate_merkle_tree, get_merkle_proofs, generate_merkle_multiproof, get_hash_backend, HashOnElements, PolicyTree
 from starkware.starknet.compiler.compile import get_selector_from_name
 from utils.utils import str_to_felt
 from utils.plugin_signer import PluginSigner, TRANSACTION_VERSION
-from dataclasses import dataclass
-from utils.utils import from_call_to_call_array, copy_contract_state, StarkKeyPair
+from dataclasses import dataclass, field
+from concurrent.futures import Executor
+from functools import lru_cache
+from utils.utils import get_execute_calldata, StarkKeyPair
 from starkware.starknet.testing.contract import StarknetContract
 from starkware.starknet.core.os.transaction_hash.transaction_hash import calculate_transaction_hash_common, TransactionHashPrefix
 from starkware.starknet.business_logic.transaction.objects import InternalTransaction, TransactionExecutionInfo
@@ -15,10 +17,12 @@ from starkware.starknet.services.api.gateway.transaction import InvokeFunction,
 AllowedCall = Tuple[int,str]
 # H('StarkNetDomain(chainId:felt)')
 STARKNET_DOMAIN_TYPE_HASH = 0x13cda234a04d66db62c06b8e3ad5f91bd0c67286c2c7519a826cf49da6ba478
-# H('Session(key:felt,expires:felt,root:merkletree)')
-SESSION_TYPE_HASH = 0x1aa0e1c56b45cf06a54534fa1707c54e520b842feb21d03b7deddb6f1e340c
+# H('Session(key:felt,expires:felt,root:merkletree,epoch:felt)')
+SESSION_TYPE_HASH = 0x2fa688a35c92dba531f29f73757285d5dabd7edb99bb2ce7ac2b00a0831a46b
 # H(Policy(contractAddress:felt,selector:selector))
 POLICY_TYPE_HASH = 0x2f0026e78543f036f33e26a8f5891b88c58dc1e20cbbfaf0bb53274da6fa568
+# number of multiproof flags packed in a single felt
+MULTIPROOF_FLAGS_PER_FELT = 128
 
 
 # Returns the tree root and proofs for each allowed call
@@ -29,11 +33,21 @@ def generate_policy_tree(allowed_calls : List[AllowedCall]) -> Tuple[int, List[L
         selectors=[get_selector_from_name(a[1]) for a in allowed_calls],
     )
     leaves = [leave[0] for leave in merkle_leaves]
-    root = generate_merkle_root(leaves)
-    proofs = [generate_merkle_proof(leaves, index) for index, leave in enumerate(leaves)]
+    levels = generate_merkle_tree(leaves)
+    root = levels[-1][0]
+    proofs = get_merkle_proofs(levels)
     return root, proofs
 
 
+# Returns an editable policy tree, edits only re-hash the affected paths
+def build_policy_tree(allowed_calls : List[AllowedCall]) -> PolicyTree:
+    return PolicyTree(
+        policy_type_hash=POLICY_TYPE_HASH,
+        contracts=[a[0] for a in allowed_calls],
+        selectors=[get_selector_from_name(a[1]) for a in allowed_calls],
+    )
+
+
 @dataclass
 class Session:
     session_public_key: int
@@ -44,22 +58,37 @@ class Session:
     session_hash: int
     account_address: int
     session_token: List[int]
+    session_epoch: int = 0
+    # index of the first proof of each allowed call
+    call_indexes: Dict[AllowedCall, int] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.call_indexes = {}
+        for index, allowed_call in enumerate(self.allowed_calls):
+            self.call_indexes.setdefault(allowed_call, index)
 
     def single_proof_len(self) -> int:
         return len(self.proofs[0])
 
+    def get_proof(self, contract: int, selector_name: str) -> List[int]:
+        index = self.call_indexes.get((contract, selector_name))
+        if index is None:
+            raise ValueError(f"{(contract, selector_name)} is not an allowed call")
+        return self.proofs[index]
 
-def build_session(signer, allowed_calls: List[AllowedCall], session_public_key: int, session_expiration:int, chain_id:int, account_address: int):
-    root, proofs = generate_policy_tree(allowed_calls)
-    domain_hash = compute_hash_on_elements([STARKNET_DOMAIN_TYPE_HASH, chain_id])
-    message_hash = compute_hash_on_elements([SESSION_TYPE_HASH, session_public_key, session_expiration, root])
 
-    session_hash = compute_hash_on_elements([
-        str_to_felt('StarkNet Message'),
-        domain_hash,
-        account_address,
-        message_hash
-    ])
+def build_session(signer, allowed_calls: List[AllowedCall], session_public_key: int, session_expiration:int, chain_id:int, account_address: int, policy_tree: Optional[PolicyTree] = None, session_epoch: int = 0):
+    if policy_tree is None:
+        root, proofs = generate_policy_tree(allowed_calls)
+    else:
+        root = policy_tree.root
+        proofs = [policy_tree.get_proof(a[0], get_selector_from_name(a[1])) for a in allowed_calls]
+    return sign_session(signer, allowed_calls, root, proofs, session_public_key, session_expiration, chain_id, account_address, session_epoch)
+
+
+# Same as build_session with the root and proofs of the policy tree already computed
+def sign_session(signer, allowed_calls: List[AllowedCall], root: int, proofs: List[List[int]], session_public_key: int, session_expiration: int, chain_id: int, account_address: int, session_epoch: int = 0):
+    session_hash = get_session_hash(session_public_key, session_expiration, root, session_epoch, chain_id, account_address)
     signed_hash = signer.sign(session_hash)
     return Session(
         session_public_key=session_public_key,
@@ -69,10 +98,62 @@ def build_session(signer, allowed_calls: List[AllowedCall], session_public_key:
         proofs=proofs,
         session_hash=session_hash,
         account_address=account_address,
-        session_token=signed_hash
+        session_token=signed_hash,
+        session_epoch=session_epoch
     )
 
 
+# same as SessionKey.compute_session_hash
+def get_session_hash(session_public_key: int, session_expiration: int, root: int, session_epoch: int, chain_id: int, account_address: int) -> int:
+    message_hash = get_hash_backend().hash_array([SESSION_TYPE_HASH, session_public_key, session_expiration, root, session_epoch])
+    return get_session_hash_prefix(chain_id, account_address).update([message_hash]).finalize()
+
+
+# the message, domain and account part of the session hashes
+def get_session_hash_prefix(chain_id: int, account_address: int) -> HashOnElements:
+    return HashOnElements.from_state(get_session_hash_prefix_state(chain_id, account_address))
+
+
+# cached as the immutable state of the hash, every caller of get_session_hash_prefix gets its own HashOnElements
+@lru_cache(maxsize=1024)
+def get_session_hash_prefix_state(chain_id: int, account_address: int) -> Tuple[int, int]:
+    domain_hash = get_hash_backend().hash_array([STARKNET_DOMAIN_TYPE_HASH, chain_id])
+    return HashOnElements([str_to_felt('StarkNet Message'), domain_hash, account_address]).state
+
+
+# Returns the proof of each call
+def get_call_proofs(session: Session, calls) -> List[List[int]]:
+    return [session.get_proof(call[0], call[1]) for call in calls]
+
+
+# Returns a single multiproof for all the calls, in the layout expected by SessionKey.check_policy_multiproof
+def build_multiproof(session: Session, calls) -> List[int]:
+    leaves = []
+    proofs = []
+    call_leaves = []
+    for call in calls:
+        leaf = get_hash_backend().hash_array([POLICY_TYPE_HASH, call[0], get_selector_from_name(call[1])])
+        if leaf not in leaves:
+            leaves.append(leaf)
+            proofs.append(session.get_proof(call[0], call[1]))
+        call_leaves.append(leaf)
+
+    ordered_leaves, proof, flags = generate_merkle_multiproof(leaves, proofs)
+    packed_flags = [
+        sum(flag << bit for bit, flag in enumerate(flags[i:i + MULTIPROOF_FLAGS_PER_FELT]))
+        for i in range(0, len(flags), MULTIPROOF_FLAGS_PER_FELT)
+    ]
+    return [
+        len(ordered_leaves),
+        *ordered_leaves,
+        *[ordered_leaves.index(leaf) for leaf in call_leaves],
+        len(proof),
+        *proof,
+        len(packed_flags),
+        *packed_flags
+    ]
+
+
 class SessionPluginSigner(PluginSigner):
     def __init__(self, stark_key: StarkKeyPair, account: StarknetContract, plugin_class_hash):
         super().__init__(account, plugin_class_hash)
@@ -83,58 +164,61 @@ class SessionPluginSigner(PluginSigner):
         raise Exception("SessionPluginSigner can't sign arbitrary messages")
 
     async def get_signed_transaction(self, calls, session: Session, nonce: Optional[int] = None, max_fee: Optional[int] = 0) -> InvokeFunction:
-        proofs = []
-        for call in calls:
-            call_proof_index = session.allowed_calls.index((call[0], call[1]))
-            proofs.append(session.proofs[call_proof_index])
+        with self.timed('proofs'):
+            proofs = get_call_proofs(session, calls)
         return await self.get_signed_transaction_with_proofs(calls, session, proofs, nonce, max_fee)
 
+    async def get_signed_transactions(self, calls_list, session: Session, max_fee: Optional[int] = 0, executor: Optional[Executor] = None) -> List[InvokeFunction]:
+        nonces = await self.nonce_manager.reserve(len(calls_list))
+        calldatas = [get_execute_calldata(calls) for calls in calls_list]
+        transaction_hashes = [self.get_transaction_hash(calldata, nonce, max_fee) for calldata, nonce in zip(calldatas, nonces)]
+        session_signatures = self.stark_key.sign_many(transaction_hashes, executor)
+        signed_txs = []
+        for calls, calldata, session_signature, nonce in zip(calls_list, calldatas, session_signatures, nonces):
+            proofs_flat = [item for proof in get_call_proofs(session, calls) for item in proof]
+            signature = self.get_session_signature(session_signature, session, session.single_proof_len(), proofs_flat)
+            signed_txs.append(self.build_transaction(calldata, signature, nonce, max_fee))
+        return signed_txs
+
     async def get_signed_transaction_with_proofs(self, calls, session: Session, proofs: List[List[int]], nonce: Optional[int] = None, max_fee: Optional[int] = 0) -> InvokeFunction:
-        call_array, calldata = from_call_to_call_array(calls)
+        proofs_flat = [item for proof in proofs for item in proof]
+        return await self.get_signed_session_transaction(calls, session, session.single_proof_len(), proofs_flat, nonce, max_fee)
 
-        account_copy = copy_contract_state(self.account)
+    async def get_signed_transaction_with_multiproof(self, calls, session: Session, nonce: Optional[int] = None, max_fee: Optional[int] = 0) -> InvokeFunction:
+        with self.timed('proofs'):
+            multiproof = build_multiproof(session, calls)
+        # a single_proof_len of 0 tells the plugin the proofs are a multiproof
+        return await self.get_signed_session_transaction(calls, session, 0, multiproof, nonce, max_fee)
 
-        raw_invocation = account_copy.__execute__(call_array, calldata)
+    async def get_signed_session_transaction(self, calls, session: Session, single_proof_len: int, proofs: List[int], nonce: Optional[int] = None, max_fee: Optional[int] = 0) -> InvokeFunction:
+        with self.timed('calldata'):
+            calldata = get_execute_calldata(calls)
 
         if nonce is None:
-            nonce = await raw_invocation.state.state.get_nonce_at(contract_address=account_copy.contract_address)
-
-        transaction_hash = calculate_transaction_hash_common(
-            tx_hash_prefix=TransactionHashPrefix.INVOKE,
-            version=TRANSACTION_VERSION,
-            contract_address=self.account.contract_address,
-            entry_point_selector=0,
-            calldata=raw_invocation.calldata,
-            max_fee=max_fee,
-            chain_id=StarknetChainId.TESTNET.value,
-            additional_data=[nonce],
-        )
-
-        session_signature = self.stark_key.sign(transaction_hash)
-        proofs_flat = [item for proof in proofs for item in proof]
-        signature = [
+            with self.timed('nonce'):
+                nonce = await self.nonce_manager.next()
+
+        with self.timed('hash'):
+            transaction_hash = self.get_transaction_hash(calldata, nonce, max_fee)
+        with self.timed('sign'):
+            session_signature = self.stark_key.sign(transaction_hash)
+        signature = self.get_session_signature(session_signature, session, single_proof_len, proofs)
+        return self.build_transaction(calldata, signature, nonce, max_fee)
+
+    def get_session_signature(self, session_signature: Tuple[int, int], session: Session, single_proof_len: int, proofs: List[int]) -> List[int]:
+        return [
             self.plugin_class_hash,
             *session_signature,          # session signature
             session.session_public_key,  # session_key
             session.session_expiration,  # expiration
             session.root,                # root
-            session.single_proof_len(),  # single_proof_len
-            len(proofs_flat),            # proofs_len
-            *proofs_flat,                # proofs
+            single_proof_len,            # single_proof_len
+            len(proofs),                 # proofs_len
+            *proofs,                     # proofs
             len(session.session_token),  # session_token_len
             *session.session_token       # session_token
         ]
 
-        return InvokeFunction(
-            contract_address=self.account.contract_address,
-            calldata=raw_invocation.calldata,
-            entry_point_selector=None,
-            signature=signature,
-            max_fee=max_fee,
-            version=TRANSACTION_VERSION,
-            nonce=nonce,
-        )
-
     async def send_transaction(self, calls, session: Session, nonce: Optional[int] = None, max_fee: Optional[int] = 0) -> TransactionExecutionInfo:
         signed_tx = await self.get_signed_transaction(calls, session, nonce, max_fee)
         return await self.send_signed_tx(signed_tx)
@@ -143,10 +227,6 @@ class SessionPluginSigner(PluginSigner):
         signed_tx = await self.get_signed_transaction_with_proofs(calls, session, proofs, nonce, max_fee)
         return await self.send_signed_tx(signed_tx)
 
-    async def send_signed_tx(self, signed_tx: InvokeFunction) -> TransactionExecutionInfo:
-        return await self.account.state.execute_tx(
-            tx=InternalTransaction.from_external(
-                external_tx=signed_tx,
-                general_config=self.account.state.general_config
-            )
-        )
+    async def send_transaction_with_multiproof(self, calls, session: Session, nonce: Optional[int] = None, max_fee: Optional[int] = 0) -> TransactionExecutionInfo:
+        signed_tx = await self.get_signed_transaction_with_multiproof(calls, session, nonce, max_fee)
+        return await self.send_signed_tx(signed_tx)
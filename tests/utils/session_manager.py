@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor
+from typing import Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+from starkware.starknet.compiler.compile import get_selector_from_name
+from utils.merkle_utils import PolicyTree
+from utils.plugin_signer import PluginSigner
+from utils.session_keys_utils import AllowedCall, Session, sign_session
+
+LOGGER = logging.getLogger(__name__)
+
+# (account address, session public key, policy root, allowed calls)
+SessionCacheKey = Tuple[int, int, int, FrozenSet[AllowedCall]]
+
+
+# Caches the sessions authorised by the owner of an account, so a session is only built and signed again when it's about to expire.
+# Sessions are evicted once expired and, beyond max_sessions, least recently used first.
+# A timer starts building the replacement of a session renewal_margin seconds before it expires, if get_session returned it
+# since it was built, and get_session keeps returning the current session meanwhile. The sessions not used are left to expire.
+# Only a missing or expired session makes get_session wait for it to be built
+class SessionManager:
+    def __init__(
+        self,
+        signer: PluginSigner,
+        chain_id: int,
+        session_duration: int,
+        renewal_margin: int,
+        max_sessions: int = 128,
+        session_epoch: int = 0,
+        clock: Optional[Callable[[], int]] = None,
+        executor: Optional[Executor] = None,
+    ):
+        assert renewal_margin < session_duration, "The sessions would be renewed as soon as they are built"
+        self.signer = signer
+        self.chain_id = chain_id
+        self.session_duration = session_duration
+        self.renewal_margin = renewal_margin
+        self.max_sessions = max_sessions
+        self.session_epoch = session_epoch
+        # current timestamp, compared to the session expirations like the block timestamp in SessionKey.validate
+        self.clock = clock if clock is not None else lambda: int(time.time())
+        # runs sign_session, the default executor of the loop when None
+        self.executor = executor
+        self.sessions: 'OrderedDict[SessionCacheKey, Session]' = OrderedDict()
+        self.renewals: Dict[SessionCacheKey, asyncio.Task] = {}
+        self.renewal_timers: Dict[SessionCacheKey, asyncio.TimerHandle] = {}
+        # the sessions returned by get_session since they were built
+        self.used: Set[SessionCacheKey] = set()
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    async def get_session(self, session_public_key: int, allowed_calls: List[AllowedCall], policy_tree: PolicyTree) -> Session:
+        now = self.clock()
+        self.evict_expired(now)
+        key = (self.signer.account.contract_address, session_public_key, policy_tree.root, frozenset(allowed_calls))
+        session = self.sessions.get(key)
+        if session is None:
+            # the proofs are read now, the tree may be edited while the session is signed
+            proofs = [policy_tree.get_proof(contract, get_selector_from_name(selector_name)) for contract, selector_name in allowed_calls]
+            return await self.renew(key, list(allowed_calls), proofs)
+        self.sessions.move_to_end(key)
+        self.used.add(key)
+        if session.session_expiration - now <= self.renewal_margin:
+            # the renewal timer hasn't fired yet, e.g. with a clock ahead of the loop time
+            self.renew(key, session.allowed_calls, session.proofs)
+        return session
+
+    # starts building a new session for key, unless one is already being built
+    def renew(self, key: SessionCacheKey, allowed_calls: List[AllowedCall], proofs: List[List[int]]) -> asyncio.Task:
+        renewal = self.renewals.get(key)
+        if renewal is None:
+            renewal = asyncio.ensure_future(self.build(key, allowed_calls, proofs))
+            renewal.add_done_callback(lambda task: self.on_renewal_done(key, task))
+            self.renewals[key] = renewal
+        return renewal
+
+    def on_renewal_done(self, key: SessionCacheKey, renewal: asyncio.Task):
+        if self.renewals.get(key) is renewal:
+            del self.renewals[key]
+        # retrieving the exception also keeps asyncio from reporting it again when the task is collected
+        if not renewal.cancelled() and renewal.exception() is not None:
+            LOGGER.warning(f"Renewal of the session of key {hex(key[1])} failed", exc_info=renewal.exception())
+
+    async def build(self, key: SessionCacheKey, allowed_calls: List[AllowedCall], proofs: List[List[int]]) -> Session:
+        account_address, session_public_key, root, _ = key
+        session_epoch = self.session_epoch
+        session = await asyncio.get_running_loop().run_in_executor(
+            self.executor,
+            lambda: sign_session(
+                signer=self.signer,
+                allowed_calls=allowed_calls,
+                root=root,
+                proofs=proofs,
+                session_public_key=session_public_key,
+                session_expiration=self.clock() + self.session_duration,
+                chain_id=self.chain_id,
+                account_address=account_address,
+                session_epoch=session_epoch,
+            )
+        )
+        if session_epoch != self.session_epoch:
+            # the sessions were revoked while this one was built
+            return session
+        self.store(key, session)
+        return session
+
+    def store(self, key: SessionCacheKey, session: Session):
+        self.remove(key)
+        self.sessions[key] = session
+        loop = asyncio.get_running_loop()
+        renewal_delay = max(session.session_expiration - self.renewal_margin - self.clock(), 0)
+        self.renewal_timers[key] = loop.call_at(loop.time() + renewal_delay, self.on_renewal_due, key)
+        while len(self.sessions) > self.max_sessions:
+            self.remove(next(iter(self.sessions)))
+
+    def on_renewal_due(self, key: SessionCacheKey):
+        del self.renewal_timers[key]
+        if key in self.used:
+            session = self.sessions[key]
+            self.renew(key, session.allowed_calls, session.proofs)
+
+    # drops a session and its renewal timer, a renewal already started still stores its session
+    def remove(self, key: SessionCacheKey):
+        self.sessions.pop(key, None)
+        self.used.discard(key)
+        timer = self.renewal_timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+    def evict_expired(self, now: int):
+        # the contract accepts a session until its expiration timestamp included
+        for key in [key for key, session in self.sessions.items() if session.session_expiration < now]:
+            self.remove(key)
+
+    # drops every session, e.g. after revokeAllSessions with the new epoch
+    def clear(self, session_epoch: Optional[int] = None):
+        for key in list(self.sessions):
+            self.remove(key)
+        if session_epoch is not None:
+            self.session_epoch = session_epoch
+
+    # waits for the sessions being renewed
+    async def join(self):
+        await asyncio.gather(*self.renewals.values(), return_exceptions=True)
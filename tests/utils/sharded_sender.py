@@ -0,0 +1,68 @@
+from typing import AsyncIterator, Dict, Hashable, List, Optional, Tuple
+from utils.pipeline import Completion, Submission, SubmissionPipeline
+from utils.plugin_signer import PluginSigner
+
+
+# Spreads the calls over a pool of accounts so a single nonce doesn't serialize all the traffic.
+# The calls sharing a key are sent in order by the same account, the other calls go round-robin.
+# An account is backed up when max_backlog of its transactions are not completed: round-robin skips it, and its keys
+# move to the least loaded account once none of their calls are pending, so the calls of a key stay ordered.
+# The accounts share one pipeline, its executor can sign in worker processes.
+class ShardedSender:
+    def __init__(self, signers: List[PluginSigner], max_backlog: int = 4, pipeline: Optional[SubmissionPipeline] = None):
+        assert len(signers) > 0, "No account to send from"
+        self.signers = signers
+        self.max_backlog = max_backlog
+        self.pipeline = SubmissionPipeline(max_in_flight=len(signers) * max_backlog) if pipeline is None else pipeline
+        self.pipeline.listeners.append(self.on_complete)
+        self.backlogs = [0] * len(signers)
+        self.key_shards: Dict[Hashable, int] = {}
+        self.key_backlogs: Dict[Hashable, int] = {}
+        # id of the pending submissions -> (shard, key)
+        self.routes: Dict[int, Tuple[int, Optional[Hashable]]] = {}
+        self.next_shard = 0
+
+    async def send(self, calls, key: Optional[Hashable] = None, max_fee: int = 0) -> Submission:
+        shard = self.route(key)
+        submission = Submission(self.signers[shard], calls, max_fee=max_fee)
+        self.backlogs[shard] += 1
+        if key is not None:
+            self.key_backlogs[key] = self.key_backlogs.get(key, 0) + 1
+        self.routes[id(submission)] = (shard, key)
+        await self.pipeline.put(submission)
+        return submission
+
+    async def close(self):
+        await self.pipeline.close()
+
+    def completions(self) -> AsyncIterator[Completion]:
+        return self.pipeline.completions()
+
+    def route(self, key: Optional[Hashable] = None) -> int:
+        if key is None:
+            shard = next(
+                (shard for shard in self.round_robin() if self.backlogs[shard] < self.max_backlog),
+                self.least_loaded()
+            )
+            self.next_shard = (shard + 1) % len(self.signers)
+            return shard
+
+        shard = self.key_shards.get(key)
+        if shard is None or (self.backlogs[shard] >= self.max_backlog and key not in self.key_backlogs):
+            shard = self.least_loaded()
+            self.key_shards[key] = shard
+        return shard
+
+    def round_robin(self) -> List[int]:
+        return [(self.next_shard + offset) % len(self.signers) for offset in range(len(self.signers))]
+
+    def least_loaded(self) -> int:
+        return min(self.round_robin(), key=lambda shard: self.backlogs[shard])
+
+    def on_complete(self, completion: Completion):
+        shard, key = self.routes.pop(id(completion.submission))
+        self.backlogs[shard] -= 1
+        if key is not None:
+            self.key_backlogs[key] -= 1
+            if self.key_backlogs[key] == 0:
+                del self.key_backlogs[key]
@@ -0,0 +1,110 @@
+import ast
+import hashlib
+import importlib.util
+import inspect
+import json
+import os
+import pickle
+import re
+from types import ModuleType
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from starkware.cairo.lang.version import __version__ as cairo_lang_version
+from starkware.starknet.services.api.contract_class import ContractClass
+from starkware.starknet.testing.contract import StarknetContract
+from starkware.starknet.testing.starknet import Starknet
+from starkware.starknet.testing.state import StarknetState
+
+STATE_SNAPSHOT_DIR = os.environ.get('STATE_SNAPSHOT_DIR', os.path.normpath(os.path.join(os.path.dirname(__file__), '..', '.state_snapshots')))
+# the modules imported from this directory are part of the snapshot keys
+LOCAL_SOURCE_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), '..'))
+
+# builds the world on an empty network and returns the values needed to use it (addresses, class hashes)
+SnapshotSetup = Callable[[Starknet, List[ContractClass]], Awaitable[Dict[str, int]]]
+
+
+# Returns a network set up by setup, loaded from disk when a snapshot of the same setup exists.
+# The contract objects can't be pickled, only the state and the values returned by setup are stored,
+# use deployed_contract to rebuild the contracts
+async def load_state_snapshot(name: str, contract_classes: List[ContractClass], setup: SnapshotSetup) -> Tuple[Starknet, Dict[str, int]]:
+    snapshot_path = get_state_snapshot_path(name, contract_classes, setup)
+    if os.path.exists(snapshot_path):
+        with open(snapshot_path, 'rb') as snapshot_file:
+            state, values = pickle.load(snapshot_file)
+        return Starknet(state=state), values
+
+    starknet = await Starknet.empty()
+    values = await setup(starknet, contract_classes)
+    store_state_snapshot(name, snapshot_path, starknet.state, values)
+    return starknet, values
+
+
+# The snapshots are keyed by the compiled classes, the cairo-lang version, the source of the module defining setup and of the
+# local modules it imports: besides the setup code, the module constants it reads (e.g. the signer keys) and the helpers it
+# calls are part of the key. Helpers reached in other ways, e.g. from an installed package, are not tracked
+def get_state_snapshot_path(name: str, contract_classes: List[ContractClass], setup: SnapshotSetup) -> str:
+    key = hashlib.sha256(cairo_lang_version.encode())
+    for contract_class in contract_classes:
+        # the key order of ContractClass.dumps changes between processes
+        key.update(hashlib.sha256(json.dumps(contract_class.dump(), sort_keys=True).encode()).digest())
+    for dependency in get_python_dependencies(inspect.getmodule(setup)):
+        with open(dependency, 'rb') as source_file:
+            key.update(hashlib.sha256(source_file.read()).digest())
+    return os.path.join(STATE_SNAPSHOT_DIR, f"{name}-{key.hexdigest()}.pickle")
+
+
+# the source of the module and of the modules of LOCAL_SOURCE_DIR it imports, directly or not
+def get_python_dependencies(module: ModuleType) -> List[str]:
+    dependencies = []
+    pending = [os.path.normpath(inspect.getsourcefile(module))]
+    while pending:
+        current = pending.pop()
+        if current in dependencies:
+            continue
+        dependencies.append(current)
+        with open(current) as source_file:
+            tree = ast.parse(source_file.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                # the imported names may be submodules
+                names = [node.module, *[f"{node.module}.{alias.name}" for alias in node.names]]
+            else:
+                continue
+            for name in names:
+                path = get_module_path(name)
+                if path is not None and path.startswith(LOCAL_SOURCE_DIR + os.sep):
+                    pending.append(path)
+    return sorted(dependencies)
+
+
+def get_module_path(name: str) -> Optional[str]:
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or spec.origin is None or not os.path.isfile(spec.origin):
+        return None
+    return os.path.normpath(spec.origin)
+
+
+def store_state_snapshot(name: str, snapshot_path: str, state: StarknetState, values: Dict[str, int]):
+    os.makedirs(STATE_SNAPSHOT_DIR, exist_ok=True)
+    # evict the snapshots of older setups
+    for snapshot in os.listdir(STATE_SNAPSHOT_DIR):
+        if re.fullmatch(rf"{re.escape(name)}-[0-9a-f]{{64}}\.pickle", snapshot) and os.path.join(STATE_SNAPSHOT_DIR, snapshot) != snapshot_path:
+            os.remove(os.path.join(STATE_SNAPSHOT_DIR, snapshot))
+    # write then rename so concurrent test workers never read a partial file
+    tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as snapshot_file:
+        pickle.dump((state, values), snapshot_file)
+    os.replace(tmp_path, snapshot_path)
+
+
+def deployed_contract(state: StarknetState, contract_class: ContractClass, contract_address: int) -> StarknetContract:
+    return StarknetContract(
+        state=state,
+        abi=contract_class.abi,
+        contract_address=contract_address,
+        deploy_call_info=None
+    )
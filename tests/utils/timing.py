@@ -0,0 +1,60 @@
+import contextlib
+import json
+import math
+import time
+from abc import abstractmethod
+from collections import defaultdict
+from typing import ContextManager, Dict, Iterator, List
+
+PERCENTILES = [50, 95, 99]
+# entered when the timing is disabled, costs a single attribute check per stage
+NO_TIMING = contextlib.nullcontext()
+
+
+# Wraps each stage of the signing and sending of a transaction: calldata, proofs, nonce, hash, sign and execute
+class TimingHooks:
+    @abstractmethod
+    def stage(self, name: str) -> ContextManager:
+        ...
+
+
+# Keeps the duration of every stage in memory and reports their percentiles
+class HistogramCollector(TimingHooks):
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples[name].append(time.perf_counter() - start)
+
+    # count, percentiles and max of each stage, in seconds
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        summary = {}
+        for name, samples in self.samples.items():
+            ordered = sorted(samples)
+            stage_summary = {'count': len(ordered)}
+            for percentile in PERCENTILES:
+                stage_summary[f"p{percentile}"] = get_percentile(ordered, percentile)
+            stage_summary['max'] = ordered[-1]
+            summary[name] = stage_summary
+        return summary
+
+    def to_json(self) -> str:
+        return json.dumps(self.summary(), sort_keys=True)
+
+    def dump(self, path: str):
+        with open(path, 'w') as summary_file:
+            summary_file.write(self.to_json())
+
+    def reset(self):
+        self.samples.clear()
+
+
+# nearest-rank percentile of sorted samples
+def get_percentile(ordered: List[float], percentile: float) -> float:
+    assert len(ordered) > 0, "No samples"
+    return ordered[max(0, math.ceil(percentile / 100 * len(ordered)) - 1)]
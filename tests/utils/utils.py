@@ -1,13 +1,22 @@
+import hashlib
+import os
+import re
+from collections import ChainMap
+from concurrent.futures import Executor, ProcessPoolExecutor
+from itertools import repeat
 from starkware.crypto.signature.signature import private_to_stark_key
 from starkware.starknet.services.api.contract_class import ContractClass
 from starkware.starknet.testing.contract import StarknetContract
 from starkware.starknet.testing.state import StarknetState
+from starkware.starknet.business_logic.state.state import CachedState
 from starkware.starkware_utils.error_handling import StarkException
 from starkware.starknet.compiler.compile import compile_starknet_files
+from starkware.cairo.lang.version import __version__ as cairo_lang_version
 from starkware.starknet.compiler.compile import get_selector_from_name
 from starkware.starknet.business_logic.execution.objects import Event
 from typing import Optional, List, Tuple
 from starkware.crypto.signature.signature import private_to_stark_key, sign
+from utils.fast_signature import sign_fast
 from starkware.starknet.public.abi import AbiType
 from starkware.starknet.definitions.error_codes import StarknetErrorCode
 
@@ -15,15 +24,79 @@ from starkware.starknet.definitions.error_codes import StarknetErrorCode
 ERC165_INTERFACE_ID = 0x01ffc9a7
 ERC165_ACCOUNT_INTERFACE_ID = 0x3943f10f
 
+COMPILE_CACHE_DIR = os.environ.get('COMPILE_CACHE_DIR', os.path.normpath(os.path.join(os.path.dirname(__file__), '..', '.compile_cache')))
+CAIRO_IMPORT_RE = re.compile(r'^\s*from\s+([\w.]+)\s+import', re.MULTILINE)
+
 def str_to_felt(text: str) -> int:
     b_text = bytes(text, 'UTF-8')
     return int.from_bytes(b_text, "big")
 
 def compile(path: str) -> ContractClass:
+    cache_path = get_compile_cache_path(path)
+    if os.path.exists(cache_path):
+        with open(cache_path) as cache_file:
+            return ContractClass.loads(cache_file.read())
+
     contract_cls = compile_starknet_files([path], debug_info=True)
+    store_compiled_contract(path, cache_path, contract_cls)
     return contract_cls
 
 
+# compiles the contracts missing from the cache in parallel worker processes, the classes are returned in the order of paths
+def compile_many(paths: List[str], max_workers: Optional[int] = None) -> List[ContractClass]:
+    missing = [path for path in dict.fromkeys(paths) if not os.path.exists(get_compile_cache_path(path))]
+    if len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=min(len(missing), max_workers or os.cpu_count() or 1)) as executor:
+            # the workers fill the cache, the classes are then loaded from it
+            list(executor.map(compile, missing))
+    return [compile(path) for path in paths]
+
+
+# local cairo files imported by path, directly or not, libraries are covered by the cairo-lang version
+def get_cairo_dependencies(path: str) -> List[str]:
+    dependencies = []
+    pending = [path]
+    while pending:
+        current = pending.pop()
+        if current in dependencies:
+            continue
+        dependencies.append(current)
+        with open(current) as cairo_file:
+            for module in CAIRO_IMPORT_RE.findall(cairo_file.read()):
+                module_path = os.path.join(*module.split('.')) + '.cairo'
+                if os.path.exists(module_path):
+                    pending.append(module_path)
+    return sorted(dependencies)
+
+
+# the compiled classes are cached by a hash of the sources they are built from and the compiler version
+def get_compile_cache_path(path: str) -> str:
+    key = hashlib.sha256(cairo_lang_version.encode())
+    for dependency in get_cairo_dependencies(path):
+        key.update(dependency.encode())
+        with open(dependency, 'rb') as cairo_file:
+            key.update(hashlib.sha256(cairo_file.read()).digest())
+    return os.path.join(COMPILE_CACHE_DIR, f"{get_compile_cache_prefix(path)}{key.hexdigest()}.json")
+
+
+def get_compile_cache_prefix(path: str) -> str:
+    return os.path.normpath(path).replace(os.sep, '_') + '-'
+
+
+def store_compiled_contract(path: str, cache_path: str, contract_cls: ContractClass):
+    os.makedirs(COMPILE_CACHE_DIR, exist_ok=True)
+    # evict the classes compiled from older sources
+    prefix = get_compile_cache_prefix(path)
+    for cached in os.listdir(COMPILE_CACHE_DIR):
+        if cached.startswith(prefix) and os.path.join(COMPILE_CACHE_DIR, cached) != cache_path:
+            os.remove(os.path.join(COMPILE_CACHE_DIR, cached))
+    # write then rename so concurrent test workers never read a partial file
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as cache_file:
+        cache_file.write(contract_cls.dumps())
+    os.replace(tmp_path, cache_path)
+
+
 def cached_contract(state: StarknetState, _class: ContractClass, deployed: StarknetContract) -> StarknetContract:
     return build_contract(
         state=state,
@@ -32,8 +105,27 @@ def cached_contract(state: StarknetState, _class: ContractClass, deployed: Stark
     )
 
 
-def copy_contract_state(contract: StarknetContract) -> StarknetContract:
-    return build_contract(contract=contract, state=contract.state.copy())
+def copy_contract_state(contract: StarknetContract, fork: bool = False) -> StarknetContract:
+    return build_contract(contract=contract, state=fork_state(contract.state) if fork else contract.state.copy())
+
+
+# Returns a copy-on-write fork of state: the fork reads through to state and only records its own writes.
+# Unlike state.copy() nothing is copied, so state must not be modified while its forks are in use
+def fork_state(state: StarknetState) -> StarknetState:
+    parent = state.state
+    fork = StarknetState(
+        state=CachedState(
+            block_info=parent.block_info,
+            state_reader=parent,
+            # the classes declared on the fork are only added to the first mapping
+            contract_class_cache=ChainMap({}, parent.contract_classes),
+        ),
+        general_config=state.general_config,
+    )
+    fork.events = list(state.events)
+    fork.l2_to_l1_messages_log = list(state.l2_to_l1_messages_log)
+    fork._l2_to_l1_messages = dict(state._l2_to_l1_messages)
+    return fork
 
 
 def build_contract(contract: StarknetContract, state: StarknetState = None,  custom_abi: AbiType = None) -> StarknetContract:
@@ -71,12 +163,32 @@ def assert_event_emitted(tx_exec_info, from_address, name, data = []):
 
 
 class StarkKeyPair:
-    def __init__(self, private_key: int):
+    # accelerated key pairs sign with the precomputed generator table of utils.fast_signature,
+    # the signatures are identical to the reference ones
+    def __init__(self, private_key: int, accelerated: bool = False):
         self.private_key = private_key
         self.public_key = private_to_stark_key(private_key)
+        self.sign_function = sign_fast if accelerated else sign
 
     def sign(self, message_hash: int) -> Tuple[int, int]:
-        return sign(msg_hash=message_hash, priv_key=self.private_key)
+        return self.sign_function(msg_hash=message_hash, priv_key=self.private_key)
+
+    # signs in the executor when one is given, the signatures are returned in the order of the hashes
+    def sign_many(self, message_hashes: List[int], executor: Optional[Executor] = None, chunksize: int = 16) -> List[Tuple[int, int]]:
+        if executor is None:
+            return [self.sign(message_hash) for message_hash in message_hashes]
+        return list(executor.map(self.sign_function, message_hashes, repeat(self.private_key), chunksize=chunksize))
+
+
+# encodes the calldata of __execute__ for the calls, without running the account
+def get_execute_calldata(calls) -> List[int]:
+    call_array, calldata = from_call_to_call_array(calls)
+    return [
+        len(call_array),
+        *[item for entry in call_array for item in entry],
+        len(calldata),
+        *calldata
+    ]
 
 
 def from_call_to_call_array(calls):